@@ -0,0 +1,132 @@
+"""
+Per-tick cost of create_distance_map and DistanceMap.update.
+
+Run from the root of the project:
+    python -m benchmarks.bench_distance_map
+"""
+import timeit
+
+import numpy as np
+import pandas as pd
+
+import controller as ctl
+from records import STATUS_CODES, component_id
+
+
+RECORD_SIZES = (500, 2000, 20000)
+
+# FORMAT of DistanceRadarBaseComponent and DistanceRadarSensorComponent. components.py needs the GPIO library.
+BASE_FORMAT   = ('timestamp', 'comp_id', 'pos', 'min_degree', 'max_degree')
+SENSOR_FORMAT = ('timestamp', 'comp_id', 'distance', 'status')
+
+
+SWEEP_MIN, SWEEP_MAX = -60., 40.
+SWEEP_SPEED = 35.5      # degree per second, 0.71 degree every 20ms
+
+
+def true_position(ts):
+    """
+    The position of the radar at the times ts (in nanosecond): a triangle wave between SWEEP_MIN and SWEEP_MAX.
+    """
+    span = SWEEP_MAX - SWEEP_MIN
+    phase = (np.asarray(ts) * 1e-9 * SWEEP_SPEED) % (2 * span)
+    return SWEEP_MIN + np.where(phase < span, phase, 2 * span - phase)
+
+
+def synthetic_streams(record_size, seed=0):
+    """
+    Build the radar base and distance sensor data of a sweep between -60 and 40 degrees, sampled like main.py does:
+    one radar position every ~20ms and one distance reading every ~1.5ms. The timestamps are in nanosecond.
+    """
+    rng = np.random.default_rng(seed)
+
+    base_ts = (1e12 + np.cumsum(rng.normal(0.020, 0.001, record_size)) * 1e9).astype(np.int64)
+    df_base = pd.DataFrame({'timestamp': base_ts, 'comp_id': component_id('DistanceRadarBase::radar_base'), 'pos': true_position(base_ts),
+                            'min_degree': SWEEP_MIN, 'max_degree': SWEEP_MAX}, columns=BASE_FORMAT)
+
+    sensor_ts = base_ts[-1] - (np.cumsum(rng.normal(0.0015, 0.0002, record_size))[::-1] * 1e9).astype(np.int64)
+    distance = rng.uniform(0.05, 3.5, record_size)
+    failed = rng.random(record_size) < 0.05
+    distance[failed] = np.nan
+    df_sensor = pd.DataFrame({'timestamp': sensor_ts, 'comp_id': component_id('DistanceRadarSensor::radar_distance_sensor'),
+                              'distance': distance, 'status': np.where(failed, STATUS_CODES['FAIL'], STATUS_CODES['SUCC'])},
+                             columns=SENSOR_FORMAT)
+
+    return df_base, df_sensor
+
+
+def legacy_format_timestamp(ts, factor=100):
+    # the legacy join key: time.time() seconds truncated to 10ms buckets
+    return (np.asarray(ts) * 1e-9 * factor).astype(np.int64)
+
+
+def legacy_positions(df_radar_base, df_distance_sensor):
+    """
+    The position attributed to each reading by the legacy join: the last radar position of the same or an earlier bucket.
+    """
+    kb = legacy_format_timestamp(df_radar_base['timestamp'])
+    ks = legacy_format_timestamp(df_distance_sensor['timestamp'])
+    i = np.searchsorted(kb, ks, side='right') - 1
+    pos = np.asarray(df_radar_base['pos'])[np.maximum(i, 0)]
+    return np.where(i >= 0, pos, np.nan)
+
+
+def legacy_create_distance_map(df_radar_base, df_distance_sensor):
+    """
+    The pandas implementation that create_distance_map replaced. Kept as the reference of the benchmark and of
+    tests/test_distance_map.py.
+    """
+    df_sensor = df_distance_sensor.assign(timestamp=legacy_format_timestamp(df_distance_sensor['timestamp']))
+    df_base   = df_radar_base.assign(timestamp=legacy_format_timestamp(df_radar_base['timestamp']))
+
+    df = pd.merge(df_sensor, df_base, on='timestamp', how='outer', suffixes=('_sensor','_base')).sort_values('timestamp', kind='stable')
+    df['distance'] = df['distance'].ffill()
+    df['status']   = df['status'].ffill()
+    df['pos']      = df['pos'].ffill()
+
+    df_work = df[(df['pos'].notnull()) & (df['distance'].notnull())]
+    df_work = df_work[['pos','timestamp','distance', 'status']].copy()
+    df_work['pos_bin'] = df_work['pos'].astype(int)
+    df_work = df_work.groupby(by=['pos_bin','timestamp'], as_index=False)['distance'].mean()
+    df_work = df_work.sort_values(['pos_bin','timestamp'])
+
+    return df_work.groupby(by='pos_bin').apply(lambda x: x.loc[ (x['timestamp'] == x['timestamp'].max()), 'distance'].mean())
+
+
+def best_of(func, repeat=5):
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def main():
+    print('{:>12} {:>14} {:>14} {:>10}'.format('record_size', 'legacy (ms)', 'numpy (ms)', 'speedup'))
+    for record_size in RECORD_SIZES:
+        df_base, df_sensor = synthetic_streams(record_size)
+
+        t_legacy = best_of(lambda: legacy_create_distance_map(df_base, df_sensor))
+        t_numpy = best_of(lambda: ctl.create_distance_map(df_base, df_sensor))
+        print('{:>12} {:>14.3f} {:>14.3f} {:>9.1f}x'.format(record_size, t_legacy * 1e3, t_numpy * 1e3, t_legacy / t_numpy))
+
+    # error of the position attributed to each reading, against the true position of the radar at the reading time
+    df_base, df_sensor = synthetic_streams(RECORD_SIZES[-1])
+    truth = true_position(df_sensor['timestamp'])
+    print('{:>12} {:>14} {:>14} {:>14}'.format('alignment', 'mean (deg)', 'p99 (deg)', 'wrong bin'))
+    for name, pos in (('legacy', legacy_positions(df_base, df_sensor)),
+                      ('interpolated', ctl.align_positions(df_base['timestamp'], df_base['pos'], df_sensor['timestamp']))):
+        ok = ~np.isnan(pos)
+        error = np.abs(pos[ok] - truth[ok])
+        wrong = np.mean(np.rint(pos[ok]) != np.rint(truth[ok]))
+        print('{:>12} {:>14.3f} {:>14.3f} {:>13.1%}'.format(name, error.mean(), np.percentile(error, 99), wrong))
+
+    # the incremental map only sees the messages of one tick, whatever the size of the history
+    distance_map = ctl.DistanceMap(min_degree=-90, max_degree=90)
+    distance_map.update(df_base, df_sensor)
+    new_base = df_base.to_records(index=False)[-1:]
+    new_sensor = df_sensor.to_records(index=False)[-14:]
+    t_incremental = best_of(lambda: distance_map.update(new_base, new_sensor))
+    print('DistanceMap.update with {} new messages: {:.3f} ms'.format(len(new_base) + len(new_sensor), t_incremental * 1e3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+"""
+Sweep speed of DistanceRadarBaseComponent over the -60..40 degree range of main.py, with a constant step delay and
+with an acceleration profile.
+
+Run from the root of the project:
+    python -m benchmarks.bench_stepper
+"""
+import time
+
+from components import DistanceRadarBaseComponent
+from stepper_motor import RampProfile
+
+
+MIN_DEGREE = -60
+MAX_DEGREE = 40
+PINS = [3, 5, 7, 11]
+
+CONFIGS = (
+    ('constant 2.5ms', None),
+    ('trapezoid 2.5ms -> 1.2ms', RampProfile(start_delay=0.0025, min_delay=0.0012, accel_steps=100, shape=RampProfile.TRAPEZOID)),
+    ('s-curve 2.5ms -> 1.2ms', RampProfile(start_delay=0.0025, min_delay=0.0012, accel_steps=100, shape=RampProfile.S_CURVE)),
+)
+
+
+def sweep_speed(profile):
+    """
+    Time one sweep from min_degree to max_degree. Return the speed in degree per second.
+    """
+    radar_base = DistanceRadarBaseComponent(name='radar_base', pins=list(PINS), step_size=0.71, initial_pos=MIN_DEGREE,
+                                            min_degree=MIN_DEGREE, max_degree=MAX_DEGREE, delay=0.0025, delay_factor=5, profile=profile)
+    start = time.perf_counter()
+    while radar_base.direction == DistanceRadarBaseComponent.ANTI_CLOCKWISE:
+        radar_base.run()
+    elapsed = time.perf_counter() - start
+    return (MAX_DEGREE - MIN_DEGREE) / elapsed
+
+
+def main():
+    for label, profile in CONFIGS:
+        print('{:>28}: {:6.1f} deg/s'.format(label, sweep_speed(profile)))
+
+
+if __name__ == '__main__':
+    main()
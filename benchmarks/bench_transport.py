@@ -0,0 +1,129 @@
+"""
+Throughput and latency of the sample transports: multiprocessing.Queue (one message per put, batched with
+transport.BatchPublisher, or batched and packed with records.RecordCodec) against transport.SharedRingQueue.
+
+A producer process sends distance sensor messages at a fixed rate and the consumer measures the delay between the
+timestamp of each message and its reception.
+
+Run from the root of the project:
+    python -m benchmarks.bench_transport
+"""
+import multiprocessing as mp
+import queue
+import time
+
+import numpy as np
+
+from clock import now_ns
+from records import RecordCodec, STATUS_CODES, component_id
+from transport import BatchPublisher, MessageBatch, SharedRingQueue
+
+
+RATES = (1000, 10000, 100000)
+DURATION = 1.
+SENSOR_FORMAT = ('timestamp', 'comp_id', 'distance', 'status')
+POLL_INTERVAL = 0.0001
+BATCH_SIZE = 32
+BATCH_AGE = 0.005
+SENSOR_DTYPE = RecordCodec(SENSOR_FORMAT).dtype
+TRANSPORTS = ('mp.Queue', 'mp.Queue+batch', 'mp.Queue+packed', 'shm ring')
+
+
+def produce(Q, rate, n_msgs, put_time, batched, packed):
+    if batched:
+        Q = BatchPublisher(Q, batch_size=BATCH_SIZE, batch_age=BATCH_AGE, codec=RecordCodec(SENSOR_FORMAT) if packed else None)
+    period = 1. / rate
+    start = time.perf_counter()
+    comp_id = component_id('DistanceRadarSensor::radar_distance_sensor')
+    succ = STATUS_CODES['SUCC']
+    total = 0.
+    for i in range(n_msgs):
+        deadline = start + i * period
+        while time.perf_counter() < deadline:
+            pass
+        t = time.perf_counter()
+        Q.put((now_ns(), comp_id, 1.5, succ))
+        total += time.perf_counter() - t
+    if batched:
+        Q.flush()
+    put_time.value = total
+
+
+def consume_queue(Q, n_msgs):
+    latencies = np.empty(n_msgs)
+    i = 0
+    while i < n_msgs:
+        msg = Q.get()
+        now = now_ns()
+        if isinstance(msg, bytes):
+            ts = np.frombuffer(msg, dtype=SENSOR_DTYPE)['timestamp']
+            latencies[i:i + len(ts)] = (now - ts) * 1e-9
+            i += len(ts)
+        elif isinstance(msg, MessageBatch):
+            for item in msg:
+                latencies[i] = (now - item[0]) * 1e-9
+                i += 1
+        else:
+            latencies[i] = (now - msg[0]) * 1e-9
+            i += 1
+    return latencies
+
+
+def consume_ring(Q, n_msgs):
+    latencies = np.empty(n_msgs)
+    i = 0
+    while i < n_msgs:
+        batch = Q.drain()
+        if len(batch) == 0:
+            time.sleep(POLL_INTERVAL)
+            continue
+        latencies[i:i + len(batch)] = (now_ns() - batch['timestamp']) * 1e-9
+        i += len(batch)
+    return latencies
+
+
+def run(transport, rate):
+    n_msgs = int(rate * DURATION)
+    if transport.startswith('mp.Queue'):
+        Q, consume = mp.Queue(), consume_queue
+    else:
+        Q, consume = SharedRingQueue(fields=SENSOR_FORMAT, capacity=65536), consume_ring
+
+    put_time = mp.Value('d', 0.)
+    producer = mp.Process(target=produce, args=(Q, rate, n_msgs, put_time, transport in ('mp.Queue+batch', 'mp.Queue+packed'),
+                                                transport == 'mp.Queue+packed'))
+
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    producer.start()
+    latencies = consume(Q, n_msgs)
+    elapsed = time.perf_counter() - start
+    consumer_cpu = time.process_time() - cpu_start
+    producer.join()
+
+    if transport == 'shm ring':
+        Q.close()
+
+    return {
+        'transport':            transport,
+        'rate':                 rate,
+        'achieved_rate':        n_msgs / elapsed,
+        'latency_mean_us':      latencies.mean() * 1e6,
+        'latency_p99_us':       np.percentile(latencies, 99) * 1e6,
+        'consumer_cpu_us':      consumer_cpu / n_msgs * 1e6,
+        'put_us':               put_time.value / n_msgs * 1e6,
+    }
+
+
+def main():
+    header = ('transport', 'rate', 'achieved', 'mean (us)', 'p99 (us)', 'cons. cpu/msg', 'put/msg')
+    print('{:>15} {:>8} {:>10} {:>10} {:>10} {:>14} {:>14}'.format(*header))
+    for rate in RATES:
+        for transport in TRANSPORTS:
+            res = run(transport, rate)
+            print('{transport:>15} {rate:>8} {achieved_rate:>10.0f} {latency_mean_us:>10.1f} {latency_p99_us:>10.1f} '
+                  '{consumer_cpu_us:>13.2f}u {put_us:>13.2f}u'.format(**res))
+
+
+if __name__ == '__main__':
+    main()
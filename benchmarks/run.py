@@ -0,0 +1,405 @@
+"""
+Benchmark suite of the data and control hot paths. It runs without hardware: the GPIO backend defaults to the
+simulation (see gpio_backend).
+
+The results are durations in second (lower is better), written as JSON and compared to a stored baseline. A timing is
+the median of REPEAT repetitions, so one slow repetition does not move it. A metric slower than the baseline by more
+than the threshold is a regression and the exit status is 1. The threshold of the latencies across processes
+(NOISY_PREFIXES) is NOISY_FACTOR times larger. The timings under FAST_LIMIT also get a slack of FAST_SLACK second: from
+one run to the next, they can move by a few hundred nanoseconds, which is up to 2x for a sub-microsecond timing.
+
+The baseline depends on the machine: record it on the machine that runs the comparison.
+
+Run from the root of the project:
+    python -m benchmarks.run                                  # run and compare to benchmarks/baseline.json
+    python -m benchmarks.run --output results.json            # also write the results
+    python -m benchmarks.run --save-baseline                  # replace the baseline with the results
+    python -m benchmarks.run --only distance_map              # only the cases whose name starts with distance_map
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import timeit
+
+os.environ.setdefault('AUTOCAR_GPIO', 'sim')
+
+import multiprocessing as mp
+
+import numpy as np
+
+import controller as ctl
+from occupancy_grid import OccupancyGrid
+from odometry import Odometry, WheelModel
+from planner import VFHPlanner
+from clock import now_ns, to_seconds
+from components import Component, ContinuousComponentWrapper, WheelComponent, DifferentialDriveComponent, CMD_EXIT
+from gpio_backend import GPIO_BACKEND_ENV, SIM
+from engine import Engine
+from transport import CommandChannel
+from commands import Command, command_table
+from records import component_id, make_dtype
+from benchmarks.bench_distance_map import SENSOR_FORMAT, synthetic_streams
+
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+THRESHOLD = 0.25
+
+# the latencies across processes depend on the scheduler and are noisier than the in-process timings
+NOISY_PREFIXES = ('wrapper.', 'engine.', 'drive.')
+NOISY_FACTOR = 4
+
+# the timings of a few microseconds move with the cache and the frequency of the processor
+FAST_LIMIT = 10e-6
+FAST_SLACK = 1e-6
+
+REPEAT = 9
+
+
+
+class EchoComponent(Component):
+    """
+    Component without hardware. It sends back the sequence number of the last echo command it executed.
+    """
+    FORMAT = ('timestamp', 'comp_id', 'seq')
+    COMMANDS = (
+        Command('echo', ('seq', 'q')),
+        Command('set_value', ('value', 'q')),
+        Command('ping'),
+    )
+
+    def __init__(self, name='echo'):
+        self._name = name
+        self._comp_id = component_id('Echo::{}'.format(name))
+        self._seq = 0
+        self._sent = 0
+        self._value = 0
+
+    def echo(self, seq):
+        self._seq = seq
+
+    def set_value(self, value):
+        self._value = value
+
+    def ping(self):
+        pass
+
+    def run(self):
+        # wait for the next command, unless there is an echo to send
+        if self._seq == self._sent:
+            self.idle(0.05)
+
+    def send_msg(self, Q):
+        if self._seq != self._sent:
+            Q.put((now_ns(), self._comp_id, self._seq))
+            self._sent = self._seq
+
+
+
+def median_of(func, repeat=REPEAT):
+    """
+    The median duration of a call of func, over repeat repetitions of as many calls as autorange runs in 0.2 s.
+    """
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return float(np.median(timer.repeat(repeat=repeat, number=number))) / number
+
+
+def bench_raw_data_handler(results):
+    msgs = [tuple(row) for row in synthetic_streams(2000)[1].itertuples(index=False)]
+    handler = ctl.RawDataHandler(name='sensor', parser=SENSOR_FORMAT, record_size=2000)
+    handler.extend(msgs)
+
+    msg = msgs[0]
+    results['raw_data_handler.update'] = median_of(lambda: handler.update(msg))
+    batch = msgs[:32]
+    results['raw_data_handler.extend_32'] = median_of(lambda: handler.extend(batch))
+
+    def update_then_data():
+        handler.update(msg)
+        return handler.data
+    results['raw_data_handler.update_then_data'] = median_of(update_then_data)
+
+
+def bench_distance_map(results):
+    for record_size in (500, 2000, 20000):
+        df_base, df_sensor = synthetic_streams(record_size)
+        results['distance_map.create_{}'.format(record_size)] = median_of(lambda: ctl.create_distance_map(df_base, df_sensor))
+
+    # one tick of the scanning radar: a few readings with their position
+    df_base, df_sensor = synthetic_streams(2000)
+    scan = np.zeros(len(df_sensor), dtype=[('timestamp', np.int64), ('pos', np.float64), ('distance', np.float64)])
+    scan['timestamp'] = df_sensor['timestamp']
+    scan['pos'] = ctl.align_positions(df_base['timestamp'], df_base['pos'], df_sensor['timestamp'])
+    scan['distance'] = df_sensor['distance']
+    distance_map = ctl.DistanceMap(min_degree=-90, max_degree=90)
+    distance_map.update_scan(scan)
+    tick = scan[-8:]
+    results['distance_map.update_scan_8'] = median_of(lambda: distance_map.update_scan(tick))
+
+
+def bench_occupancy_grid(results):
+    # a sweep of 101 readings in front of a wall at 1m, and the readings of one tick of the scanning radar
+    angles = np.arange(-50., 51.)
+    distances = 1. / np.cos(np.deg2rad(angles))
+    grid = OccupancyGrid(cell_size=0.05, size=200)
+    results['occupancy_grid.update_sweep_101'] = median_of(lambda: grid.update(angles, distances))
+    results['occupancy_grid.update_tick_8'] = median_of(lambda: grid.update(angles[:8], distances[:8]))
+
+
+def _wheel_msgs(n, pulse, start_ns=0, repeat=10):
+    msgs = np.zeros(n, dtype=make_dtype(WheelComponent.FORMAT))
+    msgs['pulse'] = pulse
+    msgs['repeat'] = repeat
+    msgs['timestamp'] = start_ns + np.cumsum(np.full(n, int(repeat * (pulse + 0.020) * 1e9)))
+    return msgs
+
+
+def bench_odometry(results):
+    # the wheels turn at different speeds: the pose follows an arc
+    left, right = WheelModel(0.001462, 0.00025), WheelModel(0.001450, 0.00025, mirror=True)
+    for n in (1, 100):
+        left_msgs, right_msgs = _wheel_msgs(n, 0.001662), _wheel_msgs(n, 0.001400)
+        shift = int(left_msgs['timestamp'][-1])
+        odometry = Odometry(left=left, right=right)
+
+        def integrate():
+            left_msgs['timestamp'] += shift
+            right_msgs['timestamp'] += shift
+            odometry.update('left', left_msgs)
+            odometry.update('right', right_msgs)
+            odometry.compute_current_param()
+        results['odometry.integrate_{}'.format(n)] = median_of(integrate)
+
+
+def bench_planner(results):
+    # the bins of the radar of main.py, and the readings of one tick of the scanning radar
+    angles = np.arange(-60, 41)
+    distance = 1. / np.cos(np.deg2rad(angles))
+    planner = VFHPlanner()
+    planner.decide(angles, distance)
+    tick = np.arange(8)
+
+    def decide():
+        distance[tick] *= -1.
+        distance[tick] += 2.
+        planner.decide(angles, distance)
+    results['planner.decide_tick_8'] = median_of(decide)
+    results['planner.decide_unchanged'] = median_of(lambda: planner.decide(angles, distance))
+
+
+def bench_parse_and_execute(results):
+    comp = EchoComponent()
+    results['parse_and_execute.name_only'] = median_of(lambda: comp.parse_and_execute(('ping',)))
+    results['parse_and_execute.args'] = median_of(lambda: comp.parse_and_execute(('set_value', (1,))))
+    results['parse_and_execute.args_kwargs'] = median_of(lambda: comp.parse_and_execute(('set_value', (), {'value': 1})))
+
+    # the same commands in wire form
+    commands = command_table(EchoComponent)
+    ping, set_value = commands.encode('ping'), commands.encode('set_value', 1)
+    results['parse_and_execute.wire_name_only'] = median_of(lambda: comp.parse_and_execute(ping))
+    results['parse_and_execute.wire_args'] = median_of(lambda: comp.parse_and_execute(set_value))
+
+
+def _percentiles(prefix, latencies, results):
+    results[prefix + '_p50'] = float(np.percentile(latencies, 50))
+    results[prefix + '_p99'] = float(np.percentile(latencies, 99))
+
+
+def bench_wrapper_round_trip(results, n=200):
+    """
+    Time from the put of a command to the reception of the message that the component sends after executing it.
+    """
+    cmd_Q, output_Q = CommandChannel(), mp.Queue()
+    wrapper = ContinuousComponentWrapper(component=EchoComponent(), cmd_Q=cmd_Q, output_Q=output_Q)
+    wrapper.start()
+
+    commands = command_table(EchoComponent)
+    latencies = np.empty(n)
+    for seq in range(1, n + 1):
+        start = now_ns()
+        cmd_Q.put(commands.encode('echo', seq))
+        while True:
+            msg = output_Q.get()
+            if msg[2] == seq:
+                break
+        latencies[seq - 1] = to_seconds(now_ns() - start)
+
+    cmd_Q.put(CMD_EXIT)
+    wrapper.join()
+    _percentiles('wrapper.round_trip', latencies, results)
+
+
+def _wheels():
+    left = WheelComponent(name='left_wheel', mirror=False, pin_signal=13, repeat=10, reference_pulse=0.001462)
+    right = WheelComponent(name='right_wheel', mirror=True, pin_signal=15, repeat=10, reference_pulse=0.001450)
+    return left, right
+
+
+def _command_latency(engine, n):
+    for i in range(n):
+        engine.increase_speed(0.01 if i % 2 == 0 else -0.01)
+        time.sleep(0.05)
+    time.sleep(0.1)
+    latency = engine.command_latency.values()
+    return np.mean([stats['mean'] for stats in latency]), max(stats['max'] for stats in latency)
+
+
+def _stop_response(engine, n, timeout=0.5):
+    """
+    Stop the simulated robot n times. Return the delays between Engine.stop and the stop of both wheels, and the
+    delays between the stops of the two wheels.
+
+    Note:
+        A wheel stops at the time of its first stop pulse (sim_world.World.wheel_pulse_times), not when this loop sees
+        the stop: the wheel process can hold the processor for a few milliseconds between the two pulses.
+    """
+    import math
+    from sim_world import world
+
+    rng = np.random.default_rng(0)
+    latencies, skews = [], []
+    for i in range(n):
+        engine.set_speed(0.8, 0.8)
+        # the stop is sent at any time of the period of the pulses
+        time.sleep(0.1 + rng.uniform(0., 0.025))
+        # the simulated pulses are measured from the edges, so a stopped wheel can keep a tiny speed
+        before = world.wheel_speeds
+        start = time.monotonic()
+        engine.stop()
+        stopped = [None, None]
+        while None in stopped and time.monotonic() < start + timeout:
+            speeds = world.wheel_speeds
+            pulse_times = world.wheel_pulse_times
+            now = time.monotonic()
+            for side in (0, 1):
+                if stopped[side] is None and abs(speeds[side]) < 0.5 * abs(before[side]):
+                    stopped[side] = pulse_times[side] if math.isfinite(pulse_times[side]) else now
+            # do not take the processor from the wheels
+            time.sleep(0.0002)
+        if None not in stopped:
+            latencies.append(max(stopped) - start)
+            skews.append(abs(stopped[0] - stopped[1]))
+    return latencies, skews
+
+
+def bench_engine_command_latency(results, n=20):
+    """
+    Delay between an Engine command and its execution by the wheel processes, which are sending pulses. With the
+    simulated robot, also the delay until a stop reaches both wheels and the delay between the two wheels.
+    """
+    left, right = _wheels()
+    engine = Engine(left_wheel_comp=left, right_wheel_comp=right)
+    engine.start()
+    results['engine.command_latency_mean'], results['engine.command_latency_max'] = _command_latency(engine, n)
+    if os.environ.get(GPIO_BACKEND_ENV) == SIM:
+        latencies, skews = _stop_response(engine, n)
+        _percentiles('engine.stop_latency', latencies, results)
+        _percentiles('engine.wheel_skew', skews, results)
+    engine.shutdown()
+
+
+def bench_drive_command_latency(results, n=20):
+    """
+    The same as bench_engine_command_latency, with both wheels driven by one DifferentialDriveComponent.
+    """
+    left, right = _wheels()
+    engine = Engine(drive_comp=DifferentialDriveComponent(name='drive', left_wheel=left, right_wheel=right))
+    engine.start()
+    results['drive.command_latency_mean'], results['drive.command_latency_max'] = _command_latency(engine, n)
+    if os.environ.get(GPIO_BACKEND_ENV) == SIM:
+        latencies, skews = _stop_response(engine, n)
+        _percentiles('drive.stop_latency', latencies, results)
+        _percentiles('drive.wheel_skew', skews, results)
+    engine.shutdown()
+
+
+CASES = (
+    ('raw_data_handler', bench_raw_data_handler),
+    ('distance_map', bench_distance_map),
+    ('occupancy_grid', bench_occupancy_grid),
+    ('odometry', bench_odometry),
+    ('planner', bench_planner),
+    ('parse_and_execute', bench_parse_and_execute),
+    ('wrapper', bench_wrapper_round_trip),
+    ('engine', bench_engine_command_latency),
+    ('drive', bench_drive_command_latency),
+)
+
+
+def run(only=None):
+    results = {}
+    for name, case in CASES:
+        if only is None or name.startswith(only):
+            case(results)
+    return {
+        'meta': {
+            'time':     time.time(),
+            'python':   platform.python_version(),
+            'numpy':    np.__version__,
+            'machine':  platform.machine(),
+        },
+        'results': results,
+    }
+
+
+def compare(results, baseline, threshold=THRESHOLD):
+    """
+    Return the rows (name, baseline, result, ratio, regression) of the metrics present in both.
+    """
+    rows = []
+    for name, value in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None or not base > 0:
+            rows.append((name, None, value, None, False))
+            continue
+        ratio = value / base
+        limit = threshold
+        if name.startswith(NOISY_PREFIXES):
+            limit *= NOISY_FACTOR
+        elif base < FAST_LIMIT:
+            limit += FAST_SLACK / base
+        rows.append((name, base, value, ratio, ratio > 1. + limit))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks of the hot paths.')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', default=BASELINE, help='the baseline JSON file')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD, help='relative slowdown counted as a regression')
+    parser.add_argument('--save-baseline', action='store_true', help='write the results to the baseline file')
+    parser.add_argument('--only', help='only run the cases whose name starts with this prefix')
+    args = parser.parse_args(argv)
+
+    report = run(args.only)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+
+    regressions = 0
+    print('{:<40} {:>14} {:>14} {:>8}'.format('benchmark', 'baseline (us)', 'result (us)', 'ratio'))
+    for name, base, value, ratio, regression in compare(report['results'], baseline, args.threshold):
+        print('{:<40} {:>14} {:>14.2f} {:>8} {}'.format(name, '{:.2f}'.format(base * 1e6) if base is not None else '-', value * 1e6,
+                                                         '{:.2f}'.format(ratio) if ratio is not None else '-',
+                                                         'REGRESSION' if regression else ''))
+        regressions += regression
+
+    if regressions:
+        print('{} regression(s) above {:.0%}'.format(regressions, args.threshold))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
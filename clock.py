@@ -0,0 +1,26 @@
+"""
+The clock used to timestamp the messages of all the components.
+
+time.time can jump (NTP, manual change) and its resolution is coarse. time.monotonic_ns is CLOCK_MONOTONIC on Linux: it
+never goes backward and it is the same clock in every process of the machine, so the timestamps sent by different
+component processes can be compared with each other.
+"""
+import time
+
+
+NS_PER_SECOND = 1000000000
+
+
+def now_ns():
+    """
+    The current time, in integer nanoseconds.
+    """
+    return time.monotonic_ns()
+
+
+def to_seconds(ns):
+    return ns / NS_PER_SECOND
+
+
+def to_ns(seconds):
+    return int(seconds * NS_PER_SECOND)
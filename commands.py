@@ -0,0 +1,128 @@
+"""
+Command set of the components and its compact wire form.
+
+A component declares the commands it accepts in its COMMANDS attribute, e.g.
+    COMMANDS = (
+        Command('increase_speed', ('scale', 'd'), ('block', '?')),
+        Command('stop'),
+    )
+Each argument is a name and a struct code. The declarations of a class are compiled once into a CommandTable: the
+command at position i of COMMANDS gets the opcode i, the names of the arguments are checked against the signature of
+the method and the defaults are read from it.
+
+The wire form of a command is bytes: the opcode (one unsigned byte) followed by the arguments packed with struct, e.g.
+9 bytes for increase_speed(0.1, False) instead of about 60 for the pickled ('increase_speed', (0.1,), {}). The
+component executes it with one list lookup and one unpack (see Component.parse_and_execute).
+"""
+import inspect
+import struct
+
+
+class Command:
+    """
+    Declaration of a command.
+
+    Args of __init__:
+        name: the name of the method of the component.
+        args: the (name, struct code) of each argument, in the order of the signature of the method.
+    """
+    def __init__(self, name, *args):
+        assert all(len(arg) == 2 for arg in args), 'An argument is declared as (name, struct code).'
+        self._name = name
+        self._args = tuple(args)
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def args(self):
+        return self._args
+
+
+
+class CommandTable:
+    """
+    The compiled commands of a component class. Use command_table to get the table of a class.
+
+    Args of __init__:
+        cls: a Component class. Its COMMANDS are validated against its methods.
+    """
+    MAX_COMMANDS = 256
+
+    def __init__(self, cls):
+        commands = tuple(cls.COMMANDS)
+        assert len(commands) <= CommandTable.MAX_COMMANDS, 'The opcode is a single byte.'
+
+        self._cls = cls
+        self._names = []
+        self._structs = []
+        self._arg_structs = []
+        self._signatures = []
+        self._opcodes = {}
+        for opcode, command in enumerate(commands):
+            assert command.name not in self._opcodes, 'Command {} is declared twice.'.format(command.name)
+            func = getattr(cls, command.name, None)
+            if not callable(func):
+                raise ValueError('{} declares the command {} but has no such method.'.format(cls.__name__, command.name))
+
+            signature = inspect.signature(func)
+            params = list(signature.parameters)[1:]
+            names = [arg_name for arg_name, _ in command.args]
+            if params != names:
+                raise ValueError('The arguments {} of the command {}.{} do not match the method {}.'.format(names, cls.__name__, command.name, params))
+
+            self._opcodes[command.name] = opcode
+            self._names.append(command.name)
+            codes = ''.join(code for _, code in command.args)
+            self._structs.append(struct.Struct('<B' + codes))
+            self._arg_structs.append(struct.Struct('<' + codes))
+            self._signatures.append(signature.replace(parameters=list(signature.parameters.values())[1:]))
+
+    def opcode(self, name):
+        try:
+            return self._opcodes[name]
+        except KeyError:
+            raise ValueError('{} has no command {}.'.format(self._cls.__name__, name))
+
+    def encode(self, name, *args, **kwargs):
+        """
+        The wire form of the command name called with args and kwargs. The missing arguments take their default value.
+        """
+        opcode = self.opcode(name)
+        if kwargs or len(args) != len(self._signatures[opcode].parameters):
+            bound = self._signatures[opcode].bind(*args, **kwargs)
+            bound.apply_defaults()
+            args = bound.args
+        return self._structs[opcode].pack(opcode, *args)
+
+    def decode(self, data):
+        """
+        The (name, args) of a command in wire form.
+        """
+        opcode = data[0]
+        return self._names[opcode], self._arg_structs[opcode].unpack_from(data, 1)
+
+    def bind(self, component):
+        """
+        The dispatch list of a component: the (bound method, unpack_from) of each opcode. unpack_from(data, 1) returns
+        the arguments.
+        """
+        return [(getattr(component, name), s.unpack_from) for name, s in zip(self._names, self._arg_structs)]
+
+    @property
+    def names(self):
+        return tuple(self._names)
+
+
+
+_tables = {}
+
+def command_table(cls):
+    """
+    The CommandTable of a component class. It is compiled on the first call.
+    """
+    table = _tables.get(cls)
+    if table is None:
+        table = _tables[cls] = CommandTable(cls)
+    return table
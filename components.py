@@ -1,17 +1,39 @@
+import os
 import time
 from abc import ABCMeta, abstractmethod
 import multiprocessing as mp
 
+import numpy as np
 
 from stepper_motor import StepperMotor
 from distance_sensor import DistanceSensor
 from controller import RawDataHandler
-from wheel_motor import WheelMotor
+from wheel_motor import WheelMotor, DifferentialDriveMotor
+from transport import BatchPublisher, CommandChannel
+from clock import now_ns
+from metrics import Metrics
+from commands import Command, command_table
+from records import RecordCodec, STATUS_CODES, component_id, component_name, make_dtype
+from recorder import Recorder, CommandRecorder, RecordingQueue, stream_path, OUTPUT, COMMANDS
 
 CMD_EXIT = '__exit__'
 
+# the distance of a failed reading. The fields of the messages are numbers, see records.py
+NAN = float('nan')
+
 class Component(metaclass=ABCMeta):
+    """
+    Base class of the components. The commands a component accepts are declared in COMMANDS (see commands.py).
+    """
+    COMMANDS = ()
+
+    # set by the ContinuousComponentWrapper. See attach_command_source.
+    _command_pending = None
+    _command_wait = None
 
+    # the dispatch list of the commands and the methods by name, see parse_and_execute
+    _dispatch = None
+    _dispatch_names = None
 
     @abstractmethod
     def send_msg(self,Q):
@@ -31,16 +53,27 @@ class Component(metaclass=ABCMeta):
 
     def parse_and_execute(self, msg_tuple):
         """
-        This function will parse the arguments and call the member function accordingly.
-        The msg_tuple should be (func_name, args, kwargs):
-            func_name : the name fo the member function that will be called
-            args      : the argument list. It is also a tuple.
-            kwargs    : keyword argumetns. It is a dictionary
+        This function will parse the command and call the member function accordingly. Only the commands declared
+        in COMMANDS can be called (see commands.py). The command is either:
+            bytes:              the wire form, see commands.CommandTable.encode. It is the fast path.
+            (func_name, args, kwargs): the legacy form, args and kwargs are optional:
+                func_name : the name fo the member function that will be called
+                args      : the argument list. It is also a tuple.
+                kwargs    : keyword argumetns. It is a dictionary
 
         """
 
         #TODO: add exit status
 
+        dispatch = self._dispatch
+        if dispatch is None:
+            dispatch = self._bind_commands()
+
+        if isinstance(msg_tuple, bytes):
+            func, unpack_from = dispatch[msg_tuple[0]]
+            func(*unpack_from(msg_tuple, 1))
+            return
+
         len_tuple = len(msg_tuple)
 
         if len_tuple == 1:
@@ -56,27 +89,67 @@ class Component(metaclass=ABCMeta):
                 args = comp
             elif isinstance(comp, dict):
                 kwargs = comp
-
-
-
         else: # all components are present
             func_name, args, kwargs = msg_tuple
 
-        func = getattr(self, func_name)
+        func = self._dispatch_names.get(func_name)
+        if func is None:
+            raise ValueError('{} has no command {}.'.format(type(self).__name__, func_name))
         func(*args, **kwargs)
 
+    def _bind_commands(self):
+        # compiled once per class, bound once per instance (in the process that executes the commands)
+        table = command_table(type(self))
+        self._dispatch = table.bind(self)
+        self._dispatch_names = {name: func for name, (func, _) in zip(table.names, self._dispatch)}
+        return self._dispatch
+
+    def attach_command_source(self, pending, wait):
+        """
+        Called by the wrapper before the component starts running in the background.
+
+        Args:
+            pending: callable. Returns True if a command is waiting to be executed.
+            wait:    callable. wait(timeout) blocks until a command is waiting or the timeout expires.
+        """
+        self._command_pending = pending
+        self._command_wait = wait
 
-    def update(self, attr, val):
-        setattr(self, attr, val)
+    def preempted(self):
+        """
+        Return True if a command is waiting. Long operations check it at their yield points and return early, so the
+        command is executed without waiting for the end of the operation.
+        """
+        return self._command_pending is not None and self._command_pending()
 
-    def d_update(self, attr, val):
-        orig_val = getattr(self,attr)
-        setattr(self, attr, orig_val + val)
+    def idle(self, seconds):
+        """
+        Replacement of time.sleep at the yield points of the component. The wait is interrupted when a command arrives.
+        Return True if it was interrupted.
+        """
+        if self._command_wait is None:
+            time.sleep(seconds)
+            return False
+        return self._command_wait(seconds)
 
     @property
     def name(self):
         return self._name
 
+    @property
+    def comp_id(self):
+        """
+        The interned name of the component in its messages, see records.component_id.
+        """
+        return self._comp_id
+
+    def describe(self):
+        """
+        The settings that the consumers of the messages need, e.g. the range of a radar. They are saved with the
+        recordings (see recorder.py).
+        """
+        return {}
+
 
 
 
@@ -87,19 +160,43 @@ class ContinuousComponentWrapper(mp.Process):
 
     Args of __init__:
         component: an instance of component class.
-        cmd_Q:     command queue. It is used to send command to the component when it is running in the background.
-        output_Q:  output queue. The wrapper sends out message or informaiton through this queue.
-
-
+        cmd_Q:     command queue. It is used to send command to the component when it is running in the background. It is a 
+                   transport.CommandChannel (preferred: the component can wait for commands and the command latency is
+                   recorded) or a multiprocessing.Queue.
+        output_Q:  output queue. The wrapper sends out message or informaiton through this queue. It is a multiprocessing.Queue or
+                   any queue with a put method, e.g. transport.SharedRingQueue, or transport.LatestValue for a status of
+                   which only the latest message matters.
+        batch_size: int. If it is set, the messages of the component are sent to output_Q in batches (transport.MessageBatch) of 
+                    at most batch_size messages. Default is None (one put per message).
+        batch_age:  float. If it is set, a batch is sent once its first message is older than batch_age seconds.
+        record_dir: str. If it is set, the messages sent by the component and the commands it executes are recorded in
+                    this directory, see recorder.py.
+
+    Note:
+        The pending batch is always sent after the component executes a command, when its first message is older
+        than batch_age (checked at every loop) and when the wrapper exits. The batches are sent as packed records
+        (records.RecordCodec) when the FORMAT of the component allows it. The consumers should use transport.drain with
+        the dtype of the messages (or controller.retrieve_data) which unpacks the batches.
+
+        The loop is instrumented (see metrics): the number of loops and commands, the duration (ns) of each loop, of
+        component.run and of send_msg, and the depth of output_Q. The metrics are readable from the parent process.
     """
-    def __init__(self, component=None, cmd_Q=None,output_Q=None):
+    # sample the depth of output_Q every DEPTH_INTERVAL loops
+    DEPTH_INTERVAL = 16
+
+    def __init__(self, component=None, cmd_Q=None,output_Q=None, batch_size=None, batch_age=None, record_dir=None):
         assert isinstance(component, Component)
-        assert isinstance(cmd_Q, mp.queues.Queue)
-        assert isinstance(output_Q, mp.queues.Queue)
+        assert hasattr(cmd_Q, 'get')
+        assert hasattr(output_Q, 'put')
 
         self._component = component
         self._output_Q = output_Q
         self._cmd_Q = cmd_Q
+        self._batch_size = batch_size
+        self._batch_age = batch_age
+        self._record_dir = record_dir
+        self._metrics = Metrics(component.name, counters=('loops', 'commands', 'unrecorded_commands'), gauges=('output_depth',),
+                                histograms=('loop', 'run', 'send_msg', 'command'))
         super(ContinuousComponentWrapper,self).__init__()
 
 
@@ -112,25 +209,112 @@ class ContinuousComponentWrapper(mp.Process):
         Running the component in the infinite loop. To change the status of the component, one can send command to the command queue.
         #TODO: add a stop-pill
         """
+        output_Q = self._output_Q
+        out_recorder, cmd_recorder = self._open_recorders()
+        if out_recorder is not None:
+            output_Q = RecordingQueue(output_Q, out_recorder)
+
+        if self._batch_size is not None or self._batch_age is not None:
+            fields = self._component.FORMAT
+            codec = RecordCodec(fields) if RecordCodec.can_pack(fields) else None
+            output_Q = BatchPublisher(output_Q, batch_size=self._batch_size, batch_age=self._batch_age, codec=codec)
+        batching = isinstance(output_Q, BatchPublisher)
+
+        cmd_Q = self._cmd_Q
+        if isinstance(cmd_Q, CommandChannel):
+            pending = cmd_Q.pending
+            self._component.attach_command_source(pending, cmd_Q.wait)
+        else:
+            pending = lambda: not cmd_Q.empty()
+            self._component.attach_command_source(pending, self._sleep_then_check)
+
+        metrics = self._metrics
+        loops, commands = metrics.counter('loops'), metrics.counter('commands')
+        unrecorded = metrics.counter('unrecorded_commands')
+        output_depth = metrics.gauge('output_depth')
+        loop_hist, run_hist = metrics.histogram('loop'), metrics.histogram('run')
+        send_hist, command_hist = metrics.histogram('send_msg'), metrics.histogram('command')
+        last_start = None
+
         try:
 
             while True:
-                while not self._cmd_Q.empty():
-                    cmd = self._cmd_Q.get()
+                start = now_ns()
+                if last_start is not None:
+                    loop_hist.record(start - last_start)
+                last_start = start
+
+                executed = False
+                while pending():
+                    cmd = cmd_Q.get()
                     if cmd == CMD_EXIT or cmd == (CMD_EXIT,):
                         return 
                     self._component.parse_and_execute(cmd)
-
-
+                    if cmd_recorder is not None and not cmd_recorder.record(cmd):
+                        unrecorded.incr()
+                    if isinstance(cmd_Q, CommandChannel):
+                        cmd_Q.executed()
+                    executed = True
+                    commands.incr()
+
+                # the messages sent before the state change should not be delayed by the batching
+                if executed and isinstance(output_Q, BatchPublisher):
+                    output_Q.flush()
+
+                t_run = now_ns()
+                if executed:
+                    command_hist.record(t_run - start)
                 self._component.run()
-                self._component.send_msg(self._output_Q)
+                t_send = now_ns()
+                self._component.send_msg(output_Q)
+                if batching:
+                    # a partial batch is sent once it is too old, even if the component sends nothing more
+                    output_Q.poll()
+                run_hist.record(t_send - t_run)
+                send_hist.record(now_ns() - t_send)
+
+                loops.incr()
+                if loops.value % ContinuousComponentWrapper.DEPTH_INTERVAL == 0:
+                    output_depth.set(self._output_depth())
 
         except KeyboardInterrupt:
             if hasattr(self._component, 'KeyboardInterruptHandler'):
                 self._component.KeyboardInterruptHandler()
             print('{} property exit after KeyboardInterrupt.'.format(self._component.name))
 
+        finally:
+            if isinstance(output_Q, BatchPublisher):
+                output_Q.flush()
+            for recorder in (out_recorder, cmd_recorder):
+                if recorder is not None:
+                    recorder.close()
+
+    def _open_recorders(self):
+        # opened in the process of the component, which is the only writer
+        if self._record_dir is None:
+            return None, None
+        os.makedirs(self._record_dir, exist_ok=True)
+        component = self._component
+        meta = {'name': component.name, 'class': type(component).__name__, 'comp_id': component.comp_id,
+                'comp_name': component_name(component.comp_id), 'fields': list(component.FORMAT), 'attrs': component.describe()}
+        out_recorder = Recorder(stream_path(self._record_dir, component.name, OUTPUT), make_dtype(component.FORMAT),
+                                meta=dict(meta, kind=OUTPUT))
+        cmd_recorder = CommandRecorder(stream_path(self._record_dir, component.name, COMMANDS), meta=dict(meta, kind=COMMANDS))
+        return out_recorder, cmd_recorder
+
+
+
+    def _output_depth(self):
+        try:
+            return self._output_Q.qsize()
+        except NotImplementedError:
+            # multiprocessing.Queue.qsize is not available on macOS
+            return -1
 
+    def _sleep_then_check(self, timeout):
+        # a multiprocessing.Queue cannot be waited on without consuming the command
+        time.sleep(timeout)
+        return not self._cmd_Q.empty()
 
     @property
     def component(self):
@@ -145,25 +329,44 @@ class ContinuousComponentWrapper(mp.Process):
     def output_Q(self):
         return self._output_Q
 
+    @property
+    def metrics(self):
+        return self._metrics
+
 
 
 
 
 class DistanceRadarBaseComponent(Component):
+    KIND = 'DistanceRadarBase'
     CLOCKWISE = 0
     ANTI_CLOCKWISE = 1
-    FORMAT = ('timestamp', 'comp_name', 'pos', 'min_degree', 'max_degree')
-    def __init__(self, name=None, pins=None, initial_pos=0, min_degree=0, max_degree=180, delay=0.002, delay_factor=3, step_size=5):
+    FORMAT = ('timestamp', 'comp_id', 'pos', 'min_degree', 'max_degree')
+    COMMANDS = (
+        Command('set_delay', ('delay', 'd')),
+        Command('set_step_size', ('step_size', 'd')),
+    )
+    def __init__(self, name=None, pins=None, initial_pos=0, min_degree=0, max_degree=180, delay=0.002, delay_factor=3, step_size=5, profile=None, mode=StepperMotor.HALF_STEP):
+        """
+        Args:
+            delay:   the delay between two steps of the motor.
+            profile: a RampProfile. If it is set, the motor accelerates over each sweep between min_degree and max_degree
+                     following the profile, and delay is only used to initialize the position.
+            mode:    StepperMotor.HALF_STEP or StepperMotor.FULL_STEP.
+        """
         assert name is not None
 
-        self._stepper_motor = StepperMotor(pins,initial_pos)
+        self._stepper_motor = StepperMotor(pins,initial_pos, mode=mode)
         self._name = name
+        self._comp_id = component_id('{}::{}'.format(self.KIND, name))
         self._init_pos = initial_pos
         self._min_degree = min_degree
         self._max_degree = max_degree
         self._delay = delay
         self._delay_factor = delay_factor
         self._step_size = step_size
+        self._profile = profile
+        self._sweep_steps = self._stepper_motor.degree_to_steps(max_degree - min_degree)
         
         self._direction = self.ANTI_CLOCKWISE
 
@@ -181,29 +384,63 @@ class DistanceRadarBaseComponent(Component):
 
 
 
+    def _step_delays(self):
+        """
+        The delays of the next move. With a profile, they are the slice of the sweep profile starting at the current position.
+        """
+        if self._profile is None:
+            return self._delay
+
+        motor = self._stepper_motor
+        if self._direction == self.ANTI_CLOCKWISE:
+            start = motor.degree_to_steps(motor.pos - self._min_degree)
+        else:
+            start = motor.degree_to_steps(self._max_degree - motor.pos)
+        start = min(max(start, 0), self._sweep_steps)
+
+        n_steps = motor.degree_to_steps(self._step_size)
+        delays = self._profile.delays(self._sweep_steps)[start:start + n_steps]
+        if len(delays) < n_steps:
+            # beyond the end of the sweep
+            delays = np.r_[delays, [self._profile.start_delay] * (n_steps - len(delays))]
+        return delays
+
     def run(self):
 
         if self._direction == self.ANTI_CLOCKWISE:
-            self._stepper_motor.rotate(degree=self._step_size, clockwise=False, delay=self._delay)
+            self._stepper_motor.rotate(degree=self._step_size, clockwise=False, delay=self._step_delays())
             if self._stepper_motor.pos > self._max_degree :
                 self._direction = self.CLOCKWISE
-                time.sleep(self._delay * self._delay_factor)
+                self.idle(self._delay * self._delay_factor)
 
         else:
-            self._stepper_motor.rotate(degree=self._step_size, clockwise=True, delay=self._delay)
+            self._stepper_motor.rotate(degree=self._step_size, clockwise=True, delay=self._step_delays())
             if self._stepper_motor.pos < self._min_degree:
                 self._direction = self.ANTI_CLOCKWISE
-                time.sleep(self._delay * self._delay_factor)
+                self.idle(self._delay * self._delay_factor)
 
 
     def send_msg(self,Q):
-        msg = (time.time(), 'DistanceRadarBase::{}'.format(self._name), self._stepper_motor.pos, self.min_degree, self.max_degree)
+        # the position is stamped with the time of the step that reached it, not the time of the message
+        timestamp = self._stepper_motor.step_ns
+        if timestamp is None:
+            timestamp = now_ns()
+        msg = (timestamp, self._comp_id, self._stepper_motor.pos, self.min_degree, self.max_degree)
         Q.put(msg)
 
     def KeyboardInterruptHandler(self):
         self._stepper_motor.back_to_zero_pos(delay=self._delay)
 
     
+    def set_delay(self, delay):
+        self._delay = delay
+
+    def set_step_size(self, step_size):
+        self._step_size = step_size
+
+    def describe(self):
+        return {'min_degree': self._min_degree, 'max_degree': self._max_degree}
+
     @property
     def delay(self):
         return self._delay
@@ -219,6 +456,10 @@ class DistanceRadarBaseComponent(Component):
 #    def degree(self,val):
 #        self._degree = val
     
+    @property
+    def direction(self):
+        return self._direction
+
     @property
     def max_degree(self):
         return self._max_degree
@@ -238,12 +479,16 @@ class DistanceRadarBaseComponent(Component):
 
 
 class DistanceRadarSensorComponent(Component):
-    FORMAT = ('timestamp','comp_name','distance','status')
-    def __init__(self, name=None, pin_echo=None, pin_trig=None, unit='m', delay=0.00001):
+    FORMAT = ('timestamp','comp_id','distance','status')
+    COMMANDS = (
+        Command('set_delay', ('delay', 'd')),
+    )
+    def __init__(self, name=None, pin_echo=None, pin_trig=None, unit='m', delay=0.00001, mode=DistanceSensor.POLL, pipelined=False):
         assert name is not None
 
         self._name = name
-        self._sensor = DistanceSensor(pin_echo=pin_echo, pin_trig=pin_trig, unit=unit)
+        self._comp_id = component_id('DistanceRadarSensor::{}'.format(name))
+        self._sensor = DistanceSensor(pin_echo=pin_echo, pin_trig=pin_trig, unit=unit, mode=mode, pipelined=pipelined)
         self._measure_result = (None,DistanceSensor.INIT)
         self._delay = delay
 
@@ -252,22 +497,91 @@ class DistanceRadarSensorComponent(Component):
 
     def run(self):
         self._measure_result = self._sensor.measure()
-        time.sleep(self._delay)
+        self.idle(self._delay)
+
+    def set_delay(self, delay):
+        self._delay = delay
 
     def send_msg(self,Q):
         res = self._measure_result
-        msg = (time.time(), 'DistanceRadarSensor::{}'.format(self._name), res[0], res[1])
+        # the reading is stamped with the midpoint of the echo, see DistanceSensor.measure_ns
+        timestamp = self._sensor.measure_ns
+        if timestamp is None:
+            timestamp = now_ns()
+        msg = (timestamp, self._comp_id, res[0] if res[0] is not None else NAN, STATUS_CODES[res[1]])
         Q.put(msg)
 
 
 
+class ScanningRadarComponent(DistanceRadarBaseComponent):
+    """
+    Radar that moves the stepper motor and measures the distance in the same loop. Each run moves the radar by
+    resolution degrees and sends one ping once the motor has stopped, so each message contains the position of its
+    measure and no join with the radar base messages is needed (see controller.DistanceMap.update_scan).
+
+    It replaces the pair DistanceRadarBaseComponent and DistanceRadarSensorComponent, which run in two processes.
+    """
+    KIND = 'ScanningRadar'
+    FORMAT = ('timestamp', 'comp_id', 'pos', 'distance', 'status')
+
+    def __init__(self, name=None, pins=None, pin_echo=None, pin_trig=None, resolution=1., initial_pos=0, min_degree=0, max_degree=180,
+                 delay=0.002, delay_factor=3, profile=None, mode=StepperMotor.HALF_STEP, sensor_mode=DistanceSensor.EDGE, settle=0.):
+        """
+        Args:
+            resolution:  the angle (in degree) between two measures. It is rounded to a whole number of steps of the motor.
+            sensor_mode: DistanceSensor.POLL or DistanceSensor.EDGE.
+            settle:      the time (in second) to wait between the end of the move and the ping.
+
+            See DistanceRadarBaseComponent for the other arguments.
+        """
+        super(ScanningRadarComponent, self).__init__(name=name, pins=pins, initial_pos=initial_pos, min_degree=min_degree, max_degree=max_degree,
+                                                     delay=delay, delay_factor=delay_factor, step_size=resolution, profile=profile, mode=mode)
+        assert self._stepper_motor.degree_to_steps(resolution) > 0, 'The resolution is smaller than one step of the motor.'
+
+        self._sensor = DistanceSensor(pin_echo=pin_echo, pin_trig=pin_trig, mode=sensor_mode)
+        self._settle = settle
+        self._measure_result = (NAN, NAN, STATUS_CODES[DistanceSensor.INIT])
+
+    def run(self):
+        super(ScanningRadarComponent, self).run()
+        if self._settle > 0:
+            time.sleep(self._settle)
+        distance, status = self._sensor.measure()
+        self._measure_result = (self._stepper_motor.pos, distance if distance is not None else NAN, STATUS_CODES[status])
+
+    def send_msg(self, Q):
+        pos, distance, status = self._measure_result
+        timestamp = self._sensor.measure_ns
+        if timestamp is None:
+            timestamp = now_ns()
+        Q.put((timestamp, self._comp_id, pos, distance, status))
+
+    def KeyboardInterruptHandler(self):
+        self._sensor.close()
+        super(ScanningRadarComponent, self).KeyboardInterruptHandler()
+
+    @property
+    def resolution(self):
+        """
+        The angle (in degree) between two measures, as achieved by the motor.
+        """
+        motor = self._stepper_motor
+        return motor.degree_to_steps(self._step_size) * motor.step_angle
+
+
+
 class WheelComponent(Component):
     """
     Represent a single wheel.
     """
-    FORMAT = ('timestamp', 'comp_name', 'pulse', 'repeat')
-
-    def __init__(self, name=None, mirror=False, pin_signal=None, repeat=10, pulse=None, reference_pulse=None, max_pulse_deviation=None,width=None, power=1):
+    FORMAT = ('timestamp', 'comp_id', 'pulse', 'repeat')
+    COMMANDS = (
+        Command('set_speed', ('scale', 'd')),
+        Command('increase_speed', ('scale', 'd'), ('block', '?')),
+        Command('stop'),
+    )
+
+    def __init__(self, name=None, mirror=False, pin_signal=None, repeat=10, pulse=None, reference_pulse=None, max_pulse_deviation=None,width=None, power=1, use_pwm=False):
         """
         Args:
             name:           the name of the component.
@@ -279,9 +593,11 @@ class WheelComponent(Component):
             pin_signal:     the pin number for sending the pulse to the motor.
             pulse:          the pulse that is send to the motor. If the pulse is None,it will be set to the reference pulse of the underlying motor 
                             class, which make the motor still. The default value of pulse is None.
-            repeat:         the number pulse sent to the motor in a cycle.
+            repeat:         the number pulse sent to the motor in a cycle. A message is sent after each cycle; the commands are
+                            executed between any two pulses.
             width:          In the communication protocol, the signal consists of two parts: (1)pulse and (2)silence. The width specifies the length 
                             of the slient period. If the width is None, it will be set to the width value of the underlaying motor class.
+            use_pwm:        Bool. Generate the pulses with gpio.PWM. See WheelMotor.
 
         """
 
@@ -290,9 +606,10 @@ class WheelComponent(Component):
         assert 0 < power <= 1
 
         self._name = name
+        self._comp_id = component_id('WheelComponent::{}'.format(name))
         self._pin_signal = pin_signal
 
-        self._motor = WheelMotor(pin_signal=self._pin_signal, reference_pulse=reference_pulse, max_pulse_deviation=max_pulse_deviation)
+        self._motor = WheelMotor(pin_signal=self._pin_signal, reference_pulse=reference_pulse, max_pulse_deviation=max_pulse_deviation, use_pwm=use_pwm)
 
         self._reference_pulse = self._motor.reference_pulse
         self._max_deviation = self._motor.max_pulse_deviation
@@ -304,12 +621,31 @@ class WheelComponent(Component):
         self._repeat = repeat
         self._mirror = mirror
 
+        # the pulses sent since the last message: their length and their number
+        self._cycle_pulse = None
+        self._cycle_count = 0
+        self._cycle_done = False
+
 
     def run(self):
-        self._motor.generate_pulse(repeat=self._repeat,pulse=self._pulse, width=0.020)
+        # one period of the pulse train. A command that arrives during the silence interrupts the wait and applies to
+        # the next pulse, so it takes effect within one period (see WheelMotor.pulse_once).
+        pulse = self._pulse
+        if self._cycle_count and pulse != self._cycle_pulse:
+            # the pulse has changed: the message of the previous pulses is sent first
+            self._cycle_done = True
+            return
+        if self._motor.pulse_once(pulse=pulse, width=0.020, wait=self.idle):
+            self._cycle_pulse = pulse
+            self._cycle_count += 1
+            self._cycle_done = self._cycle_count >= self._repeat
 
     def send_msg(self,Q):
-        Q.put((time.time(), 'WheelComponent::{}'.format(self._name), self.pulse, self.repeat))
+        # one message per cycle of repeat pulses of the same length. repeat is the number of pulses actually sent.
+        if self._cycle_done:
+            Q.put((now_ns(), self._comp_id, self._cycle_pulse, self._cycle_count))
+            self._cycle_count = 0
+            self._cycle_done = False
 
     @property
     def pulse(self):
@@ -337,6 +673,10 @@ class WheelComponent(Component):
     def mirror(self):
         return self._mirror
 
+    @property
+    def motor(self):
+        return self._motor
+
     def set_speed(self, scale):
         increment = scale * self._max_deviation
         if self._mirror:
@@ -390,6 +730,114 @@ class WheelComponent(Component):
 
 
 
+class DifferentialDriveComponent(Component):
+    """
+    The two wheels of the robot, driven by one process. The pulse trains of both wheels are generated by the same
+    timing loop (see DifferentialDriveMotor) and a command sets both wheels at once, so they change speed in the same
+    period.
+
+    The commands take the speed of both wheels, as scales (see WheelComponent.set_speed) or as the linear and angular
+    speeds of the robot.
+    """
+    FORMAT = ('timestamp', 'comp_id', 'left_pulse', 'right_pulse', 'repeat')
+    COMMANDS = (
+        Command('set_speed', ('left_scale', 'd'), ('right_scale', 'd')),
+        Command('increase_speed', ('left_scale', 'd'), ('right_scale', 'd'), ('block', '?')),
+        Command('drive', ('v', 'd'), ('omega', 'd')),
+        Command('stop'),
+    )
+
+    def __init__(self, name=None, left_wheel=None, right_wheel=None, repeat=10, max_wheel_speed=0.2, track_width=0.15):
+        """
+        Args:
+            name:            the name of the component.
+            left_wheel:      WheelComponent of the left wheel. It is only used for its settings and its motor, it is not
+                             wrapped in a process.
+            right_wheel:     WheelComponent of the right wheel.
+            repeat:          the number of pulses sent to each motor in a cycle.
+            max_wheel_speed: the speed (in m/s) of a wheel at scale 1. It is used by drive.
+            track_width:     the distance (in meter) between the wheels. It is used by drive.
+        """
+        assert name is not None
+        assert isinstance(left_wheel, WheelComponent) and isinstance(right_wheel, WheelComponent)
+        assert max_wheel_speed > 0 and track_width > 0
+
+        self._name = name
+        self._comp_id = component_id('DifferentialDriveComponent::{}'.format(name))
+        self._left = left_wheel
+        self._right = right_wheel
+        self._motor = DifferentialDriveMotor(left=left_wheel.motor, right=right_wheel.motor)
+        self._repeat = repeat
+        self._max_wheel_speed = max_wheel_speed
+        self._track_width = track_width
+
+        # see WheelComponent.run
+        self._cycle_pulses = None
+        self._cycle_count = 0
+        self._cycle_done = False
+
+    def run(self):
+        # one period of the pulse trains, see WheelComponent.run
+        pulses = (self._left.pulse, self._right.pulse)
+        if self._cycle_count and pulses != self._cycle_pulses:
+            self._cycle_done = True
+            return
+        if self._motor.pulse_once(left_pulse=pulses[0], right_pulse=pulses[1], width=0.020, wait=self.idle):
+            self._cycle_pulses = pulses
+            self._cycle_count += 1
+            self._cycle_done = self._cycle_count >= self._repeat
+
+    def send_msg(self, Q):
+        if self._cycle_done:
+            Q.put((now_ns(), self._comp_id, self._cycle_pulses[0], self._cycle_pulses[1], self._cycle_count))
+            self._cycle_count = 0
+            self._cycle_done = False
+
+    def describe(self):
+        return {'max_wheel_speed': self._max_wheel_speed, 'track_width': self._track_width}
+
+    def set_speed(self, left_scale, right_scale):
+        self._left.set_speed(max(-1., min(1., left_scale)))
+        self._right.set_speed(max(-1., min(1., right_scale)))
+
+    def increase_speed(self, left_scale, right_scale, block=False):
+        self._left.increase_speed(left_scale, block)
+        self._right.increase_speed(right_scale, block)
+
+    def drive(self, v, omega):
+        """
+        Move at the linear speed v (in m/s, positive forward) and the angular speed omega (in rad/s, positive
+        anti-clockwise).
+        """
+        half_turn = 0.5 * omega * self._track_width
+        self.set_speed((v - half_turn) / self._max_wheel_speed, (v + half_turn) / self._max_wheel_speed)
+
+    def stop(self):
+        self._left.stop()
+        self._right.stop()
+
+    @property
+    def left_wheel(self):
+        return self._left
+
+    @property
+    def right_wheel(self):
+        return self._right
+
+    @property
+    def repeat(self):
+        return self._repeat
+
+    @property
+    def max_wheel_speed(self):
+        return self._max_wheel_speed
+
+    @property
+    def track_width(self):
+        return self._track_width
+
+
+
 
 
 
@@ -1,6 +1,14 @@
 import pandas as pd 
 import numpy as np
 import time
+from collections import deque
+
+from clock import now_ns, to_ns, to_seconds
+from metrics import Metrics
+from recorder import ReplayedComponent
+from records import RingBuffer, make_dtype, to_array
+from transport import drain
+
 class Status:
     def __init__(self,*args, **kwargs):
 
@@ -56,160 +64,747 @@ class Status:
 
 
 class RawDataHandler:
-    def __init__(self, name=None, parser=None, record_size=100):
+    """
+    Keep the latest messages of a component.
+
+    Args of __init__:
+        name:        the name of the data handler.
+        parser:      tuple of field names of the messages, usually the FORMAT attribute of the component.
+        record_size: the maximum number of messages kept by the handler.
+        dtypes:      dict. Overrides the default dtype of some fields. See records.make_dtype.
+        retention:   in second. If it is set, only the messages of the last retention seconds are returned by records
+                     and data, e.g. 1.5 for the last 1.5 s. The messages need a timestamp field.
+        clock:       callable that returns the current time, e.g. clock.now_ns. The retention window ends at the current
+                     time, so the messages of a component that stopped sending expire. None: the window ends at the
+                     newest message, for the replays whose timestamps are in the past.
+
+    Note:
+        The messages are stored in a preallocated ring buffer, so update and extend do not allocate once the buffer
+        is full. The DataFrame returned by data is cached and rebuilt only when new messages have arrived or old ones have
+        expired. It is shared between the callers and should not be modified in place.
+
+        record_size still bounds the number of messages: it should be larger than the number of messages sent in
+        retention seconds.
+    """
+    def __init__(self, name=None, parser=None, record_size=100, dtypes=None, retention=None, clock=None):
         assert name is not None and parser is not None
+        assert retention is None or (retention > 0 and 'timestamp' in parser)
         self._name = name
-        self._records     = []
+        self._records     = RingBuffer(parser, capacity=record_size, dtypes=dtypes)
         self._record_size = record_size
+        self._retention_ns = to_ns(retention) if retention is not None else None
+        self._clock = clock
         self._columns = parser
+        self._df = None
 
     def update(self, msg):
-        if len(self._records) == self._record_size:
-            self._records.pop(0)
+        self._records.append(msg)
+        self._df = None
 
-        # parse the msg
-        self._records.append(list(msg))
-    
+    def extend(self, msgs):
+        """
+        Add a batch of messages, e.g. all the messages drained from a queue.
+        """
+        if len(msgs) == 0:
+            return
+        self._records.extend(msgs)
+        self._df = None
+
+    @property
+    def dtype(self):
+        return self._records.dtype
+
+    @property
+    def records(self):
+        """
+        The stored messages as a structured array in arrival order, limited to the retention window if any. It is a
+        view on the ring buffer and is only valid until the next update.
+        """
+        view = self._records.view
+        if self._retention_ns is None or len(view) == 0:
+            return view
+        # the timestamps of a component increase, so the window starts at a binary search
+        timestamps = view['timestamp']
+        end = self._clock() if self._clock is not None else timestamps[-1]
+        return view[np.searchsorted(timestamps, end - self._retention_ns):]
+
+    @property
+    def retention(self):
+        return to_seconds(self._retention_ns) if self._retention_ns is not None else None
 
     @property
     def data(self):
-        df = pd.DataFrame(self._records, columns=self._columns)
-        df['DataHandlerName'] = self._name
-        return df
+        records = self.records
+        # with a clock, the window also shrinks when messages expire
+        if self._df is None or len(self._df) != len(records):
+            df = pd.DataFrame(records)
+            df['DataHandlerName'] = self._name
+            self._df = df
+        return self._df
 
 
 
 
-T_FACTOR = 100
 CN_DISTANCE = 'distance'
 CN_STATUS = 'status'
 CN_POS = 'pos'
 
+# the position of the radar is not interpolated over a gap longer than MAX_GAP seconds between two radar messages
+MAX_GAP = 0.1
 
+# see DistanceMap.last_readings
+NO_READINGS = (np.empty(0), np.empty(0))
 
-def format_timestamp(ts,factor=T_FACTOR):
-    return (ts * factor).astype(np.int64)
+# the ways to shed the stale messages, see shed_stale
+SHED_DROP = 'drop'
+SHED_LATEST = 'latest'
 
-def create_distance_map(df_radar_base, df_distance_sensor):
+
+
+def _sort_by_key(keys, values):
+    # the streams are almost always sorted already, only pay for the sort when they are not.
+    if keys.size > 1 and np.any(keys[1:] < keys[:-1]):
+        order = np.argsort(keys, kind='stable')
+        return keys[order], values[order]
+    return keys, values
+
+
+def align_positions(base_ts, base_pos, sample_ts, max_gap=MAX_GAP):
     """
-    Create the distance map. The map represents the environment in front of the robot. It is the association between position of
-    radar (in degree) and the distance detected in that position.
+    The position of the radar at the time of each sample. It is the linear interpolation between the radar message
+    before the sample and the radar message after it (a backward and a forward merge_asof followed by an interpolation).
 
     Args:
-        df_radar_base:      data sent from distance radar component.
-        df_distance_sensor: data sent from the distance radar sensor component.
+        base_ts:   timestamps (clock.now_ns) of the radar base messages, sorted.
+        base_pos:  positions (in degree) of the radar base messages.
+        sample_ts: timestamps (clock.now_ns) of the samples, e.g. the echo midpoints of the distance readings.
+        max_gap:   in second. The samples between two radar messages more than max_gap apart are not aligned.
 
     Return:
-        A pd.Series. The index is the position of the radar base and the value is the distance deteced. 
-
-    Note:
-        The map is discrete. The value of index in the retured Series is integer.
+        An array of positions. NaN for the samples that cannot be aligned: before the first radar message, after the
+        last one, or in a gap.
     """
+    base_ts   = np.asarray(base_ts, dtype=np.int64)
+    base_pos  = np.asarray(base_pos, dtype=np.float64)
+    sample_ts = np.asarray(sample_ts, dtype=np.int64)
 
+    if base_ts.size == 0:
+        return np.full(sample_ts.shape, np.nan)
 
+    # relative to the first radar message, so the nanoseconds are exact in float64
+    origin = base_ts[0]
+    pos = np.interp((sample_ts - origin).astype(np.float64), (base_ts - origin).astype(np.float64), base_pos,
+                    left=np.nan, right=np.nan)
 
-    df_sensor = df_distance_sensor
-    df_base = df_radar_base
+    after  = np.minimum(np.searchsorted(base_ts, sample_ts, side='right'), base_ts.size - 1)
+    before = np.maximum(after - 1, 0)
+    pos[base_ts[after] - base_ts[before] > to_ns(max_gap)] = np.nan
+    return pos
 
-    df_sensor['timestamp'] = format_timestamp(df_sensor['timestamp'])
-    df_base['timestamp']   = format_timestamp(df_base['timestamp'])
-#    print('+++++ sensor_min: {}, sensor_max: {}, base_min: {}, base_max: {}'.format(
-#            df_sensor['timestamp'].min(), df_sensor['timestamp'].max(),
-#            df_base['timestamp'].min(), df_base['timestamp'].max()))
 
-    df = pd.merge(df_sensor, df_base, on='timestamp', how='outer', suffixes=('_sensor','_base')).sort_values('timestamp')
-    
-    # smooth the distance.
-#    window = int(df.shape[0] / df['pos'].notnull().sum())
-#    df['avg_distance'] = df['distance'].rolling(window=window, min_periods=1).mean()
-#    df['distance'] = df['distance'].combine_first(df['avg_distance'])
-#    df = df.drop('avg_distance', axis=1)
+def _latest_per_bin(bins, keys):
+    """
+    Return the unique bins and, for each of them, the index of the sample with the latest key.
+    """
+    if bins.size == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    order = np.lexsort((keys, bins))
+    unique_bins, first = np.unique(bins[order], return_index=True)
+    return unique_bins, order[np.r_[first[1:], bins.size] - 1]
 
-    # clean the data
-    df['distance'] = df['distance'].fillna(method='ffill')
-    df['status']   = df['status'].fillna(method='ffill')
-    df['pos']      = df['pos'].fillna(method='ffill')
 
-    df_work = df[(df['pos'].notnull()) & (df['distance'].notnull())]
+def compute_distance_map(base_ts, base_pos, sensor_ts, sensor_distance, max_gap=MAX_GAP):
+    """
+    NumPy engine of create_distance_map. It works on plain arrays and does not allocate any DataFrame.
 
-    # select useful information
-    df_work = df_work[['pos','timestamp','distance', 'status']]
+    Each distance reading is attributed to the position of the radar interpolated at its timestamp (see align_positions).
+    The failed readings (NaN) and the readings that cannot be aligned are dropped. For each position bin, the latest
+    reading is kept.
 
+    Args:
+        base_ts:         timestamps (clock.now_ns) of the radar base messages.
+        base_pos:        positions (in degree) of the radar base messages.
+        sensor_ts:       timestamps (clock.now_ns) of the distance sensor messages.
+        sensor_distance: distances of the distance sensor messages. None or NaN for failed readings.
+        max_gap:         see align_positions.
 
+    Return:
+        A tuple (bins, distances) of arrays. bins is sorted and contains the positions rounded to the nearest degree.
+    """
+    base_ts, base_pos = _sort_by_key(np.asarray(base_ts, dtype=np.int64), np.asarray(base_pos, dtype=np.float64))
+    sensor_ts = np.asarray(sensor_ts, dtype=np.int64)
+    distances = np.asarray(sensor_distance, dtype=np.float64)
 
-    # create the distance map
-    df_work['pos_bin'] = df_work['pos'].astype(int)
-    df_work = df_work.groupby(by=['pos_bin','timestamp'], as_index=False)['distance'].mean()
-    df_work = df_work.sort_values(['pos_bin','timestamp'])
+    pos = align_positions(base_ts, base_pos, sensor_ts, max_gap)
+    valid = ~np.isnan(pos) & ~np.isnan(distances)
+    bins = np.rint(pos[valid]).astype(np.int64)
+    if bins.size == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
 
-#    ts_distance_map = df_work.groupby(by='pos_bin')['distance'].mean().sort_index()
-#    ts_distance_map = df_work.groupby(by='pos_bin')['distance'].agg(lambda x: x.values[-1])
-    ts_distance_map = df_work.groupby(by='pos_bin').apply(lambda x: x.loc[ (x['timestamp'] == x['timestamp'].max()), 'distance'].mean())
+    unique_bins, last = _latest_per_bin(bins, sensor_ts[valid])
+    return unique_bins, distances[valid][last]
 
-    return ts_distance_map
 
+def create_distance_map(df_radar_base, df_distance_sensor):
+    """
+    Create the distance map. The map represents the environment in front of the robot. It is the association between position of
+    radar (in degree) and the distance detected in that position.
 
+    Args:
+        df_radar_base:      data sent from distance radar component. A DataFrame or a structured array.
+        df_distance_sensor: data sent from the distance radar sensor component. A DataFrame or a structured array.
 
+    Return:
+        A pd.Series. The index is the position of the radar base and the value is the distance deteced. 
 
+    Note:
+        The map is discrete. The value of index in the retured Series is integer.
+        The computation is done by compute_distance_map. The inputs are not modified.
+    """
+    bins, distances = compute_distance_map(df_radar_base['timestamp'], df_radar_base[CN_POS],
+                                           df_distance_sensor['timestamp'], df_distance_sensor[CN_DISTANCE])
 
-def retrieve_data(Q, data_handler):
-    while not Q.empty():
-        msg = Q.get()
-        data_handler.update(msg)
+    return pd.Series(distances, index=pd.Index(bins, name='pos_bin'))
 
 
 
 
-class Controller:
 
-    def __init__(self, radar_base=None, radar_distance_sensor=None, engine=None):
-        assert isinstance(radar_base, ContinuousComponentWrapper)
-        assert isinstance(radar_distance_sensor, ContinuousComponentWrapper)
-        assert isinstance(engine, Engine)
+class DistanceMap:
+    """
+    Incremental version of create_distance_map. The map is updated from the newly received messages only, so the cost
+    of an update depends on the number of new messages and not on the size of the history.
+
+    For each position bin, the map keeps the latest distance, its timestamp and the number of readings that were
+    attributed to the bin.
+
+    Args of __init__:
+        min_degree:    the smallest position bin of the map.
+        max_degree:    the largest position bin of the map. The readings outside [min_degree, max_degree] are ignored.
+        base_format:   FORMAT of the radar base messages. Only needed when messages are passed as tuples.
+        sensor_format: FORMAT of the distance sensor messages. Only needed when messages are passed as tuples.
+        scan_format:   FORMAT of the messages of a ScanningRadarComponent, for update_scan. Only needed when messages
+                       are passed as tuples.
+        max_gap:       see align_positions.
+        max_delay:     in second. The radar messages of the last max_delay seconds are kept to align the readings that
+                       arrive late, e.g. because the sensor messages are batched.
+        max_pending:   the maximum number of readings kept while waiting for the next radar message.
 
-        self._radar_base = radar_base
-        self._radar_distance_sensor = radar_distance_sensor
-        self._engine = engine
+    Note:
+        A reading can only be aligned once a radar message after it has been received. The readings newer than the
+        last radar message are kept and aligned by a later update. The readings of a ScanningRadarComponent already
+        contain their position and are added directly by update_scan.
+    """
+    def __init__(self, min_degree=-180, max_degree=180, base_format=None, sensor_format=None, scan_format=None, max_gap=MAX_GAP,
+                 max_delay=0.5, max_pending=1024):
+        assert min_degree <= max_degree
+
+        self._min_degree = int(min_degree)
+        self._max_degree = int(max_degree)
+        self._max_gap = max_gap
+        self._max_delay = max_delay
+        self._max_pending = max_pending
+        self._base_dtype   = make_dtype(base_format) if base_format is not None else None
+        self._sensor_dtype = make_dtype(sensor_format) if sensor_format is not None else None
+        self._scan_dtype   = make_dtype(scan_format) if scan_format is not None else None
+
+        n_bins = self._max_degree - self._min_degree + 1
+        self._distance  = np.full(n_bins, np.nan)
+        self._timestamp = np.full(n_bins, -1, dtype=np.int64)
+        self._count     = np.zeros(n_bins, dtype=np.int64)
+
+        self._init_context()
+        self._last_readings = NO_READINGS
+
+    def _init_context(self):
+        # the recent radar messages, and the valid readings that are not aligned yet
+        self._base_ts  = np.empty(0, dtype=np.int64)
+        self._base_pos = np.empty(0, dtype=np.float64)
+        self._pending_ts = np.empty(0, dtype=np.int64)
+        self._pending_distance = np.empty(0, dtype=np.float64)
+
+    def _as_records(self, msgs, dtype):
+        if msgs is None:
+            return None
+        if isinstance(msgs, (list, tuple)):
+            if len(msgs) == 0:
+                return None
+            assert dtype is not None, 'The FORMAT is needed to parse the messages.'
+            return to_array(msgs, dtype)
+        return msgs
+
+    def update(self, base_msgs=None, sensor_msgs=None):
+        """
+        Update the map with new messages. The messages are a list of tuples, a structured array or a DataFrame.
+        """
+        base_msgs   = self._as_records(base_msgs, self._base_dtype)
+        sensor_msgs = self._as_records(sensor_msgs, self._sensor_dtype)
 
-        self._components = ['radar_base','radar_distance_sensor','engine']
+        empty = np.empty(0)
+        self.ingest(base_msgs['timestamp'] if base_msgs is not None else empty,
+                    base_msgs[CN_POS] if base_msgs is not None else empty,
+                    sensor_msgs['timestamp'] if sensor_msgs is not None else empty,
+                    sensor_msgs[CN_DISTANCE] if sensor_msgs is not None else empty)
 
-        self._comp_output_Q = {}
-        self._comp_output_Q['radar_base'] = self._radar_base.output_Q
-        self._comp_output_Q['radar_distance_sensor'] = selef._radar_distance_sensor.output_Q
+    def ingest(self, base_ts, base_pos, sensor_ts, sensor_distance):
+        """
+        Update the map with new samples given as arrays.
+        """
+        self._last_readings = NO_READINGS
+        kb, pos = _sort_by_key(np.asarray(base_ts, dtype=np.int64), np.asarray(base_pos, dtype=np.float64))
+        ks = np.asarray(sensor_ts, dtype=np.int64)
+        d  = np.asarray(sensor_distance, dtype=np.float64)
+
+        # the failed readings are dropped here, so they are never kept as pending
+        valid = ~np.isnan(d)
+        ks = np.concatenate((self._pending_ts, ks[valid]))
+        d  = np.concatenate((self._pending_distance, d[valid]))
+
+        # the previous radar messages give the position before the new messages. The messages already seen are ignored.
+        if self._base_ts.size:
+            newer = kb > self._base_ts[-1]
+            kb, pos = kb[newer], pos[newer]
+        kb  = np.concatenate((self._base_ts, kb))
+        pos = np.concatenate((self._base_pos, pos))
+        if kb.size:
+            keep = min(np.searchsorted(kb, kb[-1] - to_ns(self._max_delay)), kb.size - 1)
+            self._base_ts, self._base_pos = kb[keep:], pos[keep:]
+
+        # the readings after the last radar message wait for the next one
+        waiting = ks > kb[-1] if kb.size else np.ones(ks.size, dtype=bool)
+        self._pending_ts = ks[waiting][-self._max_pending:]
+        self._pending_distance = d[waiting][-self._max_pending:]
+        ks, d = ks[~waiting], d[~waiting]
+        if ks.size == 0:
+            return
+
+        self._accumulate(align_positions(kb, pos, ks, self._max_gap), ks, d)
+
+    def update_scan(self, scan_msgs=None):
+        """
+        Update the map with the messages of a ScanningRadarComponent. The messages are a list of tuples, a structured
+        array or a DataFrame.
+        """
+        scan_msgs = self._as_records(scan_msgs, self._scan_dtype)
+        if scan_msgs is None or len(scan_msgs) == 0:
+            self._last_readings = NO_READINGS
+            return
+        self.ingest_scan(scan_msgs['timestamp'], scan_msgs[CN_POS], scan_msgs[CN_DISTANCE])
 
-        self._data_handler = {}
-        self._data_handler['radar_base'] = RawDataHandler(name=self._radar_base.name, parser=self._radar_base.FORMAT, record_size=500)
-        self._data_handler['radar_distance_sensor'] = RawDataHandler(name=self._radar_distance_sensor.name,parser=self._radar_distance_sensor.FORMAT, record_size=500)
+    def ingest_scan(self, ts, pos, distance):
+        """
+        Update the map with readings whose position is known, given as arrays.
+        """
+        self._accumulate(np.asarray(pos, dtype=np.float64), np.asarray(ts, dtype=np.int64), np.asarray(distance, dtype=np.float64))
+
+    def _accumulate(self, pos, ks, d):
+        # add the readings d taken at the positions pos and the times ks. The readings without position or distance are ignored.
+        ok = ~np.isnan(pos) & ~np.isnan(d)
+        bins = np.rint(pos[ok]).astype(np.int64) - self._min_degree
+        pos, ks, d = pos[ok], ks[ok], d[ok]
+        inside = (bins >= 0) & (bins < self._count.size)
+        bins, ks, d = bins[inside], ks[inside], d[inside]
+        self._last_readings = (pos[inside], d)
+        if bins.size == 0:
+            return
+
+        self._count += np.bincount(bins, minlength=self._count.size)
+
+        unique_bins, last = _latest_per_bin(bins, ks)
+        newer = ks[last] >= self._timestamp[unique_bins]
+        unique_bins, last = unique_bins[newer], last[newer]
+        self._timestamp[unique_bins] = ks[last]
+        self._distance[unique_bins]  = d[last]
+
+    def reset(self):
+        self._distance[:] = np.nan
+        self._timestamp[:] = -1
+        self._count[:] = 0
+        self._init_context()
 
-                                
+    @property
+    def bins(self):
+        return np.arange(self._min_degree, self._max_degree + 1)
 
+    @property
+    def distance(self):
+        """
+        The latest distance of each bin. NaN if nothing has been observed in the bin.
+        """
+        return self._distance
 
+    @property
+    def timestamp(self):
+        """
+        The timestamp (clock.now_ns, in second) of the latest distance of each bin. NaN if nothing has been observed in the bin.
+        """
+        return np.where(self._timestamp >= 0, to_seconds(self._timestamp), np.nan)
+
+    @property
+    def count(self):
+        return self._count
 
-    def run(self):
+    @property
+    def last_readings(self):
         """
-        The controller will analyze the data received from different components, make decisions to adjustment the status of
-        the robot and send back commands to each component.
+        The (positions, distances) of the readings added to the map by the last update.
         """
-        
+        return self._last_readings
 
+    @property
+    def pending(self):
+        """
+        The number of readings waiting for the next radar message.
+        """
+        return self._pending_ts.size
 
-        while True:
+    @property
+    def series(self):
+        """
+        The current map, in the format returned by create_distance_map.
+        """
+        observed = self._timestamp >= 0
+        return pd.Series(self._distance[observed], index=pd.Index(self.bins[observed], name='pos_bin'))
 
 
-            # retrieve data from different component
-            for item in self._components:
-                retrieve_data(self._comp_output_Q[item], self._data_handler[item])
 
 
-            # craete the distance map
-            ts_distance_map = create_distance_map(df_radar_base, df_radar_distance_sensor)
 
+def shed_stale(msgs, now, max_age, mode=SHED_DROP):
+    """
+    Remove the stale messages of a batch: the messages older than max_age seconds at the time now. They pile up when the
+    reader falls behind or when the producer or the transport stalls, and the map should not spend its time on them.
 
+    Args:
+        msgs:    structured array of messages with a timestamp field, in arrival order.
+        now:     the current time (clock.now_ns).
+        max_age: in second. The staleness bound.
+        mode:    SHED_DROP discards the stale messages. SHED_LATEST summarizes them: the newest stale message of each
+                 position (degree of the pos field) is kept, since the distance map only keeps the latest reading of a
+                 position. The stale messages without position are discarded.
+
+    Return:
+        The kept messages, in arrival order, and the number of messages removed.
+    """
+    assert mode in (SHED_DROP, SHED_LATEST)
+    if len(msgs) == 0:
+        return msgs, 0
+    timestamps = msgs['timestamp']
+    stale = timestamps < now - to_ns(max_age)
+    if not stale.any():
+        return msgs, 0
+
+    keep = np.flatnonzero(~stale)
+    if mode == SHED_LATEST and CN_POS in msgs.dtype.names:
+        old = np.flatnonzero(stale)
+        old = old[~np.isnan(msgs[CN_POS][old])]
+        if old.size:
+            _, last = _latest_per_bin(np.rint(msgs[CN_POS][old]).astype(np.int64), timestamps[old])
+            keep = np.sort(np.concatenate((old[last], keep)))
+    return msgs[keep], len(msgs) - keep.size
 
-            # analyze
 
+def retrieve_data(Q, data_handler):
+    """
+    Move the messages available in the queue to the data handler. The messages are returned as a structured array.
+    """
+    msgs = drain(Q, data_handler.dtype)
+    data_handler.extend(msgs)
+    return msgs
 
 
 
 
+class Controller:
+    """
+    Closed loop of the robot. The controller runs at a fixed rate and each tick executes the stages:
+        ingest:   move the new messages of the radar to the data handlers.
+        map:      update the distance map with the new messages.
+        decision: call the policy, which decides the commands of the engine.
+        commands: send the decided and the submitted commands to the engine.
+
+    Args of __init__:
+        radar:                 ContinuousComponentWrapper of a ScanningRadarComponent, or its recorder.ReplayedComponent.
+        radar_base:            ContinuousComponentWrapper of a DistanceRadarBaseComponent. It is used with radar_distance_sensor
+                               instead of radar.
+        radar_distance_sensor: ContinuousComponentWrapper of a DistanceRadarSensorComponent.
+        engine:                an Engine. If it has an odometry, the ingest stage also updates the pose of the robot (and of
+                               the occupancy grid) from the messages of the wheels.
+        policy:                callable. policy(controller) returns a list of engine commands (method_name, args, kwargs) or None.
+        rate:                  the number of ticks per second.
+        optional:              the stages that can be skipped when the tick is running late.
+        record_size:           the number of messages kept by the data handlers.
+        retention:             in second. The time window of the data handlers, see RawDataHandler. It ends at the current
+                               time, or at the newest message for a replayed component.
+        max_sample_age:        in second. If it is set, the radar messages older than this at ingestion are shed by the
+                               ingest stage before they reach the map, see shed_stale. The numbers of messages shed are
+                               counted in metrics (shed::). It is meant for the live components: the timestamps of a
+                               replayed recording are in the past.
+        shed:                  SHED_DROP or SHED_LATEST, how the stale messages are shed.
+        occupancy_grid:        an occupancy_grid.OccupancyGrid. If it is set, the map stage also adds the new readings to the grid.
+        scan_match:            bool. If it is set (with an engine that has an odometry and an occupancy_grid), the map stage
+                               corrects the pose of the odometry: the obstacles of the last readings are matched against
+                               the grid every SCAN_MATCH_POINTS readings (OccupancyGrid.match) and the pose found is
+                               passed to Odometry.observe_pose. The matches and the corrections are counted in metrics.
 
+    Note:
+        The ticks are scheduled against absolute deadlines (clock.now_ns), so the rate does not drift. A tick that ends after
+        its deadline is an overrun. An optional stage is skipped when the time left in the tick is shorter than its usual
+        duration; the messages of a skipped map stage are kept for the next tick. When the loop falls more than one period
+        behind, the missed ticks are dropped instead of being run back to back.
+
+        The durations of the stages and the age of the radar messages at ingestion (now - timestamp, in ns) are also
+        recorded in metrics, see the metrics property. The ages include the shed messages.
+    """
+    STAGES = ('ingest', 'map', 'decision', 'commands')
+
+    # weight of the last duration in the estimate of the duration of a stage
+    ESTIMATE_WEIGHT = 0.1
+
+    # the number of obstacles seen by the radar that are matched against the occupancy grid at once
+    SCAN_MATCH_POINTS = 40
+
+    def __init__(self, radar=None, radar_base=None, radar_distance_sensor=None, engine=None, policy=None, rate=50., optional=('decision',), record_size=500,
+                 occupancy_grid=None, retention=None, max_sample_age=None, shed=SHED_DROP, scan_match=False):
+        # imported here because components imports this module
+        from components import ContinuousComponentWrapper
+        from engine import Engine
+
+        # the recorded components can be replayed in place of the running ones
+        sources = (ContinuousComponentWrapper, ReplayedComponent)
+        if radar is not None:
+            assert isinstance(radar, sources)
+            self._radars = {'radar': radar}
+        else:
+            assert isinstance(radar_base, sources)
+            assert isinstance(radar_distance_sensor, sources)
+            self._radars = {'radar_base': radar_base, 'radar_distance_sensor': radar_distance_sensor}
+        assert engine is None or isinstance(engine, Engine)
+        assert rate > 0
+        assert all(stage in Controller.STAGES for stage in optional)
+        assert max_sample_age is None or max_sample_age > 0
+        assert shed in (SHED_DROP, SHED_LATEST)
+
+        self._engine = engine
+        self._policy = policy
+        self._occupancy_grid = occupancy_grid
+        self._scan_match = scan_match and occupancy_grid is not None and engine is not None and engine.odometry is not None
+        # the obstacles (x, y) seen since the last scan matching, from the pose of the odometry at their tick
+        self._scan_points = []
+        self._period_ns = to_ns(1. / rate)
+        self._optional = tuple(optional)
+        self._max_sample_age = max_sample_age
+        self._shed = shed
+
+        self._data_handler = {}
+        for key, comp in self._radars.items():
+            # the retention of the live components ends now, the one of a replay at its newest message
+            clock = None if isinstance(comp, ReplayedComponent) else now_ns
+            self._data_handler[key] = RawDataHandler(name=comp.name, parser=comp.FORMAT, record_size=record_size, retention=retention,
+                                                     clock=clock)
+
+        if radar is not None:
+            self._distance_map = DistanceMap(min_degree=radar.min_degree, max_degree=radar.max_degree, scan_format=radar.FORMAT)
+        else:
+            self._distance_map = DistanceMap(min_degree=radar_base.min_degree, max_degree=radar_base.max_degree,
+                                             base_format=radar_base.FORMAT, sensor_format=radar_distance_sensor.FORMAT)
+
+        # messages not added to the map yet, and commands not sent yet. deque.append and popleft are thread safe.
+        self._unmapped = {key: [] for key in self._radars}
+        self._pending_commands = deque()
+
+        ages = tuple('sample_age::{}'.format(key) for key in self._radars)
+        shed_counters = tuple('shed::{}'.format(key) for key in self._radars)
+        self._metrics = Metrics('controller', counters=('ticks', 'overruns', 'missed', 'scan_matches', 'corrections') + shed_counters, gauges=ages,
+                                histograms=Controller.STAGES + ages)
+        self._ticks = self._metrics.counter('ticks')
+        self._overruns = self._metrics.counter('overruns')
+        self._missed = self._metrics.counter('missed')
+
+        self._running = False
+        self.reset_stats()
+
+    def reset_stats(self):
+        self._metrics.reset()
+        self._stage_stats = {}
+        for stage in Controller.STAGES:
+            self._stage_stats[stage] = {'count': 0, 'total': 0, 'max': 0, 'last': 0, 'estimate': 0., 'skipped': 0}
+
+    def submit(self, cmd):
+        """
+        Queue an engine command (method_name, args, kwargs). It is sent by the commands stage of the next tick. It can be
+        called from another thread, e.g. a keyboard handler.
+        """
+        self._pending_commands.append(cmd)
+
+    def _ingest(self):
+        for key, comp in self._radars.items():
+            msgs = retrieve_data(comp.output_Q, self._data_handler[key])
+            if len(msgs):
+                # the age of every message is recorded, the gauge is the age of the newest one
+                now = now_ns()
+                name = 'sample_age::{}'.format(key)
+                ages = now - msgs['timestamp']
+                self._metrics.histogram(name).record_many(ages)
+                self._metrics.gauge(name).set(int(ages[-1]))
+
+                if self._max_sample_age is not None:
+                    msgs, shed = shed_stale(msgs, now, self._max_sample_age, self._shed)
+                    if shed:
+                        self._metrics.counter('shed::{}'.format(key)).incr(shed)
+                if len(msgs):
+                    self._unmapped[key].append(msgs)
+
+        # the pose of the robot, from the messages of the wheels
+        odometry = self._engine.odometry if self._engine is not None else None
+        if odometry is not None:
+            self._engine.update_motor_stats()
+            odometry.compute_current_param()
+            odometry.rotate()
+            if self._occupancy_grid is not None:
+                self._occupancy_grid.move_to(*odometry.pose)
+
+    def _map(self):
+        readings = []
+        if 'radar' in self._unmapped:
+            for msgs in self._unmapped['radar']:
+                self._distance_map.update_scan(msgs)
+                readings.append(self._distance_map.last_readings)
+        else:
+            # the radar messages first, so the readings of the same ticks can be aligned
+            for msgs in self._unmapped['radar_base']:
+                self._distance_map.update(base_msgs=msgs)
+                readings.append(self._distance_map.last_readings)
+            for msgs in self._unmapped['radar_distance_sensor']:
+                self._distance_map.update(sensor_msgs=msgs)
+                readings.append(self._distance_map.last_readings)
+        for batches in self._unmapped.values():
+            del batches[:]
+
+        # all the readings of the tick are added to the grid at once, after the pose is corrected with them
+        if self._occupancy_grid is not None and readings:
+            pos, d = np.concatenate([pos for pos, _ in readings]), np.concatenate([d for _, d in readings])
+            if self._scan_match:
+                self._correct_pose(pos, d)
+            self._occupancy_grid.update(pos, d)
+
+    def _correct_pose(self, pos, d):
+        # the obstacles are kept in world coordinates, so the readings of several ticks can be matched together
+        odometry = self._engine.odometry
+        grid = self._occupancy_grid
+        hit = ~np.isnan(d) & (d > 0) & (d < grid.max_range)
+        x, y, heading = odometry.pose
+        angles = np.deg2rad(heading + pos[hit])
+        self._scan_points.append(np.column_stack((x + d[hit] * np.cos(angles), y + d[hit] * np.sin(angles))))
+        if sum(len(points) for points in self._scan_points) < Controller.SCAN_MATCH_POINTS:
+            return
+
+        points = np.concatenate(self._scan_points)
+        del self._scan_points[:]
+        self._metrics.counter('scan_matches').incr()
+        match = grid.match(points, odometry.pose)
+        if match is not None and odometry.observe_pose(match[0]):
+            self._metrics.counter('corrections').incr()
+            grid.move_to(*odometry.pose)
+
+    def _decision(self):
+        if self._policy is None:
+            return
+        cmds = self._policy(self)
+        if cmds:
+            self._pending_commands.extend(cmds)
+
+    def _commands(self):
+        while self._pending_commands:
+            func_name, args, kwargs = self._pending_commands.popleft()
+            if self._engine is not None:
+                getattr(self._engine, func_name)(*args, **kwargs)
+
+    def tick(self, deadline_ns):
+        """
+        Run the stages once. The optional stages are skipped if they are not expected to finish before deadline_ns.
+        """
+        for stage in Controller.STAGES:
+            stats = self._stage_stats[stage]
+            start = now_ns()
+            if stage in self._optional and deadline_ns - start < stats['estimate']:
+                # the estimate decays while the stage is skipped, so the stage is tried again later
+                stats['skipped'] += 1
+                stats['estimate'] *= 1. - Controller.ESTIMATE_WEIGHT
+                continue
+
+            getattr(self, '_' + stage)()
+
+            elapsed = now_ns() - start
+            self._metrics.histogram(stage).record(elapsed)
+            stats['count'] += 1
+            stats['total'] += elapsed
+            stats['last'] = elapsed
+            stats['max'] = max(stats['max'], elapsed)
+            stats['estimate'] += Controller.ESTIMATE_WEIGHT * (elapsed - stats['estimate'])
+        self._ticks.incr()
+
+    def run(self, duration=None):
+        """
+        Run the loop until stop is called, or for duration seconds.
+        """
+        period = self._period_ns
+        next_start = now_ns()
+        end = next_start + to_ns(duration) if duration is not None else None
+
+        self._running = True
+        while self._running and (end is None or next_start < end):
+            deadline = next_start + period
+            self.tick(deadline)
+
+            now = now_ns()
+            if now > deadline:
+                self._overruns.incr()
+                missed = (now - deadline) // period
+                self._missed.incr(missed)
+                next_start = deadline + missed * period
+            else:
+                next_start = deadline
+                time.sleep(to_seconds(deadline - now))
+
+    def stop(self):
+        self._running = False
+
+    @property
+    def stats(self):
+        """
+        The number of ticks, overruns and missed ticks, the number of messages shed for each radar, and for each stage:
+        the number of runs, the mean, max and last duration (in second) and the number of skips.
+        """
+        stages = {}
+        for stage, stats in self._stage_stats.items():
+            stages[stage] = {
+                'count':   stats['count'],
+                'mean':    to_seconds(stats['total'] / stats['count']) if stats['count'] else None,
+                'max':     to_seconds(stats['max']),
+                'last':    to_seconds(stats['last']),
+                'skipped': stats['skipped'],
+            }
+        shed = {key: self._metrics.counter('shed::{}'.format(key)).value for key in self._radars}
+        return {'ticks': self._ticks.value, 'overruns': self._overruns.value, 'missed': self._missed.value, 'shed': shed,
+                'stages': stages}
+
+    @property
+    def metrics(self):
+        return self._metrics
+
+    @property
+    def distance_map(self):
+        return self._distance_map
+
+    @property
+    def occupancy_grid(self):
+        return self._occupancy_grid
+
+    @property
+    def data_handler(self):
+        return self._data_handler
+
+    @property
+    def engine(self):
+        return self._engine
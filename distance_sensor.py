@@ -1,6 +1,9 @@
 
-import RPi.GPIO as gpio
+from gpio_backend import gpio
 import time
+import threading
+
+from clock import now_ns
 
 #gpio.setmode(gpio.BCM)
 gpio.setmode(gpio.BOARD)
@@ -8,15 +11,39 @@ gpio.setmode(gpio.BOARD)
 
 
 class DistanceSensor:
+    """
+    Ultrasonic distance sensor (HC-SR04). A 10us pulse on the trigger pin sends a ping, the echo pin is then high
+    for the time the sound takes to go to the obstacle and back.
+
+    Args of __init__:
+        pin_echo:  the pin number of the echo signal.
+        pin_trig:  the pin number of the trigger signal.
+        mode:      POLL or EDGE. In POLL mode, measure busy-waits on the echo pin. In EDGE mode, the edges of the echo
+                   signal are timestamped by GPIO event callbacks and measure sleeps until the echo is complete.
+        pipelined: bool. Only in EDGE mode. The next ping is sent as soon as the echo of the previous one is received, and
+                   measure returns the latest completed measurement.
+    """
     SUCC    = 'SUCC'
     INIT    = 'INIT'
     TIMEOUT = 'TIMEOUT'
     FAIL    = 'FAIL'
 
-    def __init__(self, pin_echo=None, pin_trig=None, unit='m'):
+    POLL = 'poll'
+    EDGE = 'edge'
+
+    HALF_SPEED_OF_SOUND = 170.  # m/s
+    ECHO_START_TIMEOUT  = 0.03  # the echo has to start within 30ms after the ping
+    ECHO_TIMEOUT        = 0.06  # the echo has to end within 60ms after the ping
+
+    def __init__(self, pin_echo=None, pin_trig=None, unit='m', mode=POLL, pipelined=False):
         assert pin_echo is not None and pin_trig is not None
+        assert mode in (DistanceSensor.POLL, DistanceSensor.EDGE)
+        assert not pipelined or mode == DistanceSensor.EDGE, 'Only the EDGE mode can be pipelined.'
+
         self._pin_echo = pin_echo
         self._pin_trig = pin_trig
+        self._mode = mode
+        self._pipelined = pipelined
 
         gpio.setup(pin_echo, gpio.IN, pull_up_down=gpio.PUD_DOWN)
         gpio.setup(pin_trig, gpio.OUT, initial=0)
@@ -26,50 +53,172 @@ class DistanceSensor:
         self._status = DistanceSensor.INIT
         self._latest_measure = (None, DistanceSensor.INIT)
 
+        # timestamps (clock.now_ns) of the current ping, filled by the edge callback in EDGE mode
+        self._trigger_ns = None
+        self._rise_ns = None
+        self._fall_ns = None
+        self._measure_ns = None
+
+        if mode == DistanceSensor.EDGE:
+            self._echo_done = threading.Condition()
+            self._seq = 0           # number of completed echoes
+            self._returned_seq = 0  # last echo returned by measure
+            self._running = False
+            # the edge detection runs a thread, it is enabled by the first measure in the process that measures
+            self._edge_detect = False
+
+    def _trigger(self):
+        self._rise_ns = None
+        self._fall_ns = None
+        self._trigger_ns = now_ns()
+        gpio.output(self._pin_trig, 1)
+        time.sleep(self._pulse)
+        gpio.output(self._pin_trig, 0)
+
+    def _to_measure(self, echo_s):
+        distance_m = DistanceSensor.HALF_SPEED_OF_SOUND * echo_s
+
+        # sanity check
+        if distance_m < 0.04 or distance_m > 4:
+            return None, DistanceSensor.FAIL
+        return distance_m, DistanceSensor.SUCC
+
     def measure(self):
         """
         measure the distance once. The returnd value is a tuple: (distance, status)
         """
+        if self._mode == DistanceSensor.EDGE:
+            res = self._measure_edge()
+        else:
+            res = self._measure_poll()
+
+        self._status = res[1]
+        self._latest_measure = res
+        return res
+
+    def _measure_poll(self):
         # send out the signal
-        gpio.output(self._pin_trig, 1)
-        time.sleep(self._pulse)
-        gpio.output(self._pin_trig, 0)
+        self._trigger()
 
-        start = time.time()
+        start = now_ns()
         _start = start
+        start_timeout = int(DistanceSensor.ECHO_START_TIMEOUT * 1e9)
 
         while gpio.input(self._pin_echo) == 0: # no echo signal received
-            if time.time() - _start > 0.03:
-                self._status = DistanceSensor.TIMEOUT 
-                break
-            start = time.time()
-
-        if self._status == DistanceSensor.TIMEOUT:
-            return None, self._status
+            if now_ns() - _start > start_timeout:
+                self._measure_ns = self._trigger_ns
+                return None, DistanceSensor.TIMEOUT
+            start = now_ns()
 
+        stop = start
         while gpio.input(self._pin_echo) == 1: # receiving the echo signal
-            stop = time.time()
+            stop = now_ns()
+
+        self._rise_ns = start
+        self._fall_ns = stop
+        self._measure_ns = (start + stop) // 2
+        return self._to_measure((stop - start) * 1e-9)
+
+    def _on_edge(self, channel):
+        now = now_ns()
+        # the pings are only sent under the lock, so the callback and measure (after a timeout) never trigger at once
+        with self._echo_done:
+            if self._trigger_ns is None:
+                return
+
+            # the edges of an echo always come in pairs: rising then falling
+            if self._rise_ns is None:
+                self._rise_ns = now
+                return
+
+            self._fall_ns = now
+            self._seq += 1
+            self._echo_result = self._to_measure((self._fall_ns - self._rise_ns) * 1e-9)
+            self._echo_midpoint_ns = (self._rise_ns + self._fall_ns) // 2
+            self._echo_done.notify_all()
+
+            # the echo window is closed, the next ping can be sent immediately
+            if self._pipelined and self._running:
+                self._trigger()
+
+    def _measure_edge(self):
+        if not self._edge_detect:
+            gpio.add_event_detect(self._pin_echo, gpio.BOTH, callback=self._on_edge)
+            self._edge_detect = True
+
+        with self._echo_done:
+            if not self._pipelined or not self._running or self._seq == self._returned_seq and self._timed_out():
+                self._running = True
+                self._trigger()
+
+            completed = self._echo_done.wait_for(lambda: self._seq > self._returned_seq, timeout=DistanceSensor.ECHO_TIMEOUT)
+            if not completed:
+                # the next call sends a new ping
+                self._measure_ns = self._trigger_ns
+                self._trigger_ns = None
+                self._running = False
+                return None, DistanceSensor.TIMEOUT
+
+            self._returned_seq = self._seq
+            self._measure_ns = self._echo_midpoint_ns
+            return self._echo_result
+
+    def _timed_out(self):
+        return self._trigger_ns is None or now_ns() - self._trigger_ns > DistanceSensor.ECHO_TIMEOUT * 1e9
+
+    def close(self):
+        if self._mode == DistanceSensor.EDGE and self._edge_detect:
+            self._running = False
+            gpio.remove_event_detect(self._pin_echo)
+            self._edge_detect = False
+
+    @property
+    def echo_timestamps(self):
+        """
+        The clock.now_ns timestamps (trigger, echo start, echo end) of the last ping.
+        """
+        return self._trigger_ns, self._rise_ns, self._fall_ns
 
+    @property
+    def measure_ns(self):
+        """
+        The time (clock.now_ns) of the last measure: the midpoint of the echo, when the sound hits the obstacle. It is
+        the time of the ping if there was no echo.
+        """
+        return self._measure_ns
 
-        distance_m = 170. * (stop - start)
+    @property
+    def mode(self):
+        return self._mode
+
+    @property
+    def latest_measure(self):
+        return self._latest_measure
 
-        # sanity check
-        if distance_m < 0.04 or distance_m > 4:
-            self._status = DistanceSensor.FAIL
-            distance_m = None
 
-        else:
-            self._status = DistanceSensor.SUCC
 
-        return distance_m, self._status
+def benchmark(sensor, n=200):
+    """
+    Measure n times. Return the achieved ping rate (per second) and the CPU usage (fraction of one core).
+    """
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    for _ in range(n):
+        sensor.measure()
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+    return n / wall, cpu / wall
 
 
 
-                    
 
 if __name__ == '__main__':
     echo = 18
     trig = 16
 
-    distance_sensor = DistanceSensor(pin_echo=echo, pin_trig=trig)
+    for mode, pipelined in ((DistanceSensor.POLL, False), (DistanceSensor.EDGE, False), (DistanceSensor.EDGE, True)):
+        distance_sensor = DistanceSensor(pin_echo=echo, pin_trig=trig, mode=mode, pipelined=pipelined)
+        rate, cpu = benchmark(distance_sensor)
+        distance_sensor.close()
+        print('mode: {}, pipelined: {}, ping rate: {:.1f}/s, cpu: {:.0%}, last: {}'.format(mode, pipelined, rate, cpu, distance_sensor.latest_measure))
 
@@ -2,21 +2,34 @@ import time
 import multiprocessing as mp
 import random
 
-from components import WheelComponent, ContinuousComponentWrapper
+from components import WheelComponent, DifferentialDriveComponent, ContinuousComponentWrapper, CMD_EXIT
+from transport import CommandChannel, LatestValue, SharedRingQueue, drain
+from commands import command_table
+from records import make_dtype
 
 
 class Engine:
     """
-    Engine class controls the movement of the robot. It consists of two wheels.
+    Engine class controls the movement of the robot. It consists of two wheels, each in its own process, or of a
+    DifferentialDriveComponent that drives both wheels in one process.
     """
+    # the number of messages of a wheel kept for the odometry, about 15 minutes of cycles
+    STATUS_CAPACITY = 4096
 
-    def __init__(self, startup_scale=0.1, stable_scale=0.6, cmd_Q=None, output_Q=None,left_wheel_comp=None, right_wheel_comp=None):
+    def __init__(self, startup_scale=0.1, stable_scale=0.6, cmd_Q=None, output_Q=None,left_wheel_comp=None, right_wheel_comp=None, record_dir=None, odometry=None,
+                 drive_comp=None):
         """
         Args:
             startup_scale:    float. It controls the start up sclae of the two wheel. 
             stable_scale:     float. It controls the speed of the wheel in the stable status.
             left_wheel_comp:  Instance of WheelComponent.
             right_wheel_comp: Instance of WheelComponent.
+            record_dir:       str. Record the messages and the commands of the wheels in this directory, see recorder.py.
+            odometry:         an odometry.Odometry. The messages of the wheels are passed to it, see update_motor_stats.
+                              update_motor_stats should then be called regularly (the Controller calls it every tick):
+                              the wheels wait when STATUS_CAPACITY messages are not read.
+            drive_comp:       Instance of DifferentialDriveComponent. If it is set, left_wheel_comp and right_wheel_comp are
+                              not needed: the wheels of drive_comp are used and each command reaches both wheels at once.
             cmd_Q: Do we need this?
             output_Q: Do we need this?
 
@@ -27,6 +40,9 @@ class Engine:
 #        assert isinstance(cmd_Q, mp.queues.Queue)
 #        assert isinstance(output_Q, mp.queues.Queue)
 
+        if drive_comp is not None:
+            assert isinstance(drive_comp, DifferentialDriveComponent)
+            left_wheel_comp, right_wheel_comp = drive_comp.left_wheel, drive_comp.right_wheel
         assert isinstance(left_wheel_comp, WheelComponent)
         assert isinstance(right_wheel_comp, WheelComponent)
 
@@ -34,38 +50,111 @@ class Engine:
         self._output_Q = output_Q
         self._left_wheel_comp = left_wheel_comp
         self._right_wheel_comp = right_wheel_comp
+        self._drive_comp = drive_comp
+        self._odometry = odometry
+        self._wheel_dtype = make_dtype(WheelComponent.FORMAT)
 
         self._startup_scale = startup_scale
         self._stacle_scale = stable_scale
 
 
-        self._cmd_Q_left = mp.Queue()
-        self._cmd_Q_right = mp.Queue()
-        self._output_Q_left = mp.Queue()
-        self._output_Q_right = mp.Queue()
+        # the commands are sent to the wheels in wire form, see commands.py
+        # the odometry integrates every cycle of the wheels, so it needs all their messages. Otherwise only the
+        # current pulses matter: the last message of each wheel is kept and nothing piles up between two reads.
+        def status_channel(fields):
+            if odometry is not None:
+                return SharedRingQueue(fields, capacity=Engine.STATUS_CAPACITY)
+            return LatestValue(fields)
+
+        if drive_comp is not None:
+            self._commands = command_table(type(drive_comp))
+            self._drive_dtype = make_dtype(DifferentialDriveComponent.FORMAT)
+
+            self._cmd_Q_drive = CommandChannel()
+            self._output_Q_drive = status_channel(DifferentialDriveComponent.FORMAT)
+            self._drive = ContinuousComponentWrapper(component=drive_comp, cmd_Q=self._cmd_Q_drive, output_Q=self._output_Q_drive, record_dir=record_dir)
+            self._wrappers = [(self._drive, self._cmd_Q_drive)]
+        else:
+            self._commands = command_table(type(left_wheel_comp))
+
+            self._cmd_Q_left = CommandChannel()
+            self._cmd_Q_right = CommandChannel()
+            self._output_Q_left = status_channel(WheelComponent.FORMAT)
+            self._output_Q_right = status_channel(WheelComponent.FORMAT)
+
+            self._left_wheel  = ContinuousComponentWrapper(component=self._left_wheel_comp,  cmd_Q=self._cmd_Q_left, output_Q=self._output_Q_left, record_dir=record_dir)
+            self._right_wheel = ContinuousComponentWrapper(component=self._right_wheel_comp, cmd_Q=self._cmd_Q_right,output_Q=self._output_Q_right, record_dir=record_dir)
+            self._wrappers = [(self._left_wheel, self._cmd_Q_left), (self._right_wheel, self._cmd_Q_right)]
 
-        self._left_wheel  = ContinuousComponentWrapper(component=self._left_wheel_comp,  cmd_Q=self._cmd_Q_left, output_Q=self._output_Q_left)
-        self._right_wheel = ContinuousComponentWrapper(component=self._right_wheel_comp, cmd_Q=self._cmd_Q_right,output_Q=self._output_Q_right)
 
         # infomration of wheel components
-        self._left_pulse             = self._left_wheel.pulse
-        self._right_pulse            = self._right_wheel.pulse
-        self._left_reference_pulse   = self._left_wheel.reference_pulse
-        self._right_reference_pulse  = self._right_wheel.reference_pulse
-        self._left_max_deviation     = self._left_wheel.max_pulse_deviation
-        self._right_max_deviation    = self._right_wheel.max_pulse_deviation
-        self._left_mirro             = self._left_wheel.mirror
-        self._right_mirro            = self._right_wheel.mirror
+        self._left_pulse             = self._left_wheel_comp.pulse
+        self._right_pulse            = self._right_wheel_comp.pulse
+        self._left_reference_pulse   = self._left_wheel_comp.reference_pulse
+        self._right_reference_pulse  = self._right_wheel_comp.reference_pulse
+        self._left_max_deviation     = self._left_wheel_comp.max_pulse_deviation
+        self._right_max_deviation    = self._right_wheel_comp.max_pulse_deviation
+        self._left_mirro             = self._left_wheel_comp.mirror
+        self._right_mirro            = self._right_wheel_comp.mirror
 
     
+    @property
+    def metrics(self):
+        """
+        The metrics of the wrappers of the wheels.
+        """
+        return [wrapper.metrics for wrapper, _ in self._wrappers]
+
+    @property
+    def odometry(self):
+        return self._odometry
+
+    @property
+    def command_latency(self):
+        """
+        Statistics of the delay between sending a command and its execution by each wheel, or by the drive.
+        """
+        if self._drive_comp is not None:
+            return {'drive': self._cmd_Q_drive.latency}
+        return {'left': self._cmd_Q_left.latency, 'right': self._cmd_Q_right.latency}
+
+    @property
+    def overwritten(self):
+        """
+        The number of messages of each wheel, or of the drive, that were replaced by the next one before being read.
+        It is always 0 with an odometry, which gets all the messages.
+        """
+        if self._drive_comp is not None:
+            channels = {'drive': self._output_Q_drive}
+        else:
+            channels = {'left': self._output_Q_left, 'right': self._output_Q_right}
+        # nothing is overwritten in the rings used with an odometry
+        return {name: getattr(Q, 'overwritten', 0) for name, Q in channels.items()}
+
     def update_motor_stats(self):
-        while not self._output_Q_left.empty():
-            msg = self._output_Q_left.get(block=False)
-            self._left_pulse = msg[2]
+        """
+        Read the latest message of the wheels, if it is new. It is passed to the odometry, if any.
+        """
+        if self._drive_comp is not None:
+            msgs = drain(self._output_Q_drive, dtype=self._drive_dtype)
+            if len(msgs):
+                self._left_pulse = msgs['left_pulse'][-1]
+                self._right_pulse = msgs['right_pulse'][-1]
+                if self._odometry is not None:
+                    self._odometry.update('drive', msgs)
+            return
+
+        msgs = drain(self._output_Q_left, dtype=self._wheel_dtype)
+        if len(msgs):
+            self._left_pulse = msgs['pulse'][-1]
+            if self._odometry is not None:
+                self._odometry.update('left', msgs)
 
-        while not self._output_Q_right.empty():
-            msg = self._output_Q_right.get(block=False)
-            self._right_pulse = msg[2]
+        msgs = drain(self._output_Q_right, dtype=self._wheel_dtype)
+        if len(msgs):
+            self._right_pulse = msgs['pulse'][-1]
+            if self._odometry is not None:
+                self._odometry.update('right', msgs)
 
 
 
@@ -73,13 +162,37 @@ class Engine:
         """
         change the speed of the two wheels. A utility function.
         """
+        if self._drive_comp is not None:
+            self._cmd_Q_drive.put(self._commands.encode('increase_speed', left_scale, right_scale, False))
+            self.update_motor_stats()
+            return
+
+        left_cmd = self._commands.encode('increase_speed', left_scale, False)
+        right_cmd = self._commands.encode('increase_speed', right_scale, False)
         rdn_num = random.random()
         if rdn_num <= 0.5:
-            self._cmd_Q_left.put(('increase_speed',  (left_scale,), {}))
-            self._cmd_Q_right.put(('increase_speed', (right_scale,), {}))
+            self._cmd_Q_left.put(left_cmd)
+            self._cmd_Q_right.put(right_cmd)
         else:
-            self._cmd_Q_right.put(('increase_speed', (right_scale,), {}))
-            self._cmd_Q_left.put(('increase_speed',  (left_scale,), {}))
+            self._cmd_Q_right.put(right_cmd)
+            self._cmd_Q_left.put(left_cmd)
+
+        self.update_motor_stats()
+
+
+    def set_speed(self, left_scale=0., right_scale=0.):
+        """
+        Set the speed of the two wheels, see WheelComponent.set_speed. A positive scale moves the wheel forward.
+        """
+        if self._drive_comp is not None:
+            self._cmd_Q_drive.put(self._commands.encode('set_speed', left_scale, right_scale))
+            self.update_motor_stats()
+            return
+
+        left_cmd = self._commands.encode('set_speed', left_scale)
+        right_cmd = self._commands.encode('set_speed', right_scale)
+        self._cmd_Q_left.put(left_cmd)
+        self._cmd_Q_right.put(right_cmd)
 
         self.update_motor_stats()
 
@@ -92,28 +205,40 @@ class Engine:
         """
         Breaks the robot. Set the wheels to be still.
         """
-        self._cmd_Q_left.put(('stop', (), {}))
-        self._cmd_Q_right.put(('stop', (), {}))
+        cmd = self._commands.encode('stop')
+        if self._drive_comp is not None:
+            self._cmd_Q_drive.put(cmd)
+            return
+        self._cmd_Q_left.put(cmd)
+        self._cmd_Q_right.put(cmd)
 
     def go_straight(self):
-        left_scale = abs(self._left_pulse - self._left_reference_pulse) / self._left_max_deviation
-        right_scale = abs(self._right_pulse - self._right_reference_pulse) / self._right_max_deviation
-        new_scale = 0.5 * (left_scale + right_scale)
-
-        if self._left_pulse < self._left_reference_pulse:
-            new_left_scale = -new_scale
-        else:
-            new_left_scale = new_scale
-
+        """
+        Set both wheels to the mean of their current speeds, in the direction the robot moves: forward unless the
+        wheels move it backward overall.
+        """
+        self.update_motor_stats()
+        # the scales of set_speed: positive forward. A mirrored wheel moves forward when its pulse is shorter.
+        left_scale = (self._left_pulse - self._left_reference_pulse) / self._left_max_deviation
+        right_scale = (self._right_pulse - self._right_reference_pulse) / self._right_max_deviation
+        if self._left_mirro:
+            left_scale = -left_scale
+        if self._right_mirro:
+            right_scale = -right_scale
 
-        if self._right_pulse < self._right_reference_pulse:
-            new_right_scale = -new_scale
-        else:
-            new_right_scale = new_scale
+        new_scale = 0.5 * (abs(left_scale) + abs(right_scale))
+        if left_scale + right_scale < 0:
+            new_scale = -new_scale
 
+        self.set_speed(new_scale, new_scale)
 
-        self._cmd_Q_left.put(('set_speed',(new_scale,), {}))
-        self._cmd_Q_right.put(('set_speed', (new_scale,), {}))
+    def drive(self, v, omega):
+        """
+        Move at the linear speed v (in m/s) and the angular speed omega (in rad/s, positive anti-clockwise). It needs a
+        DifferentialDriveComponent, see DifferentialDriveComponent.drive.
+        """
+        assert self._drive_comp is not None, 'drive needs a DifferentialDriveComponent.'
+        self._cmd_Q_drive.put(self._commands.encode('drive', v, omega))
         self.update_motor_stats()
 
 
@@ -161,8 +286,16 @@ class Engine:
         Note:
             The wheels are wrapped in the ContinuousComponentWrapper and they are multiprocessing.Process.
         """
+        for wrapper, _ in self._wrappers:
+            wrapper.start()
 
-        self._left_wheel.start()
-        self._right_wheel.start()
 
-        
+    def shutdown(self, timeout=1.):
+        """
+        Stop the processes of the wheels and release their status channels.
+        """
+        for _, cmd_Q in self._wrappers:
+            cmd_Q.put(CMD_EXIT)
+        for wrapper, _ in self._wrappers:
+            wrapper.join(timeout)
+            wrapper.output_Q.close()
@@ -0,0 +1,32 @@
+"""
+Selection of the GPIO library. The hardware modules import gpio from here instead of importing RPi.GPIO directly.
+
+The backend is chosen by the environment variable AUTOCAR_GPIO:
+    rpi: RPi.GPIO, the real pins of the Raspberry Pi (default).
+    sim: sim_gpio, a simulated robot in a room (see sim_world). It runs on any Linux machine.
+"""
+import os
+
+
+GPIO_BACKEND_ENV = 'AUTOCAR_GPIO'
+RPI = 'rpi'
+SIM = 'sim'
+
+
+def load_gpio(backend=None):
+    """
+    Import and return the GPIO module of the backend. If backend is None, it is read from AUTOCAR_GPIO.
+    """
+    backend = backend or os.environ.get(GPIO_BACKEND_ENV, RPI)
+
+    if backend == RPI:
+        import RPi.GPIO as gpio
+    elif backend == SIM:
+        import sim_gpio as gpio
+    else:
+        raise ValueError('Unknown GPIO backend: {}. Valid values are {} and {}.'.format(backend, RPI, SIM))
+
+    return gpio
+
+
+gpio = load_gpio()
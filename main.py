@@ -1,20 +1,39 @@
-import time
 import multiprocessing as mp
 import psutil
 import os
 import signal
+import threading
 
 
-from components import (DistanceRadarBaseComponent, DistanceRadarSensorComponent, WheelComponent, ContinuousComponentWrapper)
+from components import (ScanningRadarComponent, WheelComponent, DifferentialDriveComponent, ContinuousComponentWrapper)
 from engine import Engine
-from controller import RawDataHandler
+from stepper_motor import RampProfile
+from occupancy_grid import OccupancyGrid
+from odometry import Odometry, WheelModel
+from planner import VFHPlanner
+from transport import CommandChannel
+from metrics import MetricsRegistry, SnapshotWriter
 
 import xutils
 
+# set AUTOCAR_RECORD to a directory to record the drive. Replay it with: python recorder.py DIRECTORY
+RECORD_ENV = 'AUTOCAR_RECORD'
+
+# set AUTOCAR_SCAN_MATCH=1 to correct the odometry by matching the radar readings against the occupancy grid. It is off
+# until it is validated on the robot: in the simulation, it fixes a biased wheel model but adds error to a good one.
+SCAN_MATCH_ENV = 'AUTOCAR_SCAN_MATCH'
+
+# calibration of the wheels, shared by the drive component and the odometry: the speed (in m/s) of a wheel at full
+# scale and the distance (in meter) between the wheels
+WHEEL_MAX_SPEED = 0.2
+TRACK_WIDTH = 0.15
+
 if __name__ == '__main__':
+    record_dir = os.environ.get(RECORD_ENV)
+    scan_match = os.environ.get(SCAN_MATCH_ENV, '0') == '1'
     
     
-    # set up radar base
+    # set up the radar: the stepper motor and the distance sensor are driven by the same loop
     in_1 = 3
     in_2 = 5
     in_3 = 7
@@ -22,27 +41,18 @@ if __name__ == '__main__':
 
     pins = [in_1, in_2, in_3, in_4 ]
 
-    radar_base = DistanceRadarBaseComponent(name='radar_base', pins=pins, step_size=0.71, initial_pos=0, min_degree=-60, max_degree=40, delay=0.0025, delay_factor=5)
-    radar_base.initialize()
-    radar_base_datahandler = RawDataHandler(name=radar_base.name, parser=radar_base.FORMAT, record_size=1000)
-
-    cmd_Q_base    = mp.Queue()
-    output_Q_base = mp.Queue()
-
-    cont_radar_base = ContinuousComponentWrapper(component=radar_base, cmd_Q=cmd_Q_base, output_Q=output_Q_base)
-
-
-    # set up distance sensor
     pin_echo = 18
     pin_trig = 16
 
-    cmd_Q_sensor = mp.Queue()
-    output_Q_sensor = mp.Queue()
+    radar_profile = RampProfile(start_delay=0.0025, min_delay=0.0012, accel_steps=100, shape=RampProfile.S_CURVE)
+    radar = ScanningRadarComponent(name='radar', pins=pins, pin_echo=pin_echo, pin_trig=pin_trig, resolution=1., initial_pos=0, min_degree=-60, max_degree=40,
+                                   delay=0.0025, delay_factor=5, profile=radar_profile)
+    radar.initialize()
 
-    distance_sensor = DistanceRadarSensorComponent(name='radar_distance_sensor', pin_echo=pin_echo, pin_trig=pin_trig, delay=0.0007)
-    distance_sensor_datahandler = RawDataHandler(name=distance_sensor.name, parser=distance_sensor.FORMAT, record_size=2000)
+    cmd_Q_radar    = CommandChannel()
+    output_Q_radar = mp.Queue()
 
-    cont_distance_sensor = ContinuousComponentWrapper(component=distance_sensor, cmd_Q=cmd_Q_sensor, output_Q=output_Q_sensor)
+    cont_radar = ContinuousComponentWrapper(component=radar, cmd_Q=cmd_Q_radar, output_Q=output_Q_radar, batch_size=8, batch_age=0.05, record_dir=record_dir)
     
     # set up wheels
     
@@ -52,86 +62,60 @@ if __name__ == '__main__':
     left_wheel_component  = WheelComponent(name='left_wheel',  mirror=False, pin_signal=pin_signal_left,  repeat=10, pulse=None, reference_pulse=0.001462, max_pulse_deviation=0.00025, width=None, power=1.)
     right_wheel_component = WheelComponent(name='right_wheel', mirror=True,  pin_signal=pin_signal_right, repeat=10, pulse=None, reference_pulse=0.001450, max_pulse_deviation=0.00025, width=None, power=1.)
 
-    engine = Engine(left_wheel_comp=left_wheel_component, right_wheel_comp=right_wheel_component)
+    # the pose of the robot, integrated from the messages of the wheels
+    odometry = Odometry(left=WheelModel.from_component(left_wheel_component, max_speed=WHEEL_MAX_SPEED),
+                        right=WheelModel.from_component(right_wheel_component, max_speed=WHEEL_MAX_SPEED), track_width=TRACK_WIDTH)
+
+    # both wheels are driven by one process, so a command changes their speeds in the same period
+    drive_component = DifferentialDriveComponent(name='drive', left_wheel=left_wheel_component, right_wheel=right_wheel_component, repeat=10,
+                                                 max_wheel_speed=WHEEL_MAX_SPEED, track_width=TRACK_WIDTH)
+
+    engine = Engine(drive_comp=drive_component, record_dir=record_dir, odometry=odometry)
 
 
 
     # start all the components
-    cont_radar_base.start()
-    cont_distance_sensor.start()
+    cont_radar.start()
     engine.start()
 
 
-    # control ??
+    # control loop
     import controller as ctl
-    from bashplotlib.histogram import plot_hist
-    import numpy as np
-
-    def series2histdata(ts):
-        if ts.isnull().sum() > 30:
-            return [0]
-        _ts = (ts * 100).astype(int)
-        n = _ts.sum()
-        out = np.empty(n)
-        i = 0
-        for item in _ts.index:
-            count = _ts.loc[item]
-            out[i: (i+count)] = item
-            i += count
-
-        return out
-            
-
-            
-
-    while True:
-        _start = time.time()
-
-        while not output_Q_sensor.empty():
-            msg = output_Q_sensor.get()
-            distance_sensor_datahandler.update(msg)
-#            print(msg)
-
-        while not output_Q_base.empty():
-            msg = output_Q_base.get()
-            radar_base_datahandler.update(msg)
-#            print(msg)
-        df_base = radar_base_datahandler.data
-        df_sensor = distance_sensor_datahandler.data
-
-        try:
-            distance_map = ctl.create_distance_map(df_base, df_sensor)
-            data4hist_distance_map = series2histdata(distance_map)
-        except:
-            #print(distance_map, distance_map.isnull().sum())
-            print("[failed] Cannot create distance map")
-
-        try:
-            pass
-#            plot_hist(data4hist_distance_map, pch='#',bincount=100)
-        except Exception:
-            pass
-            print("[failed] Cannot plot distance map")
-
-        print("time elapses: {}".format(time.time() - _start))
-
-        # handle the input from the keyboard
-
-        # When we read the key press, we will temporarily switch to the non-canonical mode
-        # so that we can read the input from the keyboard char by char instead of waiting
-        # for the new line character
-
-        # this functionality is provided by the xutils.key_press_handler
 
-        while True:
-            __start = time.time()
-            key_press = xutils.key_press_handler(timeout=10)
+    # the obstacle avoidance steers the robot when it is engaged with the key 'a'
+    planner = VFHPlanner()
 
-#            print("key_press waiting time: {}".format(time.time() - __start))
+    # with AUTOCAR_SCAN_MATCH=1, the pose of the odometry is corrected by matching the readings against the occupancy grid.
+    # the handlers keep the last 1.5 s of readings. After a stalled tick, the readings older than 0.25 s are reduced to
+    # the latest one of each position before they reach the map
+    controller = ctl.Controller(radar=cont_radar, engine=engine, policy=planner, rate=50., record_size=2000,
+                                occupancy_grid=OccupancyGrid(cell_size=0.05, size=200, max_range=4.),
+                                retention=1.5, max_sample_age=0.25, shed=ctl.SHED_LATEST, scan_match=scan_match)
 
+    # the metrics of all the processes are written to autocar_metrics.json every second. Print them with:
+    #     python metrics.py autocar_metrics.json
+    registry = MetricsRegistry()
+    for metrics in [cont_radar.metrics, controller.metrics, planner.metrics] + engine.metrics:
+        registry.register(metrics)
+    SnapshotWriter(registry, path='autocar_metrics.json', interval=1.).start()
+
+
+    # handle the input from the keyboard
+
+    # When we read the key press, we will temporarily switch to the non-canonical mode
+    # so that we can read the input from the keyboard char by char instead of waiting
+    # for the new line character
+
+    # this functionality is provided by the xutils.key_press_handler. It blocks, so it runs in its own thread and
+    # submits the commands to the controller, which sends them to the engine at its next tick.
+
+    def keyboard_loop():
+        while True:
+            key_press = xutils.key_press_handler(timeout=10)
 
             if key_press == 'q':
                 print("Exiting system")
+                print(controller.stats)
                 pid = os.getpid()
                 parent = psutil.Process(pid)
                 children = parent.children(recursive=True)
@@ -139,32 +123,38 @@ if __name__ == '__main__':
                     os.kill(process.pid, signal.SIGINT)
 
                 os.kill(pid, signal.SIGINT)
+                return
+
+            elif key_press == 'a':
+                if planner.engaged:
+                    print('manual driving')
+                    controller.submit(planner.disengage())
+                else:
+                    print('obstacle avoidance')
+                    planner.engage()
 
             elif key_press == 'b':
                 print("break!")
-                engine.stop()
+                controller.submit(('stop', (), {}))
 
             elif key_press == 's':
                 print('go straight!')
-                engine.go_straight()
-
-            elif key_press is None:
-                break
+                controller.submit(('go_straight', (), {}))
 
             elif key_press == xutils.UP_ARR:
                 print(xutils.UP_ARR)
-                engine.increase_speed(0.035) 
+                controller.submit(('increase_speed', (0.035,), {}))
             elif key_press == xutils.DOWN_ARR:
                 print(xutils.DOWN_ARR)
-                engine.increase_speed(-0.025)
+                controller.submit(('increase_speed', (-0.025,), {}))
             elif key_press == xutils.LEFT_ARR:
                 print(xutils.LEFT_ARR)
-                engine.turn_left(scale=0.15, weight=0.3, period=1.)
+                controller.submit(('turn_left', (), {'scale': 0.15, 'weight': 0.3, 'period': 1.}))
             elif key_press == xutils.RIGHT_ARR:
                 print(xutils.RIGHT_ARR)
-                engine.turn_right(scale=0.15, weight=0.3, period=1.)
-        
-
-
+                controller.submit(('turn_right', (), {'scale': 0.15, 'weight': 0.3, 'period': 1.}))
 
+    keyboard = threading.Thread(target=keyboard_loop, daemon=True)
+    keyboard.start()
 
+    controller.run()
@@ -0,0 +1,283 @@
+"""
+Instrumentation of the hot paths: counters, gauges and latency histograms.
+
+The metrics of a component live in a block of shared memory (multiprocessing.RawArray) allocated in the main process
+before the component process is forked. The component process writes to it, the main process reads it: there is no
+message to send and no lock to take. Recording a value in a histogram costs about as much as ten calls to
+time.monotonic_ns, which is negligible against the millisecond loops of the components, so the metrics can be left on.
+There is a single writer per block, a reader may see a snapshot that is a few values behind.
+
+The snapshots of all the blocks are written periodically to a JSON file by a SnapshotWriter. Run
+    python metrics.py autocar_metrics.json
+to print the latest snapshot.
+"""
+import json
+import multiprocessing as mp
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+
+class Counter:
+    def __init__(self, array, index):
+        self._array = array
+        self._index = index
+
+    def incr(self, n=1):
+        self._array[self._index] += n
+
+    @property
+    def value(self):
+        return self._array[self._index]
+
+
+
+class Gauge:
+    def __init__(self, array, index):
+        self._array = array
+        self._index = index
+
+    def set(self, value):
+        self._array[self._index] = value
+
+    @property
+    def value(self):
+        return self._array[self._index]
+
+
+
+class Histogram:
+    """
+    Log-linear histogram of non negative integers (usually durations in nanoseconds), in the style of HdrHistogram.
+    Each power of 2 is split in 2 ** SUB_BITS buckets, so the relative error of a percentile is at most 1 / 2 ** SUB_BITS.
+
+    Args of __init__:
+        array:  the shared array holding the histogram.
+        offset: the position of the histogram in the array. It uses SIZE slots.
+    """
+    SUB_BITS  = 3       # record assumes SUB_BITS = 3
+    MAX_BITS  = 40      # values up to 2 ** 40 ns (18 minutes), larger values are counted in the last bucket
+    N_BUCKETS = (MAX_BITS - SUB_BITS) << SUB_BITS
+    SIZE      = N_BUCKETS + 3   # buckets, count, sum, max
+
+    def __init__(self, array, offset):
+        self._array = array
+        # item access through a memoryview is faster than through the ctypes array
+        self._view = memoryview(array).cast('B').cast('q')
+        self._buckets = np.frombuffer(array, dtype=np.int64)[offset:offset + Histogram.N_BUCKETS]
+        self._offset = offset
+        self._count = offset + Histogram.N_BUCKETS
+        self._sum = self._count + 1
+        self._max = self._count + 2
+
+    @staticmethod
+    def bucket(value):
+        shift = value.bit_length() - Histogram.SUB_BITS - 1
+        if shift <= 0:
+            return value
+        return min((shift << Histogram.SUB_BITS) + (value >> shift), Histogram.N_BUCKETS - 1)
+
+    @staticmethod
+    def bucket_bounds():
+        """
+        The lower bound of each bucket and its width.
+        """
+        i = np.arange(Histogram.N_BUCKETS)
+        shift = np.maximum((i >> Histogram.SUB_BITS) - 1, 0)
+        lower = (i - (shift << Histogram.SUB_BITS)) << shift
+        return lower, 1 << shift
+
+    def record(self, value):
+        if value < 0:
+            value = 0
+        # same as bucket, inlined because it is on the hot path
+        shift = value.bit_length() - 4
+        if shift <= 0:
+            i = value
+        else:
+            i = (shift << 3) + (value >> shift)
+            if i >= Histogram.N_BUCKETS:
+                i = Histogram.N_BUCKETS - 1
+        view = self._view
+        view[self._offset + i] += 1
+        view[self._count] += 1
+        view[self._sum] += value
+        if value > view[self._max]:
+            view[self._max] = value
+
+    def record_many(self, values):
+        """
+        Record an array of values at once. The buckets are computed with NumPy, so the cost hardly grows with the
+        number of values.
+        """
+        values = np.maximum(np.asarray(values, dtype=np.int64), 0)
+        if values.size == 0:
+            return
+        # the float64 exponent is the bit length as long as the values are exact in float64. The larger values all go
+        # to the last bucket anyway.
+        exact = np.minimum(values, (1 << 53) - 1)
+        shift = np.frexp(exact.astype(np.float64))[1] - Histogram.SUB_BITS - 1
+        i = np.where(shift <= 0, exact, (shift << Histogram.SUB_BITS) + (exact >> np.maximum(shift, 0)))
+        self._buckets += np.bincount(np.minimum(i, Histogram.N_BUCKETS - 1), minlength=Histogram.N_BUCKETS)
+
+        view = self._view
+        view[self._count] += int(values.size)
+        view[self._sum] += int(values.sum())
+        top = int(values.max())
+        if top > view[self._max]:
+            view[self._max] = top
+
+    def reset(self):
+        for i in range(self._offset, self._offset + Histogram.SIZE):
+            self._array[i] = 0
+
+    @property
+    def counts(self):
+        return np.frombuffer(self._array, dtype=np.int64)[self._offset:self._offset + Histogram.N_BUCKETS].copy()
+
+    def percentile(self, q, counts=None):
+        counts = self.counts if counts is None else counts
+        total = counts.sum()
+        if total == 0:
+            return None
+        i = np.searchsorted(np.cumsum(counts), q / 100. * total)
+        lower, width = Histogram.bucket_bounds()
+        return float(lower[i] + (width[i] - 1) / 2.)
+
+    def summary(self):
+        """
+        count, mean, percentiles (50, 90, 99, 99.9) and max of the recorded values.
+        """
+        counts = self.counts
+        count = int(self._array[self._count])
+        res = {'count': count, 'mean': self._array[self._sum] / count if count else None, 'max': int(self._array[self._max])}
+        for q in (50, 90, 99, 99.9):
+            # the percentile is the middle of its bucket, it cannot be more than the max
+            p = self.percentile(q, counts)
+            res['p{}'.format(q)] = min(p, res['max']) if p is not None else None
+        return res
+
+
+
+class Metrics:
+    """
+    The metrics of one component (or of the controller), in one block of shared memory.
+
+    Args of __init__:
+        name:       the name of the block in the snapshots.
+        counters:   the names of the counters.
+        gauges:     the names of the gauges.
+        histograms: the names of the histograms.
+
+    Note:
+        The block must be created before the process that writes it is forked.
+    """
+    def __init__(self, name, counters=(), gauges=(), histograms=()):
+        self._name = name
+        size = len(counters) + len(gauges) + len(histograms) * Histogram.SIZE
+        self._array = mp.RawArray('q', size)
+
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        offset = 0
+        for key in counters:
+            self._counters[key] = Counter(self._array, offset)
+            offset += 1
+        for key in gauges:
+            self._gauges[key] = Gauge(self._array, offset)
+            offset += 1
+        for key in histograms:
+            self._histograms[key] = Histogram(self._array, offset)
+            offset += Histogram.SIZE
+
+    def counter(self, key):
+        return self._counters[key]
+
+    def gauge(self, key):
+        return self._gauges[key]
+
+    def histogram(self, key):
+        return self._histograms[key]
+
+    def reset(self):
+        for i in range(len(self._array)):
+            self._array[i] = 0
+
+    def snapshot(self):
+        return {
+            'counters':   {key: counter.value for key, counter in self._counters.items()},
+            'gauges':     {key: gauge.value for key, gauge in self._gauges.items()},
+            'histograms': {key: histogram.summary() for key, histogram in self._histograms.items()},
+        }
+
+    @property
+    def name(self):
+        return self._name
+
+
+
+class MetricsRegistry:
+    """
+    The metrics blocks of all the processes of the robot.
+    """
+    def __init__(self):
+        self._blocks = []
+
+    def register(self, metrics):
+        self._blocks.append(metrics)
+        return metrics
+
+    def snapshot(self):
+        return {'time': time.time(), 'metrics': {metrics.name: metrics.snapshot() for metrics in self._blocks}}
+
+
+
+class SnapshotWriter(threading.Thread):
+    """
+    Write the snapshot of a registry to a JSON file every interval seconds. The file is replaced atomically, so a reader
+    never sees a partial snapshot.
+
+    Args of __init__:
+        registry: a MetricsRegistry.
+        path:     the path of the JSON file.
+        interval: in second.
+    """
+    def __init__(self, registry, path='autocar_metrics.json', interval=1.):
+        super(SnapshotWriter, self).__init__(daemon=True)
+        self._registry = registry
+        self._path = path
+        self._interval = interval
+        self._stopped = threading.Event()
+
+    def write(self):
+        tmp = '{}.tmp'.format(self._path)
+        with open(tmp, 'w') as f:
+            json.dump(self._registry.snapshot(), f, indent=1)
+        os.replace(tmp, self._path)
+
+    def run(self):
+        while not self._stopped.wait(self._interval):
+            self.write()
+
+    def stop(self):
+        self._stopped.set()
+
+
+
+if __name__ == '__main__':
+    path = sys.argv[1] if len(sys.argv) > 1 else 'autocar_metrics.json'
+    with open(path) as f:
+        snapshot = json.load(f)
+
+    print('snapshot of {}'.format(time.ctime(snapshot['time'])))
+    for name, block in snapshot['metrics'].items():
+        print('[{}]'.format(name))
+        for key, value in list(block['counters'].items()) + list(block['gauges'].items()):
+            print('    {:<20} {}'.format(key, value))
+        for key, summary in block['histograms'].items():
+            if summary['count']:
+                print('    {:<20} n={count} mean={mean:.0f}ns p50={p50:.0f}ns p99={p99:.0f}ns max={max}ns'.format(key, **summary))
@@ -0,0 +1,277 @@
+"""
+2-D occupancy grid built from the readings of the radar.
+
+Each cell holds the log-odds of being occupied. A reading at angle a and distance d is a ray from the robot: the cells
+before d are evidence of free space, the cell at d is evidence of an obstacle. The rays of all the angles are computed
+once (the cells they cross and their range) together with the trig tables, so integrating a sweep is a few array
+operations on the readings and one bincount on the touched cells.
+
+The grid is a fixed window around the robot. When the robot gets close to the border, the window scrolls by whole
+cells and the cells that leave it are forgotten, so the memory used does not grow with the distance driven.
+
+The grid can also correct the pose of the robot: match searches the pose around the current one where the latest
+obstacles seen by the radar fall on the occupied cells of the grid (see Controller, which passes it to the odometry).
+"""
+import math
+
+import numpy as np
+
+
+class OccupancyGrid:
+    """
+    Log-odds occupancy grid around the robot.
+
+    Args of __init__:
+        cell_size:          the side of a cell, in meter.
+        size:               the number of cells of a side of the grid.
+        max_range:          in meter. The readings at max_range or beyond only clear the cells of their ray.
+        angle_resolution:   in degree. The angles are rounded to this resolution to use the precomputed rays.
+        log_odds_occupied:  the log-odds added to the cell of a reading.
+        log_odds_free:      the log-odds added to the cells crossed by a ray.
+        clamp:              the log-odds are kept in [-clamp, clamp], so a cell can change its state quickly.
+        margin:             in cells. The grid scrolls when the robot is closer than margin to a border.
+
+    Note:
+        The first axis of the grid is x (the heading of the robot when the pose is (0, 0, 0)) and the second axis is y.
+        The angles are in degree, anti-clockwise, 0 is the heading of the robot: the positions of the radar. The rays
+        start at the center of the cell of the robot, so the positions are exact to half a cell.
+    """
+    def __init__(self, cell_size=0.05, size=200, max_range=4., angle_resolution=1., log_odds_occupied=0.85, log_odds_free=-0.4,
+                 clamp=4., margin=None):
+        assert cell_size > 0 and size > 0 and max_range > 0 and angle_resolution > 0
+        self._cell_size = cell_size
+        self._size = size
+        self._max_range = max_range
+        self._angle_resolution = angle_resolution
+        self._log_odds_occupied = log_odds_occupied
+        self._log_odds_free = log_odds_free
+        self._clamp = clamp
+        self._margin = margin if margin is not None else size // 4
+
+        self._grid = np.zeros((size, size), dtype=np.float32)
+
+        # the pose of the robot in the world (meter, meter, degree) and the world position of the corner of cell (0, 0)
+        self._pose = (0., 0., 0.)
+        self._origin = (-size // 2 * cell_size, -size // 2 * cell_size)
+        self._robot_cell = (size // 2, size // 2)
+
+        self._build_tables()
+
+    def _build_tables(self):
+        n_angles = int(round(360. / self._angle_resolution))
+        theta = np.deg2rad(np.arange(n_angles) * self._angle_resolution)
+        self._n_angles = n_angles
+        self._cos = np.cos(theta)
+        self._sin = np.sin(theta)
+
+        # sample each ray every half cell, and keep each cell once, at the range where the ray enters it
+        step = self._cell_size / 2.
+        ranges = (np.arange(int(math.ceil(self._max_range / step))) + 0.5) * step
+        di = np.rint(np.outer(self._cos, ranges) / self._cell_size).astype(np.int32)
+        dj = np.rint(np.outer(self._sin, ranges) / self._cell_size).astype(np.int32)
+        new_cell = np.ones(di.shape, dtype=bool)
+        new_cell[:, 1:] = (di[:, 1:] != di[:, :-1]) | (dj[:, 1:] != dj[:, :-1])
+
+        length = new_cell.sum(axis=1).max()
+        self._ray_di = np.zeros((n_angles, length), dtype=np.int32)
+        self._ray_dj = np.zeros((n_angles, length), dtype=np.int32)
+        # the padding of the short rays is never free: its range is infinite
+        self._ray_range = np.full((n_angles, length), np.inf)
+        for a in range(n_angles):
+            cells = np.flatnonzero(new_cell[a])
+            self._ray_di[a, :cells.size] = di[a, cells]
+            self._ray_dj[a, :cells.size] = dj[a, cells]
+            self._ray_range[a, :cells.size] = ranges[cells]
+
+    def _angle_index(self, angles):
+        return np.rint((np.asarray(angles, dtype=np.float64) + self._pose[2]) / self._angle_resolution).astype(np.int64) % self._n_angles
+
+    def update(self, angles, distances):
+        """
+        Integrate readings taken from the current pose, e.g. a whole sweep of the radar.
+
+        Args:
+            angles:    the positions of the radar (in degree) of the readings.
+            distances: the distances (in meter). The failed readings (NaN) are ignored.
+        """
+        d = np.asarray(distances, dtype=np.float64)
+        valid = ~np.isnan(d) & (d > 0)
+        if not valid.any():
+            return
+        a = self._angle_index(np.asarray(angles)[valid])
+        d = d[valid]
+        ri, rj = self._robot_cell
+        size = self._size
+
+        # the cells of the rays before the obstacle are free
+        free = self._ray_range[a] < (np.minimum(d, self._max_range) - self._cell_size / 2.)[:, None]
+        fi = ri + self._ray_di[a][free]
+        fj = rj + self._ray_dj[a][free]
+
+        # the cell of the obstacle
+        hit = d < self._max_range
+        hi = ri + np.rint(d[hit] * self._cos[a[hit]] / self._cell_size).astype(np.int64)
+        hj = rj + np.rint(d[hit] * self._sin[a[hit]] / self._cell_size).astype(np.int64)
+
+        i = np.concatenate((fi, hi))
+        j = np.concatenate((fj, hj))
+        weights = np.concatenate((np.full(fi.size, self._log_odds_free), np.full(hi.size, self._log_odds_occupied)))
+        inside = (i >= 0) & (i < size) & (j >= 0) & (j < size)
+        cells = i[inside] * size + j[inside]
+        if cells.size == 0:
+            return
+
+        # only the span of the touched cells is updated
+        first, last = cells.min(), cells.max() + 1
+        flat = self._grid.reshape(-1)[first:last]
+        flat += np.bincount(cells - first, weights=weights[inside], minlength=last - first).astype(np.float32)
+        np.clip(flat, -self._clamp, self._clamp, out=flat)
+
+    def move_to(self, x, y, heading=0.):
+        """
+        Set the pose of the robot in the world: the position (in meter) and the heading (in degree, anti-clockwise).
+        The grid scrolls if the robot gets too close to a border.
+        """
+        self._pose = (x, y, heading)
+        ci, cj = self.world_to_cell(x, y)
+        low, high = self._margin, self._size - self._margin
+        if not (low <= ci < high and low <= cj < high):
+            # recenter the robot
+            center = self._size // 2
+            self.scroll(ci - center, cj - center)
+            ci, cj = self.world_to_cell(x, y)
+        self._robot_cell = (ci, cj)
+
+    def scroll(self, si, sj):
+        """
+        Move the window by si cells along x and sj cells along y. The cells that leave the window are forgotten and the
+        new cells are unknown (log-odds 0).
+        """
+        size = self._size
+        grid = self._grid
+        if abs(si) >= size or abs(sj) >= size:
+            grid[:] = 0.
+        else:
+            src_i = slice(max(si, 0), size + min(si, 0))
+            dst_i = slice(max(-si, 0), size + min(-si, 0))
+            src_j = slice(max(sj, 0), size + min(sj, 0))
+            dst_j = slice(max(-sj, 0), size + min(-sj, 0))
+            grid[dst_i, dst_j] = grid[src_i, src_j].copy()
+            if si > 0:
+                grid[size - si:, :] = 0.
+            elif si < 0:
+                grid[:-si, :] = 0.
+            if sj > 0:
+                grid[:, size - sj:] = 0.
+            elif sj < 0:
+                grid[:, :-sj] = 0.
+
+        self._origin = (self._origin[0] + si * self._cell_size, self._origin[1] + sj * self._cell_size)
+        self._robot_cell = (self._robot_cell[0] - si, self._robot_cell[1] - sj)
+
+    def _match_evidence(self):
+        # the positive log-odds, and half of them in the neighbour cells, so a point one cell away from an obstacle
+        # still counts
+        evidence = np.maximum(self._grid, 0.)
+        padded = np.pad(evidence, 1)
+        size = self._size
+        near = np.max([padded[di:di + size, dj:dj + size] for di in range(3) for dj in range(3)], axis=0)
+        return np.maximum(evidence, 0.5 * near)
+
+    def match(self, points, pose, window=(0.1, 0.1, 6.), steps=(9, 9, 7), min_points=20, min_score=1., min_gain=0.2):
+        """
+        Search the pose that best fits points on the obstacles of the grid (correlative scan matching). The candidate
+        poses are a regular lattice in a window around pose. The score of a candidate is the mean positive log-odds of
+        the cells of the points (half of it for a cell next to an obstacle), once the points are moved with the robot
+        from pose to the candidate.
+
+        Args:
+            points:     the (x, y) in meter of the obstacles seen by the radar, as an array of shape (n, 2). Their
+                        positions are computed from pose, e.g. the endpoints of the readings.
+            pose:       the (x, y, heading in degree) the points are computed from.
+            window:     the half size of the search window along x and y (in meter) and of the heading (in degree).
+            steps:      the number of candidates along each axis of the window. Odd, so pose is a candidate.
+            min_points: the match is not tried with fewer points.
+            min_score:  the match is rejected if the best score is lower.
+            min_gain:   pose is kept unless the best score beats its score by this much, so the noise of the points does
+                        not move a good pose.
+
+        Return:
+            The best (x, y, heading) and its score, or None if there is no good match.
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        if len(points) < min_points:
+            return None
+        x, y, heading = pose
+        dx = np.linspace(-window[0], window[0], steps[0])
+        dy = np.linspace(-window[1], window[1], steps[1])
+        dh = np.deg2rad(np.linspace(-window[2], window[2], steps[2]))
+
+        # the points rotated around the robot for each heading: (headings, points)
+        rx, ry = points[:, 0] - x, points[:, 1] - y
+        cos, sin = np.cos(dh)[:, None], np.sin(dh)[:, None]
+        px = x + cos * rx - sin * ry - self._origin[0]
+        py = y + sin * rx + cos * ry - self._origin[1]
+
+        # then translated: (headings, x, y, points)
+        i = np.floor((px[:, None, None, :] + dx[None, :, None, None]) / self._cell_size).astype(np.int64)
+        j = np.floor((py[:, None, None, :] + dy[None, None, :, None]) / self._cell_size).astype(np.int64)
+        inside = (i >= 0) & (i < self._size) & (j >= 0) & (j < self._size)
+        evidence = self._match_evidence()[np.clip(i, 0, self._size - 1), np.clip(j, 0, self._size - 1)]
+        score = np.where(inside, evidence, 0.).mean(axis=-1)
+
+        h, bi, bj = np.unravel_index(np.argmax(score), score.shape)
+        if score[h, bi, bj] < min_score:
+            return None
+        # pose is kept when it is about as good as the best candidate, e.g. along a wall
+        center = tuple(n // 2 for n in steps)
+        if score[center] >= score[h, bi, bj] - min_gain:
+            h, bi, bj = center
+        return (x + dx[bi], y + dy[bj], heading + math.degrees(dh[h])), float(score[h, bi, bj])
+
+    def reset(self):
+        self._grid[:] = 0.
+
+    def world_to_cell(self, x, y):
+        """
+        The cell (i, j) of a world position. It can be outside the grid.
+        """
+        return int(math.floor((x - self._origin[0]) / self._cell_size)), int(math.floor((y - self._origin[1]) / self._cell_size))
+
+    @property
+    def log_odds(self):
+        return self._grid
+
+    @property
+    def probability(self):
+        """
+        The probability that each cell is occupied. 0.5 for the unknown cells.
+        """
+        return 1. - 1. / (1. + np.exp(self._grid))
+
+    @property
+    def origin(self):
+        """
+        The world position (in meter) of the corner of the cell (0, 0).
+        """
+        return self._origin
+
+    @property
+    def pose(self):
+        return self._pose
+
+    @property
+    def robot_cell(self):
+        return self._robot_cell
+
+    @property
+    def cell_size(self):
+        return self._cell_size
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def max_range(self):
+        return self._max_range
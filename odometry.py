@@ -0,0 +1,331 @@
+"""
+Pose of the robot from the wheel messages (dead reckoning), corrected by the radar with an extended Kalman filter.
+"""
+import math
+
+import numpy as np
+
+from clock import NS_PER_SECOND
+from components import WheelComponent, DifferentialDriveComponent
+from controller import Status
+from records import make_dtype, to_array
+
+
+def _wrap(angle):
+    # angle in radian, wrapped to [-pi, pi)
+    return (angle + math.pi) % (2 * math.pi) - math.pi
+
+
+
+class WheelModel:
+    """
+    Speed of a wheel as a function of its pulse. The speed is proportional to the deviation of the pulse from the
+    reference pulse, like WheelComponent.set_speed.
+
+    Args of __init__:
+        reference_pulse:     the pulse (in second) that makes the wheel still.
+        max_pulse_deviation: the deviation of the pulse at full speed.
+        mirror:              bool. See WheelComponent. A longer pulse moves the robot backward.
+        max_speed:           the speed (in m/s) of the wheel at full speed.
+        deadband:            the deviation of the pulse below which the wheel does not move.
+        width:               the silence (in second) after each pulse. See WheelMotor.
+    """
+    def __init__(self, reference_pulse, max_pulse_deviation, mirror=False, max_speed=0.2, deadband=0., width=0.020):
+        self._reference_pulse = reference_pulse
+        self._max_pulse_deviation = max_pulse_deviation
+        self._direction = -1. if mirror else 1.
+        self._max_speed = max_speed
+        self._deadband = deadband
+        self._width = width
+
+    @classmethod
+    def from_component(cls, wheel, max_speed=0.2, deadband=0.):
+        """
+        The model calibrated from the parameters of a WheelComponent.
+        """
+        return cls(wheel.reference_pulse, wheel.max_pulse_deviation, mirror=wheel.mirror, max_speed=max_speed, deadband=deadband)
+
+    def speed(self, pulse):
+        """
+        The speed (m/s, positive forward) of the wheel for an array of pulses.
+        """
+        deviation = np.asarray(pulse, dtype=np.float64) - self._reference_pulse
+        scale = np.clip(deviation / self._max_pulse_deviation, -1., 1.)
+        return np.where(np.abs(deviation) < self._deadband, 0., self._direction * self._max_speed * scale)
+
+    def duration(self, pulse, repeat):
+        """
+        The duration (in second) of a cycle of repeat pulses.
+        """
+        return np.asarray(repeat) * (np.asarray(pulse) + self._width)
+
+
+
+class Odometry(Status):
+    """
+    Pose (x, y, heading) of a differential-drive robot, integrated from the messages of the wheels.
+
+    A wheel message is sent after a cycle of repeat pulses, so the wheel turned at the speed of its pulse during the
+    cycle that ends at the timestamp of the message. The messages of the two wheels are merged on a common timeline and
+    the pose is integrated over all the intervals at once (cumulative sums), so a batch of messages costs a few array
+    operations. The covariance of the pose is propagated with the same intervals and the radar corrects the pose
+    (extended Kalman filter): observe_pose with a pose found by scan matching (see OccupancyGrid.match, called by the
+    Controller) and observe_landmark with a range and bearing to a landmark whose position is known.
+
+    The status follows Status:
+        update(wheel, msgs):    queue a batch of messages of 'left' or 'right' (a structured array of the WheelComponent
+                                FORMAT or a list of tuples), or of 'drive' (DifferentialDriveComponent FORMAT).
+        compute_current_param:  integrate the queued messages. current holds x, y (meter), heading (degree),
+                                v (m/s), omega (degree/s) and timestamp (clock.now_ns).
+        rotate:                 current becomes last.
+
+    Args of __init__:
+        left:             WheelModel of the left wheel.
+        right:            WheelModel of the right wheel.
+        track_width:      the distance (in meter) between the wheels.
+        pose:             the initial (x, y, heading in degree).
+        distance_noise:   variance (m^2) of the travelled distance, per meter.
+        heading_noise:    variance (rad^2) of the heading, per radian of rotation.
+        slip_noise:       variance (rad^2) of the heading, per meter.
+        max_pending:      the number of cycles of a wheel kept while waiting for the messages of the other wheel.
+
+    Note:
+        The pose is integrated up to the last message of the slowest wheel; the later cycles of the other wheel wait
+        for the next messages.
+    """
+    LEFT  = 'left'
+    RIGHT = 'right'
+    DRIVE = 'drive'
+
+    def __init__(self, left=None, right=None, track_width=0.15, pose=(0., 0., 0.), distance_noise=0.002, heading_noise=0.01,
+                 slip_noise=0.005, max_pending=1024):
+        assert left is not None and right is not None and track_width > 0
+        x, y, heading = pose
+        super(Odometry, self).__init__(('x', x), ('y', y), ('heading', heading), ('v', 0.), ('omega', 0.), ('timestamp', None))
+        self._current = dict(self._last)
+
+        self._models = {Odometry.LEFT: left, Odometry.RIGHT: right}
+        self._track_width = track_width
+        self._distance_noise = distance_noise
+        self._heading_noise = heading_noise
+        self._slip_noise = slip_noise
+        self._max_pending = max_pending
+
+        # EKF state: x, y, heading (radian) and its covariance
+        self._state = np.array([x, y, math.radians(heading)])
+        self._cov = np.zeros((3, 3))
+
+        # cycles (start, end in ns, speed) not integrated yet, and the time up to which the pose is integrated
+        self._cycles = {wheel: (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0)) for wheel in self._models}
+        self._last_end = {wheel: None for wheel in self._models}
+        self._integrated = None
+
+    def update(self, attr, val):
+        """
+        Queue the messages val of the wheel attr ('left' or 'right'), or of both wheels ('drive').
+        """
+        assert attr in self._models or attr == Odometry.DRIVE, 'Unknown wheel {}.'.format(attr)
+        if len(val) == 0:
+            return
+        if not isinstance(val, np.ndarray):
+            val = to_array(val, make_dtype(DifferentialDriveComponent.FORMAT if attr == Odometry.DRIVE else WheelComponent.FORMAT))
+        self._new.setdefault(attr, []).append(val)
+
+    def _add_messages(self, attr, msgs):
+        end = msgs['timestamp'].astype(np.int64)
+        if attr != Odometry.DRIVE:
+            duration = self._models[attr].duration(msgs['pulse'], msgs['repeat'])
+            self._add_cycles(attr, end, msgs['pulse'], (duration * NS_PER_SECOND).astype(np.int64))
+            return
+
+        # the two pulse trains share their periods, see DifferentialDriveMotor
+        left, right = msgs['left_pulse'], msgs['right_pulse']
+        duration = self._models[Odometry.LEFT].duration(np.maximum(left, right), msgs['repeat'])
+        duration = (duration * NS_PER_SECOND).astype(np.int64)
+        self._add_cycles(Odometry.LEFT, end, left, duration)
+        self._add_cycles(Odometry.RIGHT, end, right, duration)
+
+    def _add_cycles(self, wheel, end, pulse, duration):
+        model = self._models[wheel]
+
+        # a cycle starts at the end of the previous one, unless the wheel loop was interrupted
+        previous = np.empty_like(end)
+        previous[0] = self._last_end[wheel] if self._last_end[wheel] is not None else end[0] - duration[0]
+        previous[1:] = end[:-1]
+        start = np.maximum(previous, end - duration)
+        self._last_end[wheel] = int(end[-1])
+
+        starts, ends, speeds = self._cycles[wheel]
+        self._cycles[wheel] = (np.concatenate((starts, start))[-self._max_pending:],
+                               np.concatenate((ends, end))[-self._max_pending:],
+                               np.concatenate((speeds, model.speed(pulse)))[-self._max_pending:])
+
+    def _speed_at(self, wheel, t):
+        # speed of the wheel at the times t: the speed of the cycle that contains t, 0 between the cycles
+        starts, ends, speeds = self._cycles[wheel]
+        i = np.searchsorted(ends, t, side='right')
+        inside = i < ends.size
+        i = np.minimum(i, ends.size - 1)
+        inside &= starts[i] <= t
+        return np.where(inside, speeds[i], 0.)
+
+    def compute_current_param(self):
+        """
+        Integrate the messages queued by update. Return the current status.
+        """
+        for attr, batches in self._new.items():
+            for msgs in batches:
+                self._add_messages(attr, msgs)
+        self._new = {}
+
+        left_end, right_end = self._last_end[Odometry.LEFT], self._last_end[Odometry.RIGHT]
+        if left_end is None or right_end is None:
+            return self._current
+        horizon = min(left_end, right_end)
+        if self._integrated is None:
+            self._integrated = min(self._cycles[Odometry.LEFT][0][0], self._cycles[Odometry.RIGHT][0][0])
+        if horizon <= self._integrated:
+            return self._current
+
+        # the timeline of both wheels between the last integration and the horizon
+        bounds = np.concatenate([np.concatenate(self._cycles[wheel][:2]) for wheel in self._models])
+        bounds = np.unique(np.clip(bounds, self._integrated, horizon))
+        if bounds.size < 2:
+            bounds = np.array([self._integrated, horizon])
+        mid = (bounds[:-1] + bounds[1:]) // 2
+        dt = np.diff(bounds) / NS_PER_SECOND
+        v_left, v_right = self._speed_at(Odometry.LEFT, mid), self._speed_at(Odometry.RIGHT, mid)
+
+        self._integrate(0.5 * (v_left + v_right) * dt, (v_right - v_left) / self._track_width * dt)
+
+        # the cycles that end before the horizon are done
+        for wheel in self._models:
+            starts, ends, speeds = self._cycles[wheel]
+            keep = ends > horizon
+            self._cycles[wheel] = (starts[keep], ends[keep], speeds[keep])
+        self._integrated = horizon
+
+        x, y, theta = self._state
+        span = (bounds[-1] - bounds[0]) / NS_PER_SECOND
+        current = dict(self._current)
+        current.update({'x': x, 'y': y, 'heading': math.degrees(theta), 'timestamp': int(horizon),
+                        'v': 0.5 * (v_left[-1] + v_right[-1]) if span > 0 else 0.,
+                        'omega': math.degrees((v_right[-1] - v_left[-1]) / self._track_width) if span > 0 else 0.})
+        self._current = current
+        return current
+
+    def _integrate(self, ds, dtheta):
+        """
+        Move the state by the distances ds and rotations dtheta of consecutive intervals, and propagate the covariance.
+        """
+        x, y, theta = self._state
+        headings = theta + np.concatenate(([0.], np.cumsum(dtheta)))
+        # the displacement of an interval follows the heading in the middle of the interval
+        mid = headings[:-1] + 0.5 * dtheta
+        cos, sin = np.cos(mid), np.sin(mid)
+        dx, dy = ds * cos, ds * sin
+
+        # The Jacobian of an interval w.r.t. the state is I + u e3^T with u = (-dy, dx, 0), so the Jacobian from the
+        # interval k to the end is I + S_k e3^T where S_k is the sum of the u of the later intervals.
+        u = np.stack((-dy, dx, np.zeros_like(dx)), axis=1)
+        total = u.sum(axis=0)
+        suffix = total - np.cumsum(u, axis=0)
+
+        n = ds.size
+        G = np.broadcast_to(np.eye(3), (n, 3, 3)).copy()
+        G[:, :, 2] += suffix
+        # the noise of an interval: along the heading for the distance, on the heading for the rotation and the slip
+        J = np.zeros((n, 3, 2))
+        J[:, 0, 0], J[:, 1, 0], J[:, 2, 1] = cos, sin, 1.
+        noise = np.zeros((n, 2, 2))
+        noise[:, 0, 0] = self._distance_noise * np.abs(ds)
+        noise[:, 1, 1] = self._heading_noise * np.abs(dtheta) + self._slip_noise * np.abs(ds)
+        GJ = np.einsum('nij,njk->nik', G, J)
+
+        F = np.eye(3)
+        F[:, 2] += total
+        self._cov = F @ self._cov @ F.T + np.einsum('nij,njk,nlk->il', GJ, noise, GJ)
+        self._state = np.array([x + dx.sum(), y + dy.sum(), _wrap(headings[-1])])
+
+    def observe_landmark(self, landmark, distance, angle, sigma_distance=0.03, sigma_angle=3., gate=9.21):
+        """
+        Correct the pose with a radar reading of a landmark whose position is known.
+
+        Args:
+            landmark:       the (x, y) of the landmark, in meter.
+            distance:       the measured distance, in meter.
+            angle:          the position of the radar (in degree, relative to the heading) of the reading.
+            sigma_distance: the standard deviation of the distance, in meter.
+            sigma_angle:    the standard deviation of the angle, in degree.
+            gate:           the reading is rejected if its Mahalanobis distance (squared) is larger. The default is the
+                            99% quantile of the chi-square distribution with 2 degrees of freedom.
+
+        Return:
+            True if the reading was used.
+        """
+        x, y, theta = self._state
+        dx, dy = landmark[0] - x, landmark[1] - y
+        q = dx * dx + dy * dy
+        r = math.sqrt(q)
+        if r < 1e-6:
+            return False
+
+        H = np.array([[-dx / r, -dy / r, 0.], [dy / q, -dx / q, -1.]])
+        innovation = np.array([distance - r, _wrap(math.radians(angle) - (math.atan2(dy, dx) - theta))])
+        R = np.diag([sigma_distance ** 2, math.radians(sigma_angle) ** 2])
+        return self._correct(innovation, H, R, gate)
+
+    def observe_pose(self, pose, sigma_position=0.02, sigma_heading=1.5, gate=11.34):
+        """
+        Correct the pose with a measurement of the whole pose, e.g. the result of a scan matching.
+
+        Args:
+            pose:           the measured (x, y, heading in degree).
+            sigma_position: the standard deviation of x and y, in meter.
+            sigma_heading:  the standard deviation of the heading, in degree.
+            gate:           the measurement is rejected if its Mahalanobis distance (squared) is larger. The default is
+                            the 99% quantile of the chi-square distribution with 3 degrees of freedom.
+
+        Return:
+            True if the measurement was used.
+        """
+        x, y, theta = self._state
+        innovation = np.array([pose[0] - x, pose[1] - y, _wrap(math.radians(pose[2]) - theta)])
+        R = np.diag([sigma_position ** 2, sigma_position ** 2, math.radians(sigma_heading) ** 2])
+        return self._correct(innovation, np.eye(3), R, gate)
+
+    def _correct(self, innovation, H, R, gate):
+        # the update step of the EKF
+        S = H @ self._cov @ H.T + R
+        S_inv = np.linalg.inv(S)
+        if innovation @ S_inv @ innovation > gate:
+            return False
+
+        K = self._cov @ H.T @ S_inv
+        self._state = self._state + K @ innovation
+        self._state[2] = _wrap(self._state[2])
+        I_KH = np.eye(3) - K @ H
+        # Joseph form, it keeps the covariance symmetric and positive
+        self._cov = I_KH @ self._cov @ I_KH.T + K @ R @ K.T
+
+        current = dict(self._current)
+        current.update({'x': self._state[0], 'y': self._state[1], 'heading': math.degrees(self._state[2])})
+        self._current = current
+        return True
+
+    def rotate(self):
+        self._last = dict(self._current)
+
+    @property
+    def pose(self):
+        """
+        The current (x, y, heading in degree).
+        """
+        return self._state[0], self._state[1], math.degrees(self._state[2])
+
+    @property
+    def covariance(self):
+        """
+        The covariance of (x, y, heading in radian).
+        """
+        return self._cov
@@ -0,0 +1,266 @@
+"""
+Obstacle avoidance with a Vector Field Histogram (VFH+).
+
+The distance map gives the distance of the closest obstacle seen at each position of the radar (one bin per degree). An
+obstacle at distance d in bin j has the magnitude m = 1 - d / max_range and is enlarged by the radius of the robot plus a
+safety distance: it covers the bins j - g .. j + g with g = asin((radius + safety) / d). The polar histogram of a
+direction is the sum of the magnitudes that cover it, so a direction is blocked when the robot would touch an obstacle
+by driving along it.
+
+The decision of a tick:
+    1. the bins of the distance map that changed since the last tick are found with one comparison, and only their
+       contributions are removed from and added to the histogram (a difference array and a cumulative sum).
+    2. the histogram is smoothed by a small triangular window (VFH).
+    3. it is thresholded with hysteresis (VFH+): a direction becomes blocked above threshold_high and free again below
+       threshold_low, so the openings do not flicker with the noise of the readings.
+    4. the candidate directions are taken from the openings (the sides of the wide ones, the center of the narrow ones
+       and the target if it is free) and the one of lowest cost is chosen (VFH+). The cost weighs the deviation from the
+       target, the size of the turn and the change from the previous direction.
+    5. the direction and the density ahead give the speed of the two wheels. A command is sent to the engine only when
+       the speeds change enough, since each command interrupts the pulse trains of the wheels.
+"""
+import time
+
+import numpy as np
+
+from metrics import Metrics
+
+
+class VFHPlanner:
+    """
+    Policy of the Controller that steers the robot away from the obstacles of the distance map.
+
+    The planner is called by the decision stage of the controller: planner(controller) returns the engine commands of
+    the tick. It does nothing until engage is called.
+
+    Args of __init__:
+        max_range:       in meter. The obstacles further away are ignored.
+        robot_radius:    in meter. The radius of the circle around the robot.
+        safety:          in meter. The distance kept between the robot and the obstacles.
+        smoothing:       the half width (in bins) of the smoothing window.
+        threshold_low:   the density below which a blocked direction becomes free.
+        threshold_high:  the density above which a free direction becomes blocked.
+        wide_opening:    in bins. The openings wider than this have two candidate directions, one on each side.
+        target:          in degree. The direction the robot goes to when it is free, relative to the heading.
+        weights:         the weights (target, turn, previous) of the cost of a candidate direction.
+        speed:           the scale of the wheel speed when the way is free, see WheelComponent.set_speed.
+        turn_gain:       the difference of scale between the wheels for a direction at 90 degrees.
+        spin_scale:      the scale of the wheels when all the directions are blocked: the robot turns in place.
+        min_change:      the engine is only commanded when the scale of a wheel changes by more than this.
+        budget:          in second. The decisions that take longer are counted in the metrics (over_budget).
+        refresh:         the histogram is recomputed from scratch every refresh decisions, so the rounding errors of the
+                         incremental updates do not accumulate.
+    """
+    def __init__(self, max_range=1.5, robot_radius=0.1, safety=0.05, smoothing=2, threshold_low=0.25, threshold_high=0.5,
+                 wide_opening=16, target=0., weights=(5., 2., 2.), speed=0.5, turn_gain=0.4, spin_scale=0.3, min_change=0.05,
+                 budget=0.005, refresh=1000):
+        assert max_range > 0 and robot_radius >= 0 and safety >= 0 and smoothing >= 0
+        assert 0 <= threshold_low <= threshold_high
+        self._max_range = max_range
+        self._clearance = robot_radius + safety
+        self._threshold_low = threshold_low
+        self._threshold_high = threshold_high
+        self._wide_opening = wide_opening
+        self._target = target
+        self._weights = weights
+        self._speed = speed
+        self._turn_gain = turn_gain
+        self._spin_scale = spin_scale
+        self._min_change = min_change
+        self._budget_ns = int(budget * 1e9)
+        self._refresh = refresh
+
+        # triangular window, normalized
+        window = np.concatenate((np.arange(1, smoothing + 2), np.arange(smoothing, 0, -1))).astype(np.float64)
+        self._window = window / window.sum()
+
+        self._engaged = False
+        self._metrics = Metrics('planner', counters=('decisions', 'commands', 'over_budget'), gauges=('direction',), histograms=('decide',))
+        self.reset()
+
+    def reset(self):
+        """
+        Forget the histogram and the previous decision.
+        """
+        self._distance = None
+        self._histogram = None
+        self._blocked = None
+        self._direction = None
+        self._command = None
+        self._since_refresh = 0
+
+    def engage(self):
+        self.reset()
+        self._engaged = True
+
+    def disengage(self):
+        """
+        Stop steering. Return the engine command that stops the robot.
+        """
+        self._engaged = False
+        return ('stop', (), {})
+
+    def set_target(self, target):
+        """
+        The direction (in degree, relative to the heading) the robot should go to.
+        """
+        self._target = target
+
+    def __call__(self, controller):
+        if not self._engaged:
+            return None
+        start = time.perf_counter_ns()
+        distance_map = controller.distance_map
+        cmds = self.decide(distance_map.bins, distance_map.distance)
+
+        duration = time.perf_counter_ns() - start
+        self._metrics.histogram('decide').record(duration)
+        self._metrics.counter('decisions').incr()
+        if duration > self._budget_ns:
+            self._metrics.counter('over_budget').incr()
+        return cmds
+
+    def _contributions(self, bins, distance):
+        # the (first bin, last bin, magnitude) of the obstacles in the bins, as indices of the histogram
+        d = distance[bins]
+        inside = (d > 0) & (d < self._max_range)
+        bins, d = bins[inside], d[inside]
+        magnitude = 1. - d / self._max_range
+        half = np.rint(np.degrees(np.arcsin(np.minimum(1., self._clearance / d)))).astype(np.int64)
+        n = distance.size
+        return np.maximum(bins - half, 0), np.minimum(bins + half, n - 1), magnitude
+
+    def _add(self, delta, first, last, magnitude, sign):
+        np.add.at(delta, first, sign * magnitude)
+        np.add.at(delta, last + 1, -sign * magnitude)
+
+    def update_histogram(self, distance):
+        """
+        Update the polar histogram with the distances (in meter, NaN if unknown) of the bins of the distance map. Only
+        the bins that changed since the last update are processed. Return the histogram.
+        """
+        distance = np.asarray(distance, dtype=np.float64)
+        n = distance.size
+        if self._distance is None or self._distance.size != n or self._since_refresh >= self._refresh:
+            self._distance = np.full(n, np.nan)
+            self._histogram = np.zeros(n)
+            self._since_refresh = 0
+        self._since_refresh += 1
+
+        old = self._distance
+        changed = np.flatnonzero((old != distance) & ~(np.isnan(old) & np.isnan(distance)))
+        if changed.size == 0:
+            return self._histogram
+
+        delta = np.zeros(n + 1)
+        self._add(delta, *self._contributions(changed, old), sign=-1.)
+        self._add(delta, *self._contributions(changed, distance), sign=1.)
+        self._histogram += np.cumsum(delta[:-1])
+        # the rounding errors can leave tiny negative densities
+        np.maximum(self._histogram, 0., out=self._histogram)
+        old[changed] = distance[changed]
+        return self._histogram
+
+    def _threshold(self, density):
+        # binary histogram with hysteresis
+        if self._blocked is None or self._blocked.size != density.size:
+            self._blocked = density > self._threshold_high
+        else:
+            self._blocked = np.where(density > self._threshold_high, True, np.where(density < self._threshold_low, False, self._blocked))
+        return self._blocked
+
+    def _candidates(self, angles, blocked):
+        # the free openings: runs of free bins
+        free = np.concatenate(([False], ~blocked, [False]))
+        edges = np.flatnonzero(free[1:] != free[:-1])
+        starts, ends = edges[0::2], edges[1::2] - 1
+
+        candidates = []
+        half = self._wide_opening // 2
+        target = self._target
+        for first, last in zip(starts, ends):
+            if last - first + 1 > self._wide_opening:
+                candidates.append(angles[first + half])
+                candidates.append(angles[last - half])
+                if angles[first + half] < target < angles[last - half]:
+                    candidates.append(target)
+            else:
+                candidates.append(angles[(first + last) // 2])
+        return np.array(candidates, dtype=np.float64)
+
+    def choose_direction(self, angles, density):
+        """
+        The direction (in degree) of lowest cost among the free directions. None if all the directions are blocked.
+        """
+        candidates = self._candidates(angles, self._threshold(density))
+        if candidates.size == 0:
+            return None
+        w_target, w_turn, w_previous = self._weights
+        previous = self._direction if self._direction is not None else self._target
+        cost = w_target * np.abs(candidates - self._target) + w_turn * np.abs(candidates) + w_previous * np.abs(candidates - previous)
+        return float(candidates[np.argmin(cost)])
+
+    def decide(self, angles, distance):
+        """
+        The engine commands for a distance map.
+
+        Args:
+            angles:   the positions of the bins of the distance map, in degree (consecutive).
+            distance: the distance of each bin, in meter. NaN if unknown.
+
+        Return:
+            A list of engine commands (method_name, args, kwargs). Empty if the current command is still good.
+        """
+        angles = np.asarray(angles)
+        histogram = self.update_histogram(distance)
+        density = np.convolve(histogram, self._window, mode='same')
+        direction = self.choose_direction(angles, density)
+
+        if direction is None:
+            # turn in place, towards the side with fewer obstacles
+            middle = np.searchsorted(angles, 0)
+            turn = 1. if density[middle:].sum() < density[:middle].sum() else -1.
+            left, right = -turn * self._spin_scale, turn * self._spin_scale
+        else:
+            # slow down when the way is obstructed
+            i = int(np.clip(np.rint(direction - angles[0]), 0, angles.size - 1))
+            speed = self._speed * (1. - min(density[i], self._threshold_high) / self._threshold_high * 0.5)
+            turn = self._turn_gain * max(-1., min(1., direction / 90.))
+            left, right = max(-1., min(1., speed - turn)), max(-1., min(1., speed + turn))
+            self._metrics.gauge('direction').set(int(round(direction)))
+        self._direction = direction
+
+        if self._command is not None and abs(left - self._command[0]) <= self._min_change and abs(right - self._command[1]) <= self._min_change:
+            return []
+        self._command = (float(left), float(right))
+        self._metrics.counter('commands').incr()
+        return [('set_speed', self._command, {})]
+
+    @property
+    def histogram(self):
+        """
+        The polar histogram (before smoothing).
+        """
+        return self._histogram
+
+    @property
+    def blocked(self):
+        """
+        The blocked directions of the last decision.
+        """
+        return self._blocked
+
+    @property
+    def direction(self):
+        """
+        The direction (in degree) chosen by the last decision. None if all the directions were blocked.
+        """
+        return self._direction
+
+    @property
+    def engaged(self):
+        return self._engaged
+
+    @property
+    def metrics(self):
+        return self._metrics
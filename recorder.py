@@ -0,0 +1,471 @@
+"""
+Flight recorder of the component streams, and their replay.
+
+A ContinuousComponentWrapper created with a record_dir writes the messages of its component and the commands it
+executes to two append-only files in that directory (<name>.out.rec and <name>.cmd.rec). The messages are fixed-size
+records (see records.py), so a file is a header followed by the records, memory-mapped by the writer and by the
+readers. A recording can be read while it is written: the number of records is published in the header after the
+records are written.
+
+A Replayer feeds the recorded messages back to the consumers (RawDataHandler, DistanceMap, Controller) through queues
+that behave like the output queues of the components, at the recorded speed, N times faster or as fast as possible.
+
+Replay a drive into the controller and print the distance map:
+    python recorder.py RECORD_DIR [SPEED]       # SPEED is a factor (default 1) or max
+"""
+import glob
+import json
+import mmap
+import os
+import pickle
+import struct
+import sys
+import time
+
+import numpy as np
+
+from clock import now_ns, to_ns, to_seconds
+from records import to_array
+
+
+MAGIC = b'AUTOCARREC01'
+HEADER_SIZE = 4096
+# magic, number of records, length of the JSON metadata
+HEADER = struct.Struct('<12sQI')
+COUNT_OFFSET = 12
+
+OUTPUT = 'out'
+COMMANDS = 'cmd'
+
+# the commands are stored in fixed-size records, see CommandRecorder
+MAX_COMMAND_SIZE = 128
+COMMAND_DTYPE = np.dtype([('timestamp', np.int64), ('size', np.uint16), ('pickled', np.bool_), ('payload', np.uint8, (MAX_COMMAND_SIZE,))])
+
+
+def stream_path(directory, name, kind):
+    return os.path.join(directory, '{}.{}.rec'.format(name, kind))
+
+
+
+class Recorder:
+    """
+    Append-only memory-mapped file of fixed-size records.
+
+    Args of __init__:
+        path:          the path of the file. An existing file is replaced.
+        dtype:         the structured dtype of the records, see records.make_dtype.
+        meta:          dict. Saved as JSON in the header, e.g. the name and the FORMAT of the component.
+        chunk_records: the file grows by chunk_records records at a time. It is also the step of the timestamp index of
+                       the readers, see Recording.
+
+    Note:
+        There must be a single writer. The file is truncated to its records when the recorder is closed; if the
+        process dies before, the readers still see all the published records.
+    """
+    def __init__(self, path, dtype, meta=None, chunk_records=4096):
+        assert chunk_records > 0
+        self._path = path
+        self._dtype = np.dtype(dtype)
+        self._chunk_records = chunk_records
+
+        meta = dict(meta or {})
+        meta['descr'] = self._dtype.descr
+        meta['chunk_records'] = chunk_records
+        meta_bytes = json.dumps(meta).encode()
+        assert HEADER.size + len(meta_bytes) <= HEADER_SIZE, 'The metadata does not fit in the header.'
+
+        self._file = open(path, 'w+b')
+        self._file.write(HEADER.pack(MAGIC, 0, len(meta_bytes)) + meta_bytes)
+        self._count = 0
+        self._capacity = 0
+        self._mmap = None
+        self._grow(chunk_records)
+
+    def _grow(self, capacity):
+        # the views on the old mapping are dropped before it is closed
+        self._records = None
+        self._header = None
+        if self._mmap is not None:
+            self._mmap.close()
+
+        self._file.truncate(HEADER_SIZE + capacity * self._dtype.itemsize)
+        self._mmap = mmap.mmap(self._file.fileno(), 0)
+        self._header = np.ndarray(1, dtype=np.uint64, buffer=self._mmap, offset=COUNT_OFFSET)
+        self._records = np.ndarray(capacity, dtype=self._dtype, buffer=self._mmap, offset=HEADER_SIZE)
+        self._capacity = capacity
+
+    def append(self, record):
+        """
+        Append one record, a tuple whose items follow the fields of the dtype.
+        """
+        if self._count == self._capacity:
+            self._grow(self._capacity + self._chunk_records)
+        self._records[self._count] = record
+        self._count += 1
+        self._header[0] = self._count
+
+    def extend(self, records):
+        """
+        Append a batch of records: tuples, a structured array or packed bytes (see records.to_array).
+        """
+        records = to_array(records, self._dtype)
+        n = len(records)
+        if n == 0:
+            return
+        if self._count + n > self._capacity:
+            chunks = -(-(self._count + n - self._capacity) // self._chunk_records)
+            self._grow(self._capacity + chunks * self._chunk_records)
+        self._records[self._count:self._count + n] = records
+        self._count += n
+        self._header[0] = self._count
+
+    def close(self):
+        if self._mmap is None:
+            return
+        self._records = None
+        self._header = None
+        self._mmap.flush()
+        self._mmap.close()
+        self._mmap = None
+        self._file.truncate(HEADER_SIZE + self._count * self._dtype.itemsize)
+        self._file.close()
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+
+
+class CommandRecorder(Recorder):
+    """
+    Recorder of the commands received by a component. A command is stored as its wire form (see commands.py), or
+    pickled if it is not in wire form, with the time (clock.now_ns) it was executed.
+
+    Note:
+        A command larger than MAX_COMMAND_SIZE bytes is not recorded. It is counted in skipped, so the component keeps
+        running and the gap in the recording is known.
+    """
+    def __init__(self, path, meta=None, chunk_records=256):
+        super(CommandRecorder, self).__init__(path, COMMAND_DTYPE, meta=meta, chunk_records=chunk_records)
+        self._record = np.zeros(1, dtype=COMMAND_DTYPE)
+        self._skipped = 0
+
+    def record(self, cmd, timestamp=None):
+        """
+        Record a command.
+
+        Return:
+            False if the command is too large to be recorded, True otherwise.
+        """
+        pickled = not isinstance(cmd, bytes)
+        data = pickle.dumps(cmd, pickle.HIGHEST_PROTOCOL) if pickled else cmd
+        if len(data) > MAX_COMMAND_SIZE:
+            self._skipped += 1
+            return False
+        record = self._record
+        record['timestamp'] = timestamp if timestamp is not None else now_ns()
+        record['size'] = len(data)
+        record['pickled'] = pickled
+        record['payload'][0, :len(data)] = np.frombuffer(data, dtype=np.uint8)
+        record['payload'][0, len(data):] = 0
+        self.extend(record)
+        return True
+
+    @property
+    def skipped(self):
+        """
+        The number of commands too large to be recorded.
+        """
+        return self._skipped
+
+
+
+class RecordingQueue:
+    """
+    Queue wrapper that records every message put in the queue, then forwards it. The messages are tuples, batches of
+    tuples or packed batches (see transport.BatchPublisher).
+
+    Args of __init__:
+        Q:        the queue that receives the messages.
+        recorder: a Recorder whose dtype is the dtype of the messages.
+    """
+    def __init__(self, Q, recorder):
+        self._Q = Q
+        self._recorder = recorder
+
+    def put(self, msg, block=True, timeout=None):
+        if isinstance(msg, (list, bytes, np.ndarray)):
+            self._recorder.extend(msg)
+        else:
+            self._recorder.append(msg)
+        self._Q.put(msg)
+
+    def __getattr__(self, attr):
+        return getattr(self._Q, attr)
+
+
+
+class Recording:
+    """
+    Read-only view of a recorded stream.
+
+    Args of __init__:
+        path: the path of the file written by a Recorder.
+
+    Note:
+        The records of a stream are in the order they were sent, which is the order of their timestamps. The index
+        holds the first timestamp of each chunk of chunk_records records, so between only searches the chunks that
+        contain the bounds.
+    """
+    def __init__(self, path):
+        self._path = path
+        with open(path, 'rb') as f:
+            magic, _, meta_len = HEADER.unpack(f.read(HEADER.size))
+            assert magic == MAGIC, '{} is not a recording.'.format(path)
+            self._meta = json.loads(f.read(meta_len).decode())
+        # JSON turns the tuples of the descr (and the shapes of the subarrays) into lists
+        self._dtype = np.dtype([tuple(field[:2]) + tuple(tuple(shape) for shape in field[2:]) for field in self._meta['descr']])
+        self._chunk_records = self._meta['chunk_records']
+        self.refresh()
+
+    def refresh(self):
+        """
+        Map the records published since the recording was opened.
+        """
+        with open(self._path, 'rb') as f:
+            f.seek(COUNT_OFFSET)
+            count = struct.unpack('<Q', f.read(8))[0]
+        if count == 0:
+            self._records = np.empty(0, dtype=self._dtype)
+        else:
+            self._records = np.memmap(self._path, dtype=self._dtype, mode='r', offset=HEADER_SIZE, shape=(count,))
+        self._index = self._records['timestamp'][::self._chunk_records]
+
+    def search(self, timestamp, side='left'):
+        """
+        The position of timestamp in the records, like np.searchsorted.
+        """
+        timestamps = self._records['timestamp']
+        chunk = np.searchsorted(self._index, timestamp, side=side)
+        start = max(chunk - 1, 0) * self._chunk_records
+        stop = min(chunk * self._chunk_records + 1, len(timestamps))
+        return start + int(np.searchsorted(timestamps[start:stop], timestamp, side=side))
+
+    def between(self, start_ns, end_ns):
+        """
+        The records with start_ns <= timestamp < end_ns.
+        """
+        return self._records[self.search(start_ns):self.search(end_ns)]
+
+    def commands(self):
+        """
+        The recorded commands as a list of (timestamp, command) of a command stream. The commands that are not in wire
+        form are unpickled.
+        """
+        res = []
+        for record in self._records:
+            data = record['payload'][:record['size']].tobytes()
+            res.append((int(record['timestamp']), pickle.loads(data) if record['pickled'] else data))
+        return res
+
+    def __len__(self):
+        return len(self._records)
+
+    @property
+    def records(self):
+        return self._records
+
+    @property
+    def meta(self):
+        return self._meta
+
+    @property
+    def name(self):
+        return self._meta.get('name')
+
+    @property
+    def kind(self):
+        return self._meta.get('kind')
+
+    @property
+    def start(self):
+        return int(self._records['timestamp'][0]) if len(self._records) else None
+
+    @property
+    def end(self):
+        return int(self._records['timestamp'][-1]) if len(self._records) else None
+
+
+
+class ReplayQueue:
+    """
+    Output queue of a replayed component. The recorded messages become available when the replay clock reaches their
+    timestamp. drain returns them as a structured array, like transport.SharedRingQueue.drain.
+    """
+    def __init__(self, recording):
+        self._recording = recording
+        self._read = 0
+        self._available = 0
+
+    def advance(self, timestamp):
+        """
+        Make the messages up to timestamp (included) available.
+        """
+        self._available = max(self._available, self._recording.search(timestamp, side='right'))
+
+    def drain(self, max_items=None):
+        stop = self._available if max_items is None else min(self._available, self._read + max_items)
+        out = np.array(self._recording.records[self._read:stop])
+        self._read = stop
+        return out
+
+    def qsize(self):
+        return self._available - self._read
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def done(self):
+        return self._read == len(self._recording)
+
+
+
+class ReplayedComponent:
+    """
+    Stand-in of the ContinuousComponentWrapper of a recorded component: it has the name, the FORMAT and the attributes
+    recorded in the metadata (see Component.describe), and an output_Q that replays the recorded messages.
+    """
+    def __init__(self, recording):
+        self._recording = recording
+        self._output_Q = ReplayQueue(recording)
+
+    def __getattr__(self, attr):
+        attrs = self.__dict__['_recording'].meta.get('attrs', {})
+        if attr in attrs:
+            return attrs[attr]
+        raise AttributeError(attr)
+
+    @property
+    def name(self):
+        return self._recording.name
+
+    @property
+    def FORMAT(self):
+        return tuple(self._recording.meta['fields'])
+
+    @property
+    def output_Q(self):
+        return self._output_Q
+
+    @property
+    def recording(self):
+        return self._recording
+
+
+
+class Replayer:
+    """
+    Replay the output streams of a recording directory.
+
+    Args of __init__:
+        directory: the record_dir of the wrappers.
+        speed:     the replay speed: 1. is the recorded speed, 10. is ten times faster, None is as fast as possible.
+    """
+    def __init__(self, directory, speed=1.):
+        assert speed is None or speed > 0
+        self._speed = speed
+        self._components = {}
+        self._commands = {}
+        for path in sorted(glob.glob(os.path.join(directory, '*.rec'))):
+            recording = Recording(path)
+            if recording.kind == OUTPUT:
+                self._components[recording.name] = ReplayedComponent(recording)
+            elif recording.kind == COMMANDS:
+                self._commands[recording.name] = recording
+
+        starts = [comp.recording.start for comp in self._components.values() if len(comp.recording)]
+        ends = [comp.recording.end for comp in self._components.values() if len(comp.recording)]
+        self._start = min(starts) if starts else None
+        self._end = max(ends) if ends else None
+
+    def component(self, name):
+        return self._components[name]
+
+    def advance(self, timestamp):
+        for comp in self._components.values():
+            comp.output_Q.advance(timestamp)
+
+    def run(self, controller=None, step=0.02, on_step=None):
+        """
+        Move the replay clock from the first to the last recorded message by step seconds of recorded time. At each
+        step, the messages up to the replay clock are released, then controller.tick and on_step(timestamp) are called.
+
+        Return the wall time (in second) of the replay.
+        """
+        if self._start is None:
+            return 0.
+        step_ns = to_ns(step)
+        wall_start = now_ns()
+        t = self._start
+        while t < self._end + step_ns:
+            self.advance(t)
+            if self._speed is not None:
+                # the pace of the replay follows the recorded time
+                delay = wall_start + int((t - self._start) / self._speed) - now_ns()
+                if delay > 0:
+                    time.sleep(to_seconds(delay))
+            if controller is not None:
+                controller.tick(now_ns() + (int(step_ns / self._speed) if self._speed is not None else step_ns))
+            if on_step is not None:
+                on_step(t)
+            t += step_ns
+        return to_seconds(now_ns() - wall_start)
+
+    @property
+    def components(self):
+        return dict(self._components)
+
+    @property
+    def commands(self):
+        """
+        The Recording of the commands of each component.
+        """
+        return dict(self._commands)
+
+    @property
+    def start(self):
+        return self._start
+
+    @property
+    def end(self):
+        return self._end
+
+
+
+if __name__ == '__main__':
+    # the classes of the module, not of __main__, are the ones the controller knows
+    import controller as ctl
+    import recorder
+
+    directory = sys.argv[1]
+    speed = sys.argv[2] if len(sys.argv) > 2 else '1'
+    replayer = recorder.Replayer(directory, speed=None if speed == 'max' else float(speed))
+
+    radars = {comp.recording.meta.get('class'): comp for comp in replayer.components.values()}
+    if 'ScanningRadarComponent' in radars:
+        controller = ctl.Controller(radar=radars['ScanningRadarComponent'], record_size=2000)
+    else:
+        controller = ctl.Controller(radar_base=radars['DistanceRadarBaseComponent'],
+                                    radar_distance_sensor=radars['DistanceRadarSensorComponent'], record_size=2000)
+
+    wall = replayer.run(controller)
+    print('replayed {:.1f}s of recording in {:.2f}s'.format(to_seconds(replayer.end - replayer.start), wall))
+    print(controller.stats)
+    print(controller.distance_map.series)
@@ -0,0 +1,243 @@
+"""
+Storage and wire format of the component messages.
+
+A message is a tuple whose items follow the FORMAT of the component. All the fields are numbers: the name of the
+component is interned once as a comp_id (see component_id) and the status of a reading is a code of STATUS_CODES, so a
+message maps to a fixed-size record (make_dtype, RecordCodec) and a batch of messages to a structured array.
+"""
+import struct
+
+import numpy as np
+
+
+# dtype of the known fields of the component messages. Fields that are not listed here are stored as float64.
+DEFAULT_DTYPE = np.float64
+FIELD_DTYPES = {
+    'timestamp': np.int64,      # clock.now_ns
+    'comp_id':   np.uint16,     # see component_id
+    'comp_name': 'U64',
+    'status':    np.uint8,      # see STATUS_CODES
+}
+
+
+# codes of the status field. The names are the statuses of DistanceSensor.
+STATUS_CODES = {'INIT': 0, 'SUCC': 1, 'TIMEOUT': 2, 'FAIL': 3}
+STATUS_NAMES = {code: name for name, code in STATUS_CODES.items()}
+
+
+_component_ids = {}
+_component_names = []
+
+def component_id(name):
+    """
+    The comp_id of a component name, e.g. 'DistanceRadarSensor::radar_distance_sensor'. A new name gets the next id.
+
+    Note:
+        The table lives in the process memory: the components intern their name in __init__, before the processes are
+        forked, so all the processes agree on the ids.
+    """
+    comp_id = _component_ids.get(name)
+    if comp_id is None:
+        assert len(_component_names) < np.iinfo(FIELD_DTYPES['comp_id']).max, 'Too many component names.'
+        comp_id = _component_ids[name] = len(_component_names)
+        _component_names.append(name)
+    return comp_id
+
+
+def component_name(comp_id):
+    """
+    The name of a comp_id. See component_id.
+    """
+    return _component_names[comp_id]
+
+
+def make_dtype(fields, dtypes=None):
+    """
+    Build the structured dtype used to store the messages of a component.
+
+    Args:
+        fields: tuple of field names, usually the FORMAT attribute of a component.
+        dtypes: dict. Overrides the default dtype of some fields.
+
+    Return:
+        A numpy structured dtype with one field per name in fields.
+    """
+    overrides = dtypes or {}
+    return np.dtype([(field, overrides.get(field, FIELD_DTYPES.get(field, DEFAULT_DTYPE))) for field in fields])
+
+
+
+def to_array(msgs, dtype):
+    """
+    Convert a batch of messages to a structured array in one call.
+
+    Args:
+        msgs:  a sequence of tuples (the messages), a structured array, or bytes packed by RecordCodec.
+        dtype: the structured dtype of the messages, see make_dtype.
+    """
+    if isinstance(msgs, np.ndarray):
+        return msgs if msgs.dtype == dtype else msgs.astype(dtype)
+    if isinstance(msgs, (bytes, bytearray, memoryview)):
+        return np.frombuffer(msgs, dtype=dtype)
+    if len(msgs) and not isinstance(msgs[0], tuple):
+        msgs = [tuple(msg) for msg in msgs]
+    return np.array(msgs, dtype=dtype)
+
+
+
+class RecordCodec:
+    """
+    Fixed-size binary form of the messages of a component. A message is packed with struct into the bytes of one
+    record of make_dtype(fields), so a batch of packed messages is read back as a structured array without parsing.
+
+    Args of __init__:
+        fields: tuple of field names, usually the FORMAT attribute of a component. All the fields must be numbers.
+        dtypes: dict. Overrides the default dtype of some fields. See make_dtype.
+    """
+    # struct codes of the numeric dtypes, by (kind, itemsize)
+    STRUCT_CODES = {
+        ('i', 1): 'b', ('i', 2): 'h', ('i', 4): 'i', ('i', 8): 'q',
+        ('u', 1): 'B', ('u', 2): 'H', ('u', 4): 'I', ('u', 8): 'Q',
+        ('f', 4): 'f', ('f', 8): 'd', ('b', 1): '?',
+    }
+
+    def __init__(self, fields, dtypes=None):
+        assert RecordCodec.can_pack(fields, dtypes), 'Only the messages with numeric fields can be packed.'
+        self._dtype = make_dtype(fields, dtypes)
+        # native byte order without alignment, like the structured dtype
+        self._struct = struct.Struct('=' + ''.join(RecordCodec._code(self._dtype[i]) for i in range(len(fields))))
+        assert self._struct.size == self._dtype.itemsize
+
+    @staticmethod
+    def _code(dtype):
+        return RecordCodec.STRUCT_CODES.get((dtype.kind, dtype.itemsize))
+
+    @staticmethod
+    def can_pack(fields, dtypes=None):
+        dtype = make_dtype(fields, dtypes)
+        return all(RecordCodec._code(dtype[i]) is not None for i in range(len(fields)))
+
+    def encode(self, msg):
+        """
+        The bytes of one message. The float fields do not accept None, use NaN instead.
+        """
+        return self._struct.pack(*msg)
+
+    def encode_many(self, msgs):
+        """
+        The bytes of a batch of messages (tuples or a structured array). None is converted to NaN.
+        """
+        return to_array(msgs, self._dtype).tobytes()
+
+    def decode(self, data):
+        """
+        The structured array of the packed messages in data. It is a read-only view on data.
+        """
+        return np.frombuffer(data, dtype=self._dtype)
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+    @property
+    def itemsize(self):
+        return self._dtype.itemsize
+
+
+
+class RingBuffer:
+    """
+    Fixed-capacity ring buffer backed by a preallocated numpy structured array.
+
+    Each record is stored twice, in slot i and slot i + capacity. The latest records are therefore always contiguous
+    in the underlying array and the buffer can be read in arrival order without copying.
+
+    Args of __init__:
+        fields:   tuple of field names, usually the FORMAT attribute of a component.
+        capacity: the maximum number of records kept in the buffer. The oldest records are overwritten.
+        dtypes:   dict. Overrides the default dtype of some fields. See make_dtype.
+    """
+    def __init__(self, fields, capacity=100, dtypes=None):
+        assert capacity > 0
+
+        self._dtype    = make_dtype(fields, dtypes)
+        self._capacity = capacity
+        self._buffer   = np.zeros(2 * capacity, dtype=self._dtype)
+        self._head     = 0  # slot of the next record
+        self._size     = 0
+        self._count    = 0  # total number of records appended since creation
+
+    def append(self, record):
+        """
+        Append one record. The record is a tuple whose items follow the order of the fields.
+        """
+        i = self._head
+        self._buffer[i] = record
+        self._buffer[i + self._capacity] = self._buffer[i]
+
+        self._head = i + 1 if i + 1 < self._capacity else 0
+        if self._size < self._capacity:
+            self._size += 1
+        self._count += 1
+
+    def extend(self, records):
+        """
+        Append a batch of records. records is either a structured array or a sequence of tuples.
+        """
+        records = to_array(records, self._dtype)
+
+        n = len(records)
+        if n == 0:
+            return
+
+        cap = self._capacity
+        if n >= cap:
+            # only the latest records survive
+            self._buffer[:cap] = records[n - cap:]
+            self._buffer[cap:] = self._buffer[:cap]
+            self._head = 0
+            self._size = cap
+
+        else:
+            head = self._head
+            first = min(n, cap - head)
+            self._buffer[head:head + first] = records[:first]
+            self._buffer[head + cap:head + cap + first] = records[:first]
+
+            rest = n - first
+            if rest > 0:
+                self._buffer[:rest] = records[first:]
+                self._buffer[cap:cap + rest] = records[first:]
+
+            self._head = (head + n) % cap
+            self._size = min(self._size + n, cap)
+
+        self._count += n
+
+    def clear(self):
+        self._head = 0
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def view(self):
+        """
+        The records in arrival order (oldest first). It is a view on the internal buffer and it becomes invalid
+        once new records are appended.
+        """
+        end = self._head + self._capacity
+        return self._buffer[end - self._size:end]
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    @property
+    def count(self):
+        return self._count
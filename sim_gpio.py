@@ -0,0 +1,260 @@
+"""
+Simulated implementation of the subset of the RPi.GPIO API used by the robot. The pins are connected to the world
+model of sim_world: the stepper coils turn the radar, the trigger pin sends a ping whose echo is computed from the
+room geometry, and the pulses on the wheel pins move the robot.
+
+Select it with AUTOCAR_GPIO=sim (see gpio_backend).
+"""
+import math
+import threading
+import time
+
+from sim_world import world
+
+
+BOARD = 10
+BCM   = 11
+
+OUT = 0
+IN  = 1
+
+LOW  = 0
+HIGH = 1
+
+PUD_OFF  = 20
+PUD_DOWN = 21
+PUD_UP   = 22
+
+RISING  = 31
+FALLING = 32
+BOTH    = 33
+
+# the coil states of the stepper motor, as in StepperMotor.PHASE_TABLE
+_PHASES = {
+    (1, 0, 0, 1): 0,
+    (1, 0, 0, 0): 1,
+    (1, 1, 0, 0): 2,
+    (0, 1, 0, 0): 3,
+    (0, 1, 1, 0): 4,
+    (0, 0, 1, 0): 5,
+    (0, 0, 1, 1): 6,
+    (0, 0, 0, 1): 7,
+}
+
+_config = world.config
+_stepper_pins = list(_config['stepper_pins'])
+_wheel_pins = {cfg['pin']: wheel for wheel, cfg in _config['wheels'].items()}
+
+# state of the pins, local to the process that drives them
+_mode = None
+_levels = {}
+_stepper_phase = 0     # StepperMotor starts at the first phase of the table
+_rise = {}
+_echo = (math.inf, math.inf)     # (start, end) of the current echo, in time.monotonic
+_edge_events = {}
+
+
+def setmode(mode):
+    global _mode
+    _mode = mode
+
+
+def getmode():
+    return _mode
+
+
+def setwarnings(flag):
+    pass
+
+
+def setup(channel, direction, initial=LOW, pull_up_down=PUD_OFF):
+    for pin in (channel if isinstance(channel, (list, tuple)) else [channel]):
+        _levels[pin] = initial if direction == OUT else LOW
+
+
+def cleanup(channel=None):
+    _levels.clear()
+    for pin in list(_edge_events):
+        remove_event_detect(pin)
+
+
+def _update_stepper():
+    global _stepper_phase
+    state = tuple(1 if _levels.get(pin) else 0 for pin in _stepper_pins)
+    phase = _PHASES.get(state)
+    if phase is None:
+        return
+    if _stepper_phase is not None:
+        # the shortest way from the previous phase: -3..4 half steps
+        delta = (phase - _stepper_phase + 3) % 8 - 3
+        if delta:
+            world.move_stepper(delta)
+    _stepper_phase = phase
+
+
+def _ping(now):
+    global _echo
+    distance = world.measure(now)
+    start = now + _config['echo_latency']
+    if math.isinf(distance):
+        width = _config['no_echo_width']
+    else:
+        width = 2. * distance / _config['speed_of_sound']
+    _echo = (start, start + width)
+
+    for pin, event in _edge_events.items():
+        if pin == _config['pin_echo']:
+            event.schedule(_echo)
+
+
+def output(channel, value):
+    now = time.monotonic()
+    if isinstance(channel, (list, tuple)):
+        values = value if isinstance(value, (list, tuple)) else [value] * len(channel)
+    else:
+        channel, values = [channel], [value]
+
+    stepper_changed = False
+    for pin, val in zip(channel, values):
+        val = 1 if val else 0
+        previous = _levels.get(pin, LOW)
+        _levels[pin] = val
+
+        if pin in _stepper_pins:
+            stepper_changed = True
+        elif pin in _wheel_pins:
+            if val and not previous:
+                _rise[pin] = now
+            elif previous and not val and pin in _rise:
+                world.set_wheel_pulse(_wheel_pins[pin], now - _rise.pop(pin), now)
+        elif pin == _config['pin_trig'] and previous and not val:
+            _ping(now)
+
+    if stepper_changed:
+        _update_stepper()
+
+
+def input(channel):
+    if channel == _config['pin_echo']:
+        start, end = _echo
+        return HIGH if start <= time.monotonic() < end else LOW
+    return _levels.get(channel, LOW)
+
+
+class _EdgeEvents:
+    """
+    Deliver the edges of the echo signal to a callback, from a background thread like RPi.GPIO does.
+    """
+    def __init__(self, channel, edge, callback):
+        self._channel = channel
+        self._edge = edge
+        self._callbacks = [callback] if callback is not None else []
+        self._cond = threading.Condition()
+        self._pending = []
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def schedule(self, echo):
+        start, end = echo
+        with self._cond:
+            if self._edge in (RISING, BOTH):
+                self._pending.append(start)
+            if self._edge in (FALLING, BOTH):
+                self._pending.append(end)
+            self._cond.notify()
+
+    def add_callback(self, callback):
+        self._callbacks.append(callback)
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                when = self._pending.pop(0)
+
+            remaining = when - time.monotonic()
+            if remaining > 0:
+                time.sleep(remaining)
+            for callback in list(self._callbacks):
+                callback(self._channel)
+
+
+def add_event_detect(channel, edge, callback=None, bouncetime=None):
+    assert channel not in _edge_events, 'Conflicting edge detection already enabled for this GPIO channel'
+    _edge_events[channel] = _EdgeEvents(channel, edge, callback)
+
+
+def add_event_callback(channel, callback):
+    _edge_events[channel].add_callback(callback)
+
+
+def remove_event_detect(channel):
+    event = _edge_events.pop(channel, None)
+    if event is not None:
+        event.stop()
+
+
+def wait_for_edge(channel, edge, bouncetime=None, timeout=None):
+    """
+    Block until the edge of the current echo. Return the channel, or None after timeout (in millisecond).
+    """
+    start, end = _echo
+    when = []
+    if edge in (RISING, BOTH):
+        when.append(start)
+    if edge in (FALLING, BOTH):
+        when.append(end)
+    now = time.monotonic()
+    when = [t for t in when if t >= now]
+    deadline = now + timeout / 1000. if timeout is not None else math.inf
+    if not when or min(when) > deadline:
+        if math.isfinite(deadline):
+            time.sleep(max(0., deadline - now))
+        return None
+    time.sleep(max(0., min(when) - now))
+    return channel
+
+
+class PWM:
+    """
+    Software PWM. On a wheel pin, the duty cycle sets the pulse length seen by the motor.
+    """
+    def __init__(self, channel, frequency):
+        self._channel = channel
+        self._frequency = frequency
+        self._duty_cycle = 0.
+
+    def _apply(self):
+        wheel = _wheel_pins.get(self._channel)
+        if wheel is None:
+            return
+        if self._duty_cycle > 0:
+            world.set_wheel_pulse(wheel, self._duty_cycle / 100. / self._frequency, continuous=True)
+        else:
+            # no signal: the wheel stops
+            world.set_wheel_pulse(wheel, _config['wheels'][wheel]['reference_pulse'])
+
+    def start(self, duty_cycle):
+        self._duty_cycle = duty_cycle
+        self._apply()
+
+    def ChangeDutyCycle(self, duty_cycle):
+        self._duty_cycle = duty_cycle
+        self._apply()
+
+    def ChangeFrequency(self, frequency):
+        self._frequency = frequency
+        self._apply()
+
+    def stop(self):
+        self._duty_cycle = 0.
+        self._apply()
@@ -0,0 +1,218 @@
+import json
+import math
+import os
+import time
+import multiprocessing as mp
+
+import numpy as np
+
+
+# configuration of the simulation. It can be overridden by a JSON file given by the environment variable AUTOCAR_SIM_CONFIG.
+SIM_CONFIG_ENV = 'AUTOCAR_SIM_CONFIG'
+
+DEFAULT_CONFIG = {
+    # walls of the room, as segments [x1, y1, x2, y2] in meter
+    'walls': [
+        [0., 0., 4., 0.],
+        [4., 0., 4., 3.],
+        [4., 3., 0., 3.],
+        [0., 3., 0., 0.],
+        # a box in the room
+        [2.5, 1.2, 3.0, 1.2],
+        [3.0, 1.2, 3.0, 1.8],
+        [3.0, 1.8, 2.5, 1.8],
+        [2.5, 1.8, 2.5, 1.2],
+    ],
+    # initial pose of the robot: x, y (meter) and heading (degree, 0 is along the x axis)
+    'pose': [1.0, 1.5, 0.],
+
+    # radar: the stepper motor pins (in the order given to StepperMotor), the half steps per revolution and the ultrasonic sensor
+    'stepper_pins': [3, 5, 7, 11],
+    'stepper_half_steps_per_revolution': 4096,
+    'radar_offset': 0.,             # direction of the radar (degree, relative to the heading) at the zero position of the stepper
+    'pin_trig': 16,
+    'pin_echo': 18,
+    'speed_of_sound': 343.,
+    'echo_latency': 0.00045,        # delay between the trigger and the start of the echo
+    'max_range': 4.,
+    'no_echo_width': 0.038,         # length of the echo when there is no obstacle in range
+    'distance_noise': 0.005,        # standard deviation of the measured distance, in meter
+
+    # wheels: pin, reference pulse, max pulse deviation and direction (+1 if a longer pulse moves the robot forward)
+    'wheels': {
+        'left':  {'pin': 13, 'reference_pulse': 0.001462, 'max_pulse_deviation': 0.00025, 'direction': 1},
+        'right': {'pin': 15, 'reference_pulse': 0.001450, 'max_pulse_deviation': 0.00025, 'direction': -1},
+    },
+    'max_wheel_speed': 0.2,         # m/s at max pulse deviation
+    'pulse_deadband': 0.00001,      # pulse deviation below which the wheel does not move
+    'track_width': 0.15,            # distance between the wheels, in meter
+    'signal_timeout': 0.1,          # the wheel stops if it does not receive a pulse for signal_timeout seconds
+}
+
+
+def load_config():
+    config = dict(DEFAULT_CONFIG)
+    path = os.environ.get(SIM_CONFIG_ENV)
+    if path:
+        with open(path) as f:
+            config.update(json.load(f))
+    return config
+
+
+
+class World:
+    """
+    Physical model of the robot in a 2D room, shared by all the processes of the robot.
+
+    The state lives in shared memory (multiprocessing.RawArray) created when the module is imported, so the processes
+    forked afterwards (the component wrappers) see the same world: the radar base process moves the stepper, the
+    sensor process reads its angle, and the wheel processes set the wheel speeds that move the robot.
+
+    Args of __init__:
+        config: dict. See DEFAULT_CONFIG.
+    """
+    # layout of the shared state
+    STEPPER  = 0
+    X        = 1
+    Y        = 2
+    HEADING  = 3
+    V_LEFT   = 4
+    V_RIGHT  = 5
+    T_LEFT   = 6    # time of the last pulse of each wheel
+    T_RIGHT  = 7
+    T_UPDATE = 8    # time of the last integration of the pose
+    SIZE     = 9
+
+    def __init__(self, config=None):
+        self._config = config if config is not None else load_config()
+        self._walls = np.array(self._config['walls'], dtype=np.float64)
+        self._lock = mp.Lock()
+        self._state = mp.RawArray('d', World.SIZE)
+        self._rng = np.random.default_rng()
+        self.reset()
+
+    def reset(self):
+        x, y, heading = self._config['pose']
+        with self._lock:
+            state = self._state
+            state[:] = [0.] * World.SIZE
+            state[World.X] = x
+            state[World.Y] = y
+            state[World.HEADING] = math.radians(heading)
+            state[World.T_UPDATE] = time.monotonic()
+
+    def _integrate(self, now):
+        # called with the lock held. The speeds are constant since the last update.
+        state = self._state
+        dt = now - state[World.T_UPDATE]
+        if dt <= 0:
+            return
+
+        timeout = self._config['signal_timeout']
+        v_left = state[World.V_LEFT] if now - state[World.T_LEFT] < timeout else 0.
+        v_right = state[World.V_RIGHT] if now - state[World.T_RIGHT] < timeout else 0.
+
+        v = 0.5 * (v_left + v_right)
+        omega = (v_right - v_left) / self._config['track_width']
+        heading = state[World.HEADING]
+
+        if abs(omega) < 1e-9:
+            state[World.X] += v * math.cos(heading) * dt
+            state[World.Y] += v * math.sin(heading) * dt
+        else:
+            new_heading = heading + omega * dt
+            radius = v / omega
+            state[World.X] += radius * (math.sin(new_heading) - math.sin(heading))
+            state[World.Y] -= radius * (math.cos(new_heading) - math.cos(heading))
+            state[World.HEADING] = new_heading
+
+        state[World.T_UPDATE] = now
+
+    def set_wheel_pulse(self, wheel, pulse, now=None, continuous=False):
+        """
+        A pulse of length pulse (in second) has been sent to the wheel. With continuous=True (PWM), the signal does not time out.
+        """
+        now = time.monotonic() if now is None else now
+        cfg = self._config['wheels'][wheel]
+        deviation = pulse - cfg['reference_pulse']
+        if abs(deviation) < self._config['pulse_deadband']:
+            speed = 0.
+        else:
+            scale = max(-1., min(1., deviation / cfg['max_pulse_deviation']))
+            speed = cfg['direction'] * scale * self._config['max_wheel_speed']
+
+        index_v, index_t = (World.V_LEFT, World.T_LEFT) if wheel == 'left' else (World.V_RIGHT, World.T_RIGHT)
+        with self._lock:
+            self._integrate(now)
+            self._state[index_v] = speed
+            self._state[index_t] = math.inf if continuous else now
+
+    def move_stepper(self, half_steps):
+        with self._lock:
+            self._state[World.STEPPER] += half_steps
+
+    def pose(self, now=None):
+        """
+        The pose (x, y, heading in radian) of the robot.
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._integrate(now)
+            return self._state[World.X], self._state[World.Y], self._state[World.HEADING]
+
+    @property
+    def wheel_speeds(self):
+        """
+        The speeds (m/s) of the left and right wheels set by their last pulses.
+        """
+        return self._state[World.V_LEFT], self._state[World.V_RIGHT]
+
+    @property
+    def wheel_pulse_times(self):
+        """
+        The times (time.monotonic) of the last pulses of the left and right wheels. inf for a PWM signal.
+        """
+        return self._state[World.T_LEFT], self._state[World.T_RIGHT]
+
+    @property
+    def radar_angle(self):
+        """
+        The direction of the radar relative to the heading of the robot, in degree.
+        """
+        steps = self._state[World.STEPPER]
+        return self._config['radar_offset'] + steps * 360. / self._config['stepper_half_steps_per_revolution']
+
+    def ray_cast(self, x, y, angle):
+        """
+        Distance from (x, y) to the closest wall in the direction angle (radian). inf if there is no wall.
+        """
+        walls = self._walls
+        dx, dy = math.cos(angle), math.sin(angle)
+        ax, ay = walls[:, 0], walls[:, 1]
+        ex, ey = walls[:, 2] - ax, walls[:, 3] - ay
+
+        denom = dx * ey - dy * ex
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = ((ax - x) * ey - (ay - y) * ex) / denom
+            s = ((ax - x) * dy - (ay - y) * dx) / denom
+        hit = (np.abs(denom) > 1e-12) & (t > 0) & (s >= 0) & (s <= 1)
+        return t[hit].min() if hit.any() else math.inf
+
+    def measure(self, now=None):
+        """
+        The distance seen by the ultrasonic sensor now. inf if nothing is in range.
+        """
+        x, y, heading = self.pose(now)
+        distance = self.ray_cast(x, y, heading + math.radians(self.radar_angle))
+        if distance > self._config['max_range']:
+            return math.inf
+        return max(0., distance + self._rng.normal(0., self._config['distance_noise']))
+
+    @property
+    def config(self):
+        return self._config
+
+
+
+# the world shared by all the processes of the simulation
+world = World()
@@ -1,11 +1,75 @@
 
-import RPi.GPIO as gpio
+from gpio_backend import gpio
 import time
 import math
 
+import numpy as np
+
+from clock import now_ns
+
 gpio.setmode(gpio.BOARD)
 
 
+class RampProfile:
+    """
+    Acceleration profile of a stepper motor move. The motor starts at start_delay (the delay between two steps),
+    accelerates to min_delay in accel_steps steps, and decelerates symmetrically before the end of the move.
+
+    Args of __init__:
+        start_delay: the delay (in second) between the steps at the start and at the end of the move.
+        min_delay:   the delay (in second) between the steps at full speed.
+        accel_steps: the number of steps used to accelerate (and to decelerate).
+        shape:       TRAPEZOID (constant acceleration) or S_CURVE (smooth acceleration, no jerk at the ends of the ramp).
+    """
+    TRAPEZOID = 'trapezoid'
+    S_CURVE   = 's_curve'
+
+    def __init__(self, start_delay=0.002, min_delay=0.001, accel_steps=50, shape=TRAPEZOID):
+        assert 0 < min_delay <= start_delay
+        assert accel_steps > 0
+        assert shape in (RampProfile.TRAPEZOID, RampProfile.S_CURVE)
+
+        self._start_delay = start_delay
+        self._min_delay = min_delay
+        self._accel_steps = accel_steps
+        self._shape = shape
+        self._cache = {}
+
+    def delays(self, n_steps):
+        """
+        The delay after each step of a move of n_steps steps. The arrays are computed once per length.
+        """
+        delays = self._cache.get(n_steps)
+        if delays is not None:
+            return delays
+
+        i = np.arange(n_steps)
+        # progress of the ramp: 0 at both ends of the move, 1 at full speed
+        ramp = np.minimum(np.minimum(i, n_steps - 1 - i) / self._accel_steps, 1.)
+
+        v0 = 1. / self._start_delay
+        v_max = 1. / self._min_delay
+        if self._shape == RampProfile.TRAPEZOID:
+            # constant acceleration: the square of the speed grows linearly with the distance
+            speed = np.sqrt(v0 ** 2 + (v_max ** 2 - v0 ** 2) * ramp)
+        else:
+            speed = v0 + (v_max - v0) * ramp * ramp * (3 - 2 * ramp)
+
+        delays = 1. / speed
+        delays.setflags(write=False)
+        self._cache[n_steps] = delays
+        return delays
+
+    @property
+    def start_delay(self):
+        return self._start_delay
+
+    @property
+    def min_delay(self):
+        return self._min_delay
+
+
+
 class StepperMotor:
     """
     StepperMotor is a class the represents a stepper motor. It provides functions to control the motor and keeps record of
@@ -15,10 +79,32 @@ class StepperMotor:
         pins:      Pins used to send signal to stepper motor. pins is a list of length 4 because the a common stepper motor has 4 inputs.
         init_pos:  Double. It represents the position of the motore. It is set by the user and is quite arbitrary.
         delta_pos: Double. The cumulative change of the position.
-    """
+        mode:      HALF_STEP or FULL_STEP.
 
-    def __init__(self, pins, init_pos=0):
+    Note:
+        The position is counted in half steps (an integer) and converted to degree when it is read. The coil states are
+        taken from a precomputed phase table and the phase is kept between moves.
+    """
+    HALF_STEP = 'half'
+    FULL_STEP = 'full'
+
+    HALF_STEPS_PER_REVOLUTION = 4096
+
+    # states of the 4 coils, in half steps. Going forward in the table turns the motor anti-clockwise.
+    PHASE_TABLE = (
+        (1, 0, 0, 1),
+        (1, 0, 0, 0),
+        (1, 1, 0, 0),
+        (0, 1, 0, 0),
+        (0, 1, 1, 0),
+        (0, 0, 1, 0),
+        (0, 0, 1, 1),
+        (0, 0, 0, 1),
+    )
+
+    def __init__(self, pins, init_pos=0, mode=HALF_STEP):
         assert isinstance(pins, list) and len(pins) == 4, 'Invalid pins.'
+        assert mode in (StepperMotor.HALF_STEP, StepperMotor.FULL_STEP)
 
         self._pins = list(pins)
         for pin in self._pins:
@@ -26,45 +112,62 @@ class StepperMotor:
 
         time.sleep(1.0)
 
-        self._init_pos = init_pos 
-        self._delta_pos = 0.
+        self._init_pos = init_pos
+        self._half_steps = 0
+        self._phase = 0
+        self._step_ns = None
+        self._mode = mode
+        self._phase_increment = 1 if mode == StepperMotor.HALF_STEP else 2
         super(StepperMotor, self).__init__()
 
+    def degree_to_steps(self, degree):
+        """
+        The number of steps (in the current mode) of a rotation of degree.
+        """
+        return int(round(degree / self.step_angle))
+
+    def step(self, clockwise=False):
+        """
+        Move the motor by one step. The caller is responsible for the delay between two steps.
+        """
+        increment = -self._phase_increment if clockwise else self._phase_increment
+        self._phase = (self._phase + increment) % len(StepperMotor.PHASE_TABLE)
+        gpio.output(self._pins, StepperMotor.PHASE_TABLE[self._phase])
+        self._step_ns = now_ns()
+        self._half_steps += increment
+
     def rotate(self, degree=None, clockwise=False, delay=0.002):
         """
         Calling the rorate function will make the motor rotate. The degree controls the range of the movement. If the degree is None, the
-        motor will not stop. The dealy controls the speed of the motor. 
+        motor will not stop. The dealy controls the speed of the motor: it is either the delay after each step, or an array with the
+        delay after each step of the move (e.g. from RampProfile.delays).
         """
-        if clockwise:
-            in_1, in_2, in_3, in_4 = self._pins[::-1]
-        else:
-            in_1, in_2, in_3, in_4 = self._pins
-
         if degree is None:
-            remaining = 1
+            while True:
+                self.step(clockwise)
+                time.sleep(delay)
+
+        n_steps = self.degree_to_steps(degree)
+        if np.isscalar(delay):
+            delays = (delay,) * n_steps
         else:
-            remaining = degree
-
-        #TODO: remove the hard-coded number
-        stepsize = 360. / 4096.  * 8
-
-        while degree is None or remaining > 0:
-            gpio.output(in_1, 1); time.sleep(delay); 
-            gpio.output(in_4, 0); time.sleep(delay); 
-            gpio.output(in_2, 1); time.sleep(delay); 
-            gpio.output(in_1, 0); time.sleep(delay); 
-            gpio.output(in_3, 1); time.sleep(delay); 
-            gpio.output(in_2, 0); time.sleep(delay); 
-            gpio.output(in_4, 1); time.sleep(delay); 
-            gpio.output(in_3, 0); time.sleep(delay); 
-
-            if degree is not None:
-                remaining -= stepsize
-
-            if clockwise:
-                self._delta_pos -= stepsize
-            else:
-                self._delta_pos += stepsize
+            assert len(delay) >= n_steps
+            delays = delay
+
+        # the steps are scheduled against absolute deadlines, so the sleep overshoots do not accumulate
+        deadline = time.perf_counter()
+        for n in range(n_steps):
+            self.step(clockwise)
+            deadline += delays[n]
+            remaining = deadline - time.perf_counter()
+            if remaining > 0:
+                time.sleep(remaining)
+
+    def rotate_with_profile(self, degree, clockwise=False, profile=None):
+        """
+        Rotate with the acceleration profile (a RampProfile) over the whole move.
+        """
+        self.rotate(degree=degree, clockwise=clockwise, delay=profile.delays(self.degree_to_steps(degree)))
 
     def back_to_zero_pos(self, delay=0.002):
         """
@@ -82,12 +185,11 @@ class StepperMotor:
         if self.delta_pos > 0:
             self.rotate(degree=self.delta_pos, clockwise=True, delay=delay)
         else:
-            self.rotate(degree=-self.data_pos, clockwise=False, delay=delay)
+            self.rotate(degree=-self.delta_pos, clockwise=False, delay=delay)
+
 
-            
     def turn_off_all_pins(self):
-        for pin in self._pins:
-            gpio.output(pin,0)
+        gpio.output(self._pins, 0)
 
     def scan(self, min_degree=0, max_degree=180, init_pos=0, delay=0.002, delay_factor=3):
         """
@@ -97,13 +199,13 @@ class StepperMotor:
         Args:
             min_degree:       The minimum degree(position) of the range.
             max_degree:       The maximum degree(position) of the range.
-            ini_pos:          The initial position of the motor. Once the initial position is specified, we can infer the position 
+            ini_pos:          The initial position of the motor. Once the initial position is specified, we can infer the position
                               that represents the zero degree.
             delay:            This parameter controls the speed of the scan.
             delay_factor:     Int (default value is 3). There is a pause in the movement when the motor arrives at the limit of the range.
                               The lenght of the pause is delay_factor * delay.
         """
-        
+
 
         # check if init_pos is inside the range. If not, adjust the init_pos to the center of the range
 
@@ -117,7 +219,7 @@ class StepperMotor:
             init_pos = new_init_pos
 
         # from init_pos to max_degree
-        self.rorate(degree=max_degree - init_pos, clockwise=False, delay=delay)
+        self.rotate(degree=max_degree - init_pos, clockwise=False, delay=delay)
         self.turn_off_all_pins()
         time.sleep(delay_factor * delay)
 
@@ -132,9 +234,27 @@ class StepperMotor:
         time.sleep(delay_factor * delay)
 
 
+    @property
+    def step_angle(self):
+        """
+        The rotation (in degree) of one step in the current mode.
+        """
+        return 360. / StepperMotor.HALF_STEPS_PER_REVOLUTION * self._phase_increment
+
+    @property
+    def step_ns(self):
+        """
+        The time (clock.now_ns) of the last step, i.e. when the motor reached pos.
+        """
+        return self._step_ns
+
+    @property
+    def half_steps(self):
+        return self._half_steps
+
     @property
     def delta_pos(self):
-        return self._delta_pos
+        return self._half_steps * 360. / StepperMotor.HALF_STEPS_PER_REVOLUTION
 
     @property
     def pos(self):
@@ -144,6 +264,10 @@ class StepperMotor:
     def init_pos(self):
         return self._init_pos
 
+    @property
+    def mode(self):
+        return self._mode
+
 if __name__ == '__main__':
 
     in_1 = 3
@@ -158,9 +282,9 @@ if __name__ == '__main__':
     print('call stepperMotor.rotate()')
     input('press any key to start')
 #    stepperMotor.rotate()
-    stepperMotor.scan(pre_rot=90)
+    stepperMotor.scan(init_pos=90)
     #swing(pins, degree=180)
-    
+
 
 
 
@@ -0,0 +1,10 @@
+"""
+The tests run on the simulated GPIO backend (see gpio_backend.py). Run them from the root of the repository:
+    python -m pytest tests
+"""
+import os
+import sys
+
+# set before gpio_backend is imported, it loads the backend at import time
+os.environ.setdefault('AUTOCAR_GPIO', 'sim')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
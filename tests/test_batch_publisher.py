@@ -0,0 +1,77 @@
+import multiprocessing as mp
+import queue
+import time
+
+from clock import now_ns
+from commands import Command
+from components import Component, ContinuousComponentWrapper, CMD_EXIT
+from records import component_id, make_dtype
+from transport import BatchPublisher, CommandChannel, MessageBatch, drain
+
+
+def test_flush_by_size():
+    Q = queue.Queue()
+    publisher = BatchPublisher(Q, batch_size=3)
+    for i in range(7):
+        publisher.put(i)
+    assert Q.get_nowait() == MessageBatch([0, 1, 2])
+    assert Q.get_nowait() == MessageBatch([3, 4, 5])
+    assert Q.empty() and len(publisher) == 1
+
+
+def test_poll_flushes_an_old_partial_batch():
+    Q = queue.Queue()
+    publisher = BatchPublisher(Q, batch_size=10, batch_age=0.02)
+    publisher.put(1)
+    publisher.poll()
+    assert Q.empty()
+    time.sleep(0.03)
+    publisher.poll()
+    assert Q.get_nowait() == MessageBatch([1])
+    # nothing to flush
+    publisher.poll()
+    assert Q.empty()
+
+
+class Once(Component):
+    """
+    Sends one message per command, then stays quiet.
+    """
+    FORMAT = ('timestamp', 'comp_id', 'seq')
+    COMMANDS = (Command('send', ('seq', 'q')),)
+
+    def __init__(self, name='once'):
+        self._name = name
+        self._comp_id = component_id('Once::{}'.format(name))
+        self._seq = None
+
+    def send(self, seq):
+        self._seq = seq
+
+    def run(self):
+        if self._seq is None:
+            self.idle(0.01)
+
+    def send_msg(self, Q):
+        if self._seq is not None:
+            Q.put((now_ns(), self._comp_id, self._seq))
+            self._seq = None
+
+
+def test_wrapper_sends_the_partial_batch_of_a_quiet_component():
+    cmd_Q, output_Q = CommandChannel(), mp.Queue()
+    component = Once()
+    wrapper = ContinuousComponentWrapper(component=component, cmd_Q=cmd_Q, output_Q=output_Q, batch_size=8, batch_age=0.05)
+    wrapper.start()
+    try:
+        cmd_Q.put(('send', (7,), {}))
+        dtype = make_dtype(Once.FORMAT)
+        deadline = time.monotonic() + 2.
+        msgs = drain(output_Q, dtype)
+        while len(msgs) == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+            msgs = drain(output_Q, dtype)
+        assert msgs['seq'].tolist() == [7]
+    finally:
+        cmd_Q.put(CMD_EXIT)
+        wrapper.join(2)
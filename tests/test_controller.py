@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+
+import controller as ctl
+from recorder import OUTPUT, Recorder, Recording, ReplayedComponent, stream_path
+from records import make_dtype
+
+
+SCAN_FORMAT = ('timestamp', 'comp_id', 'pos', 'distance', 'status')
+SENSOR_FORMAT = ('timestamp', 'comp_id', 'distance', 'status')
+MS = 10 ** 6
+
+
+def scan(timestamps, pos):
+    return np.array([(t, 1, p, 1., 1) for t, p in zip(timestamps, pos)], dtype=make_dtype(SCAN_FORMAT))
+
+
+class Clock:
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def test_retention_ends_now():
+    clock = Clock(1000 * MS)
+    handler = ctl.RawDataHandler(name='radar', parser=SCAN_FORMAT, record_size=100, retention=0.1, clock=clock)
+    handler.extend(scan(np.arange(800, 1001, 20) * MS, np.arange(11)))
+    assert handler.records['timestamp'].tolist() == [t * MS for t in range(900, 1001, 20)]
+    assert len(handler.data) == 6
+
+    # the component stops sending: its messages expire
+    clock.now = 1050 * MS
+    assert handler.records['timestamp'].tolist() == [t * MS for t in range(960, 1001, 20)]
+    assert len(handler.data) == 3
+    clock.now = 2000 * MS
+    assert len(handler.records) == 0 and len(handler.data) == 0
+
+
+def test_retention_ends_at_the_newest_message_without_clock():
+    handler = ctl.RawDataHandler(name='radar', parser=SCAN_FORMAT, record_size=100, retention=0.1)
+    handler.extend(scan(np.arange(800, 1001, 20) * MS, np.arange(11)))
+    assert handler.records['timestamp'].tolist() == [t * MS for t in range(900, 1001, 20)]
+    assert handler.retention == pytest.approx(0.1)
+
+    no_retention = ctl.RawDataHandler(name='radar', parser=SCAN_FORMAT, record_size=100)
+    no_retention.extend(scan(np.arange(800, 1001, 20) * MS, np.arange(11)))
+    assert len(no_retention.records) == 11
+
+
+def test_shed_drop():
+    msgs = scan([100 * MS, 200 * MS, 300 * MS, 400 * MS], [1., 2., 1., 2.])
+    kept, shed = ctl.shed_stale(msgs, 450 * MS, 0.2, ctl.SHED_DROP)
+    assert kept['timestamp'].tolist() == [300 * MS, 400 * MS] and shed == 2
+
+    kept, shed = ctl.shed_stale(msgs, 450 * MS, 1., ctl.SHED_DROP)
+    assert len(kept) == 4 and shed == 0
+    kept, shed = ctl.shed_stale(msgs[:0], 450 * MS, 0.2, ctl.SHED_DROP)
+    assert len(kept) == 0 and shed == 0
+
+
+def test_shed_latest():
+    # stale: the newest message of each position is kept, the ones without position are dropped
+    msgs = scan(np.arange(1, 9) * 100 * MS, [1.2, 2., 0.9, np.nan, 2.1, 5., 1., 3.])
+    kept, shed = ctl.shed_stale(msgs, 900 * MS, 0.25, ctl.SHED_LATEST)
+    assert kept['timestamp'].tolist() == [300 * MS, 500 * MS, 600 * MS, 700 * MS, 800 * MS]
+    assert shed == 3
+
+    # without a position, the stale messages are dropped
+    sensor = np.array([(t * MS, 1, 1., 1) for t in (100, 200, 800)], dtype=make_dtype(SENSOR_FORMAT))
+    kept, shed = ctl.shed_stale(sensor, 900 * MS, 0.25, ctl.SHED_LATEST)
+    assert kept['timestamp'].tolist() == [800 * MS] and shed == 2
+
+
+def test_replayed_components_keep_the_newest_anchor(tmp_path):
+    path = stream_path(str(tmp_path), 'radar', OUTPUT)
+    meta = {'name': 'radar', 'kind': OUTPUT, 'fields': list(SCAN_FORMAT), 'attrs': {'min_degree': -60, 'max_degree': 40}}
+    recorder = Recorder(path, make_dtype(SCAN_FORMAT), meta=meta)
+    # recorded long ago
+    recorder.extend(scan(np.arange(10) * 20 * MS, np.arange(10)))
+    recorder.close()
+
+    radar = ReplayedComponent(Recording(path))
+    controller = ctl.Controller(radar=radar, retention=0.1)
+    radar.output_Q.advance(10 ** 9)
+    ctl.retrieve_data(radar.output_Q, controller.data_handler['radar'])
+    assert controller.data_handler['radar'].records['timestamp'].tolist() == [t * MS for t in range(80, 181, 20)]
@@ -0,0 +1,64 @@
+"""
+compute_distance_map against the pandas implementation it replaced (benchmarks.bench_distance_map).
+
+The two differ on purpose in two ways:
+- the legacy join attributes a reading to the last radar position of its 10ms bucket, the new one interpolates the
+  position at the reading time. On streams where each reading has the timestamp of a radar message, alone in its
+  bucket, both give the position of that message.
+- the legacy bins truncate the position toward zero (astype(int)), the new bins round it to the nearest degree
+  (np.rint). So 2.7 is in bin 2 for the legacy map and in bin 3 for the new one, -0.6 in bin 0 and in bin -1.
+"""
+import numpy as np
+import pandas as pd
+
+import controller as ctl
+from benchmarks.bench_distance_map import BASE_FORMAT, SENSOR_FORMAT, legacy_create_distance_map
+from records import STATUS_CODES
+
+
+def aligned_streams(pos, seed=0):
+    """
+    One radar message every 20ms, 5ms into its 10ms bucket, and one reading at the same time.
+    """
+    rng = np.random.default_rng(seed)
+    ts = 10 ** 12 + 5 * 10 ** 6 + np.arange(len(pos), dtype=np.int64) * 20 * 10 ** 6
+    df_base = pd.DataFrame({'timestamp': ts, 'comp_id': 1, 'pos': pos, 'min_degree': -60., 'max_degree': 40.},
+                           columns=BASE_FORMAT)
+    df_sensor = pd.DataFrame({'timestamp': ts, 'comp_id': 2, 'distance': rng.uniform(0.05, 3.5, len(pos)),
+                              'status': STATUS_CODES['SUCC']}, columns=SENSOR_FORMAT)
+    return df_base, df_sensor
+
+
+def sweep(step, n=600):
+    # a triangle wave between -60 and 40 degrees, each bin is seen several times
+    phase = (np.arange(n) * step) % 200.
+    return -60. + np.where(phase < 100., phase, 200. - phase)
+
+
+def test_same_map_on_integer_positions():
+    df_base, df_sensor = aligned_streams(sweep(1.))
+    expected = legacy_create_distance_map(df_base, df_sensor)
+    result = ctl.create_distance_map(df_base, df_sensor)
+    assert np.array_equal(expected.index.values, result.index.values)
+    assert np.allclose(expected.values, result.values)
+
+
+def test_rint_instead_of_truncation():
+    pos = sweep(0.7)
+    df_base, df_sensor = aligned_streams(pos)
+    result = ctl.create_distance_map(df_base, df_sensor)
+
+    # the legacy map of the rounded positions is the new map
+    expected = legacy_create_distance_map(df_base.assign(pos=np.rint(pos)), df_sensor)
+    assert np.array_equal(expected.index.values, result.index.values)
+    assert np.allclose(expected.values, result.values)
+
+    # but not the legacy map of the positions themselves
+    legacy = legacy_create_distance_map(df_base, df_sensor)
+    assert not (np.array_equal(legacy.index.values, result.index.values) and np.allclose(legacy.values, result.values))
+
+
+def test_bins_of_fractional_positions():
+    df_base, df_sensor = aligned_streams(np.array([2.7, -0.6, 5.2]))
+    assert ctl.create_distance_map(df_base, df_sensor).index.tolist() == [-1, 3, 5]
+    assert legacy_create_distance_map(df_base, df_sensor).index.tolist() == [0, 2, 5]
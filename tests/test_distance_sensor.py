@@ -0,0 +1,50 @@
+import threading
+
+import pytest
+
+from distance_sensor import DistanceSensor
+
+
+@pytest.fixture
+def sensor():
+    sensor = DistanceSensor(pin_echo=18, pin_trig=16, mode=DistanceSensor.EDGE, pipelined=True)
+    yield sensor
+    sensor.close()
+
+
+def watch_triggers(sensor):
+    """
+    Record, for each ping, whether the condition lock was held and how many pings were being sent at once.
+    """
+    calls = []
+    active = [0]
+    guard = threading.Lock()
+    trigger = sensor._trigger
+
+    def checked_trigger():
+        with guard:
+            active[0] += 1
+            calls.append((sensor._echo_done._is_owned(), active[0]))
+        trigger()
+        with guard:
+            active[0] -= 1
+
+    sensor._trigger = checked_trigger
+    return calls
+
+
+def test_pipelined_measures(sensor):
+    calls = watch_triggers(sensor)
+    results = [sensor.measure() for _ in range(20)]
+    assert all(status == DistanceSensor.SUCC for _, status in results)
+    assert calls and all(locked and active == 1 for locked, active in calls)
+
+
+def test_triggers_are_serialized_after_timeouts(sensor, monkeypatch):
+    calls = watch_triggers(sensor)
+    # the echoes come after the timeout: measure sends a new ping while the callback may send one too
+    monkeypatch.setattr(DistanceSensor, 'ECHO_TIMEOUT', 0.001)
+    for _ in range(30):
+        sensor.measure()
+    monkeypatch.undo()
+    assert calls and all(locked and active == 1 for locked, active in calls)
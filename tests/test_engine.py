@@ -0,0 +1,80 @@
+import pytest
+
+from clock import now_ns
+from components import WheelComponent, DifferentialDriveComponent
+from engine import Engine
+from odometry import Odometry, WheelModel
+from records import component_id
+
+
+def wheels():
+    left = WheelComponent(name='left_wheel', mirror=False, pin_signal=13, repeat=10, reference_pulse=0.001462, max_pulse_deviation=0.00025)
+    right = WheelComponent(name='right_wheel', mirror=True, pin_signal=15, repeat=10, reference_pulse=0.001450, max_pulse_deviation=0.00025)
+    return left, right
+
+
+@pytest.fixture
+def drive_engine():
+    left, right = wheels()
+    odometry = Odometry(left=WheelModel.from_component(left), right=WheelModel.from_component(right))
+    engine = Engine(drive_comp=DifferentialDriveComponent(name='drive', left_wheel=left, right_wheel=right), odometry=odometry)
+    yield engine, left, right
+    # the processes are not started, only the channels are released
+    for wrapper, _ in engine._wrappers:
+        wrapper.output_Q.close()
+
+
+def test_odometry_gets_every_cycle_when_it_is_read_late(drive_engine):
+    engine, left, right = drive_engine
+    # full speed forward
+    left_pulse = left.reference_pulse + left.max_pulse_deviation
+    right_pulse = right.reference_pulse - right.max_pulse_deviation
+    duration = 10 * (max(left_pulse, right_pulse) + 0.020)
+
+    # five cycles are sent while nobody reads the wheels (a stalled controller)
+    Q = engine._wrappers[0][0].output_Q
+    start = now_ns()
+    comp_id = component_id('drive')
+    for k in range(1, 6):
+        Q.put((start + int(k * duration * 1e9), comp_id, left_pulse, right_pulse, 10))
+
+    engine.update_motor_stats()
+    engine.odometry.compute_current_param()
+    x, y, heading = engine.odometry.pose
+    assert x == pytest.approx(5 * duration * 0.2, rel=1e-6)
+    assert y == pytest.approx(0., abs=1e-9) and heading == pytest.approx(0., abs=1e-6)
+    assert engine.overwritten == {'drive': 0}
+
+
+def test_without_odometry_only_the_latest_status_is_kept():
+    left, right = wheels()
+    engine = Engine(left_wheel_comp=left, right_wheel_comp=right)
+    try:
+        Q = engine._wrappers[0][0].output_Q
+        for k in range(3):
+            Q.put((now_ns(), component_id('left_wheel'), 0.0015 + k * 1e-5, 10))
+        engine.update_motor_stats()
+        assert engine._left_pulse == pytest.approx(0.00152)
+        assert engine.overwritten == {'left': 2, 'right': 0}
+    finally:
+        for wrapper, _ in engine._wrappers:
+            wrapper.output_Q.close()
+
+
+@pytest.mark.parametrize('left_scale, right_scale, expected', [
+    (0.8, 0.4, 0.6),        # forward, drifting to the right
+    (-0.8, -0.4, -0.6),     # backward
+    (-0.5, 0.3, -0.4),      # turning, mostly backward
+    (0.3, -0.1, 0.2),       # turning, mostly forward
+])
+def test_go_straight(drive_engine, left_scale, right_scale, expected):
+    engine, left, right = drive_engine
+    drive = engine._drive_comp
+    drive.set_speed(left_scale, right_scale)
+    engine._wrappers[0][0].output_Q.put((now_ns(), drive.comp_id, left.pulse, right.pulse, 10))
+
+    engine.go_straight()
+    drive.parse_and_execute(engine._cmd_Q_drive.get())
+    # the right wheel is mirrored: forward is a pulse shorter than the reference
+    assert left.pulse == pytest.approx(left.reference_pulse + expected * left.max_pulse_deviation)
+    assert right.pulse == pytest.approx(right.reference_pulse - expected * right.max_pulse_deviation)
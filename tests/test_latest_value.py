@@ -0,0 +1,104 @@
+import multiprocessing as mp
+import queue
+
+import numpy as np
+import pytest
+
+from transport import LatestValue, MessageBatch, drain
+from records import make_dtype
+
+
+FORMAT = ('timestamp', 'comp_id', 'pulse', 'repeat')
+
+
+@pytest.fixture
+def channel():
+    Q = LatestValue(FORMAT)
+    yield Q
+    Q.close()
+
+
+def msg(i):
+    return (i, 1, i / 1000., i)
+
+
+def test_empty(channel):
+    assert channel.empty() and channel.qsize() == 0
+    assert channel.latest() is None
+    assert len(channel.drain()) == 0
+    with pytest.raises(queue.Empty):
+        channel.get_nowait()
+    with pytest.raises(queue.Empty):
+        channel.get(timeout=0.01)
+
+
+def test_put_replaces_the_record(channel):
+    for i in range(5):
+        channel.put(msg(i))
+    assert channel.qsize() == 1 and not channel.full()
+    assert channel.count == 5
+    assert channel.get() == msg(4)
+    assert channel.empty()
+    # latest does not consume
+    assert channel.latest() == msg(4)
+    assert channel.empty()
+
+
+def test_overwritten_count(channel):
+    channel.put(msg(0))
+    channel.get()
+    assert channel.overwritten == 0
+    for i in range(1, 4):
+        channel.put(msg(i))
+    # 1 and 2 were never read
+    assert channel.drain()['timestamp'].tolist() == [3]
+    assert channel.overwritten == 2
+    assert len(channel.drain()) == 0
+    channel.put(msg(4))
+    assert channel.get() == msg(4)
+    assert channel.overwritten == 2
+
+
+def test_batches_keep_the_last_message(channel):
+    channel.put(MessageBatch([msg(1), msg(2)]))
+    assert channel.get() == msg(2)
+    channel.put(np.array([msg(5), msg(6)], dtype=make_dtype(FORMAT)).tobytes())
+    assert drain(channel, channel.dtype)['timestamp'].tolist() == [6]
+
+
+def test_bad_message_leaves_the_channel_usable(channel):
+    channel.put(msg(1))
+    with pytest.raises((OverflowError, ValueError)):
+        channel.put((2, 70000, 0., 0))   # comp_id is uint16
+    assert channel.latest() == msg(1)
+    channel.put(msg(3))
+    assert channel.get() == msg(3)
+
+
+def _produce(Q, n):
+    for i in range(n):
+        # every field carries i, so a torn record is visible
+        Q.put((i, i % 60000, float(i), float(i)))
+
+
+@pytest.mark.skipif('fork' not in mp.get_all_start_methods(), reason='needs fork')
+def test_two_processes_never_tear_a_record():
+    Q = LatestValue(FORMAT)
+    n = 50000
+    producer = mp.get_context('fork').Process(target=_produce, args=(Q, n))
+    producer.start()
+    reads = 0
+    last = -1
+    while producer.is_alive() or reads == 0:
+        value = Q.latest()
+        if value is None:
+            continue
+        i = value[0]
+        assert value == (i, i % 60000, float(i), float(i))
+        # the records are read in order, some are skipped
+        assert i >= last
+        last = i
+        reads += 1
+    producer.join(5)
+    assert Q.latest()[0] == n - 1
+    Q.close()
@@ -0,0 +1,189 @@
+import math
+
+import numpy as np
+import pytest
+
+from occupancy_grid import OccupancyGrid
+from odometry import Odometry, WheelModel
+from records import component_id
+
+
+MAX_SPEED = 0.2
+TRACK_WIDTH = 0.15
+REPEAT = 10
+WIDTH = 0.020
+START = 10 ** 12
+
+LEFT = WheelModel(0.001462, 0.00025, mirror=False, max_speed=MAX_SPEED)
+RIGHT = WheelModel(0.001450, 0.00025, mirror=True, max_speed=MAX_SPEED)
+# the pulses at full speed forward and backward. The right wheel is mirrored: a shorter pulse moves it forward.
+LEFT_FORWARD, LEFT_BACKWARD = 0.001462 + 0.00025, 0.001462 - 0.00025
+RIGHT_FORWARD = 0.001450 - 0.00025
+
+
+def odometry():
+    return Odometry(left=LEFT, right=RIGHT, track_width=TRACK_WIDTH)
+
+
+def cycle_ns(pulse):
+    return int(REPEAT * (pulse + WIDTH) * 1e9)
+
+
+def drive_msgs(left_pulse, right_pulse, n):
+    # the cycles of the drive last as long as the longer pulse
+    period = cycle_ns(max(left_pulse, right_pulse))
+    comp_id = component_id('DifferentialDrive::drive')
+    return [(START + (i + 1) * period, comp_id, left_pulse, right_pulse, REPEAT) for i in range(n)], period
+
+
+def wheel_msgs(pulse, n):
+    period = cycle_ns(pulse)
+    comp_id = component_id('Wheel::test')
+    return [(START + (i + 1) * period, comp_id, pulse, REPEAT) for i in range(n)], period
+
+
+def test_straight_run():
+    odo = odometry()
+    msgs, period = drive_msgs(LEFT_FORWARD, RIGHT_FORWARD, 5)
+    odo.update('drive', msgs)
+    current = odo.compute_current_param()
+
+    x, y, heading = odo.pose
+    assert x == pytest.approx(5 * period * 1e-9 * MAX_SPEED)
+    assert y == pytest.approx(0.) and heading == pytest.approx(0.)
+    assert current['v'] == pytest.approx(MAX_SPEED) and current['omega'] == pytest.approx(0.)
+    assert current['timestamp'] == msgs[-1][0]
+
+
+def test_turn_in_place():
+    odo = odometry()
+    msgs, period = drive_msgs(LEFT_BACKWARD, RIGHT_FORWARD, 3)
+    odo.update('drive', msgs)
+    odo.compute_current_param()
+
+    omega = 2 * MAX_SPEED / TRACK_WIDTH
+    x, y, heading = odo.pose
+    assert x == pytest.approx(0., abs=1e-12) and y == pytest.approx(0., abs=1e-12)
+    expected = math.degrees((omega * 3 * period * 1e-9 + math.pi) % (2 * math.pi) - math.pi)
+    assert heading == pytest.approx(expected)
+
+
+def test_one_wheel_lagging():
+    left, left_period = wheel_msgs(LEFT_FORWARD, 6)
+    right, right_period = wheel_msgs(RIGHT_FORWARD, 6)
+    assert left_period > right_period
+
+    odo = odometry()
+    odo.update('left', left)
+    odo.update('right', right[:3])
+    odo.compute_current_param()
+    # the pose stops at the last message of the slowest wheel
+    assert odo.pose == pytest.approx((3 * right_period * 1e-9 * MAX_SPEED, 0., 0.))
+    assert odo.current['timestamp'] == right[2][0]
+
+    odo.update('right', right[3:])
+    odo.compute_current_param()
+    assert odo.pose == pytest.approx((6 * right_period * 1e-9 * MAX_SPEED, 0., 0.))
+
+    # the same pose as with all the messages at once
+    at_once = odometry()
+    at_once.update('left', left)
+    at_once.update('right', right)
+    at_once.compute_current_param()
+    assert at_once.pose == pytest.approx(odo.pose)
+
+
+def driven():
+    # a run of about 1m, so the covariance is not 0
+    odo = odometry()
+    odo.update('drive', drive_msgs(LEFT_FORWARD, RIGHT_FORWARD, 24)[0])
+    odo.compute_current_param()
+    return odo
+
+
+def test_observe_pose_gate():
+    odo = driven()
+    x, y, heading = odo.pose
+    assert odo.covariance[0, 0] > 0
+
+    assert not odo.observe_pose((x + 1., y, heading))
+    assert odo.pose == (x, y, heading)
+
+    assert odo.observe_pose((x + 0.01, y - 0.01, heading + 1.))
+    corrected = odo.pose
+    assert x < corrected[0] < x + 0.01 and y - 0.01 < corrected[1] < y and heading < corrected[2] < heading + 1.
+    assert odo.current['x'] == corrected[0]
+
+
+def test_observe_landmark_gate():
+    odo = driven()
+    x, y, heading = odo.pose
+    landmark = (x + 2., y)
+
+    assert not odo.observe_landmark(landmark, 1., 0.)
+    assert not odo.observe_landmark(landmark, 2., 30.)
+    assert odo.pose == (x, y, heading)
+
+    # the landmark looks a bit closer: the robot is a bit further
+    assert odo.observe_landmark(landmark, 1.98, 0.)
+    assert x < odo.pose[0] < x + 0.02
+    assert odo.pose[1] == pytest.approx(y)
+
+
+def room():
+    """
+    Points on the walls of a room that is not symmetric, every 2cm, in the frame of the robot at (0, 0, 0).
+    """
+    walls = [((1., -0.8), (1., 0.8)), ((-0.5, 0.6), (1., 0.6)), ((0., -0.9), (1., -0.9)), ((-0.5, -0.2), (-0.5, 0.6))]
+    points = []
+    for (x0, y0), (x1, y1) in walls:
+        n = int(math.hypot(x1 - x0, y1 - y0) / 0.02) + 1
+        points.append(np.stack((np.linspace(x0, x1, n), np.linspace(y0, y1, n)), axis=1))
+    return np.concatenate(points)
+
+
+def grid_of(points):
+    grid = OccupancyGrid(cell_size=0.05, size=100)
+    for x, y in points:
+        grid.log_odds[grid.world_to_cell(x, y)] = 4.
+    return grid
+
+
+def seen_from(points, pose):
+    """
+    The points seen by the robot at (0, 0, 0), placed in the world with pose.
+    """
+    x, y, heading = pose
+    a = math.radians(heading)
+    rotation = np.array([[math.cos(a), -math.sin(a)], [math.sin(a), math.cos(a)]])
+    return points @ rotation.T + (x, y)
+
+
+def test_match_recovers_an_offset():
+    points = room()
+    grid = grid_of(points)
+    # the odometry is off by (5cm, -2.5cm, 2 degree), on the lattice of the candidates
+    pose = (0.05, -0.025, 2.)
+    result = grid.match(seen_from(points, pose), pose)
+    assert result is not None
+    (x, y, heading), score = result
+    # the position is found to one step of the lattice (2.5cm, half a cell): the candidates that put the points in the
+    # same cells have the same score
+    assert (x, y) == pytest.approx((0., 0.), abs=0.025 + 1e-9)
+    assert heading == pytest.approx(0., abs=1e-9)
+    assert score > 0.99 * 4.
+
+
+def test_match_keeps_a_good_pose():
+    points = room()
+    grid = grid_of(points)
+    pose = (0., 0., 0.)
+    assert grid.match(seen_from(points, pose), pose)[0] == pose
+
+
+def test_match_rejects():
+    points = room()
+    grid = grid_of(points)
+    assert grid.match(points[:10], (0., 0., 0.)) is None
+    # nothing to match in an empty grid
+    assert OccupancyGrid(cell_size=0.05, size=100).match(points, (0., 0., 0.)) is None
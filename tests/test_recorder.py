@@ -0,0 +1,126 @@
+import os
+import pickle
+
+import numpy as np
+import pytest
+
+from recorder import (COMMANDS, HEADER_SIZE, MAX_COMMAND_SIZE, OUTPUT, CommandRecorder, Recorder, Recording, Replayer,
+                      stream_path)
+from records import make_dtype
+
+
+FORMAT = ('timestamp', 'comp_id', 'distance', 'status')
+DTYPE = make_dtype(FORMAT)
+
+
+def msgs(timestamps):
+    return [(int(t), 3, 0.01 * i, 1) for i, t in enumerate(timestamps)]
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'sensor.out.rec')
+
+
+def test_round_trip(path):
+    recorder = Recorder(path, DTYPE, meta={'name': 'sensor', 'kind': OUTPUT, 'fields': list(FORMAT)}, chunk_records=4)
+    data = msgs(range(0, 100, 10))
+    recorder.append(data[0])
+    recorder.extend(data[1:4])
+    recorder.extend(np.array(data[4:], dtype=DTYPE).tobytes())
+    recorder.close()
+
+    recording = Recording(path)
+    assert recording.name == 'sensor' and recording.kind == OUTPUT and recording.meta['fields'] == list(FORMAT)
+    assert recording.records.dtype == DTYPE
+    assert recording.records.tolist() == data
+    assert (recording.start, recording.end) == (0, 90)
+
+
+def test_search_across_chunks_with_duplicates(path):
+    # runs of equal timestamps across the bounds of the chunks of 4 records
+    timestamps = [0, 1, 1, 1, 1, 1, 1, 2, 3, 3, 3, 3, 3, 3, 3, 3, 5, 8, 8, 8, 9]
+    recorder = Recorder(path, DTYPE, chunk_records=4)
+    recorder.extend(msgs(timestamps))
+    recorder.close()
+
+    recording = Recording(path)
+    for t in range(-1, 11):
+        for side in ('left', 'right'):
+            assert recording.search(t, side=side) == np.searchsorted(timestamps, t, side=side), (t, side)
+    for start, end in ((1, 3), (3, 4), (0, 100), (4, 5), (8, 9), (6, 7)):
+        expected = [t for t in timestamps if start <= t < end]
+        assert recording.between(start, end)['timestamp'].tolist() == expected
+
+
+def test_refresh_while_writing(path):
+    recorder = Recorder(path, DTYPE, chunk_records=4)
+    recording = Recording(path)
+    assert len(recording) == 0 and recording.start is None
+    assert len(recording.between(0, 100)) == 0
+
+    recorder.extend(msgs(range(3)))
+    assert len(recording) == 0
+    recording.refresh()
+    assert recording.records['timestamp'].tolist() == [0, 1, 2]
+
+    # the file grows by several chunks
+    recorder.extend(msgs(range(3, 15)))
+    recorder.append((15, 3, 0., 1))
+    recording.refresh()
+    assert recording.records['timestamp'].tolist() == list(range(16))
+    assert recording.between(5, 9)['timestamp'].tolist() == [5, 6, 7, 8]
+    recorder.close()
+
+
+def test_close_truncates(path):
+    recorder = Recorder(path, DTYPE, chunk_records=100)
+    recorder.extend(msgs(range(7)))
+    assert os.path.getsize(path) == HEADER_SIZE + 100 * DTYPE.itemsize
+    recorder.close()
+    assert os.path.getsize(path) == HEADER_SIZE + 7 * DTYPE.itemsize
+    recorder.close()
+    assert len(Recording(path)) == 7
+
+
+def test_commands(tmp_path):
+    path = str(tmp_path / 'wheel.cmd.rec')
+    recorder = CommandRecorder(path, meta={'name': 'wheel', 'kind': COMMANDS})
+    assert recorder.record(b'\x01\x02', timestamp=10)
+    assert recorder.record(('set_speed', (0.5,)), timestamp=20)
+    # too large: skipped and counted, the recording goes on
+    assert not recorder.record(('set_speed', (b'x' * MAX_COMMAND_SIZE,)), timestamp=30)
+    assert recorder.record(b'\x03' * MAX_COMMAND_SIZE, timestamp=40)
+    assert recorder.skipped == 1
+    recorder.close()
+
+    assert Recording(path).commands() == [(10, b'\x01\x02'), (20, ('set_speed', (0.5,))), (40, b'\x03' * MAX_COMMAND_SIZE)]
+    assert len(pickle.dumps(('set_speed', (0.5,)), pickle.HIGHEST_PROTOCOL)) <= MAX_COMMAND_SIZE
+
+
+def test_replay_as_fast_as_possible(tmp_path):
+    directory = str(tmp_path)
+    streams = {'a': np.arange(0, 10 ** 9, 10 ** 7), 'b': np.arange(5 * 10 ** 6, 10 ** 9, 3 * 10 ** 7)}
+    for name, timestamps in streams.items():
+        recorder = Recorder(stream_path(directory, name, OUTPUT), DTYPE, meta={'name': name, 'kind': OUTPUT, 'fields': list(FORMAT)})
+        recorder.extend(msgs(timestamps))
+        recorder.close()
+    CommandRecorder(stream_path(directory, 'a', COMMANDS), meta={'name': 'a', 'kind': COMMANDS}).close()
+
+    replayer = Replayer(directory, speed=None)
+    assert sorted(replayer.components) == ['a', 'b'] and list(replayer.commands) == ['a']
+    assert replayer.component('a').FORMAT == FORMAT
+
+    received = {name: [] for name in streams}
+    def on_step(t):
+        for name, comp in replayer.components.items():
+            records = comp.output_Q.drain()
+            # a message is released once the replay clock reaches it
+            assert (records['timestamp'] <= t).all()
+            received[name].extend(records['timestamp'].tolist())
+
+    wall = replayer.run(step=0.05, on_step=on_step)
+    assert wall < 1.
+    for name, timestamps in streams.items():
+        assert received[name] == timestamps.tolist()
+        assert replayer.component(name).output_Q.done()
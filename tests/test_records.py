@@ -0,0 +1,97 @@
+import queue
+
+import numpy as np
+import pytest
+
+from clock import now_ns
+from components import (DifferentialDriveComponent, DistanceRadarBaseComponent, DistanceRadarSensorComponent,
+                        ScanningRadarComponent, WheelComponent)
+from records import STATUS_CODES, STATUS_NAMES, RecordCodec, component_id, make_dtype, to_array
+from transport import MessageBatch, drain
+
+
+COMPONENTS = (DistanceRadarBaseComponent, DistanceRadarSensorComponent, ScanningRadarComponent, WheelComponent,
+              DifferentialDriveComponent)
+
+
+def sample_msgs(fields, n=5):
+    """
+    n messages of the fields, with a failed reading (NaN distance) when there is a distance.
+    """
+    comp_id = component_id('Test::{}'.format('_'.join(fields)))
+    start = now_ns()
+    statuses = sorted(STATUS_CODES.values())
+    msgs = []
+    for i in range(n):
+        values = {'timestamp': start + i * 1000003, 'comp_id': comp_id, 'status': statuses[i % len(statuses)],
+                  'repeat': 10 + i, 'distance': np.nan if i == 1 else 0.25 * i}
+        msgs.append(tuple(values.get(field, 0.001 * i - 0.5) for field in fields))
+    return msgs
+
+
+def assert_same(records, msgs):
+    assert len(records) == len(msgs)
+    for record, msg in zip(records, msgs):
+        for name, value in zip(records.dtype.names, msg):
+            if isinstance(value, float) and np.isnan(value):
+                assert np.isnan(record[name])
+            else:
+                assert record[name] == value
+
+
+@pytest.mark.parametrize('component', COMPONENTS, ids=lambda component: component.__name__)
+def test_codec_round_trip(component):
+    fields = component.FORMAT
+    assert RecordCodec.can_pack(fields)
+    codec = RecordCodec(fields)
+    assert codec.dtype == make_dtype(fields)
+    msgs = sample_msgs(fields)
+
+    one_by_one = b''.join(codec.encode(msg) for msg in msgs)
+    assert len(one_by_one) == len(msgs) * codec.itemsize
+    assert one_by_one == codec.encode_many(msgs)
+    assert_same(codec.decode(one_by_one), msgs)
+    assert_same(to_array(msgs, codec.dtype), msgs)
+    assert_same(to_array(one_by_one, codec.dtype), msgs)
+
+
+def test_failed_readings_and_status_codes():
+    codec = RecordCodec(DistanceRadarSensorComponent.FORMAT)
+    comp_id = component_id('Test::sensor')
+    msgs = [(now_ns(), comp_id, np.nan, code) for code in STATUS_CODES.values()]
+    # encode_many also accepts None for a float
+    records = codec.decode(codec.encode_many(msgs + [(now_ns(), comp_id, None, STATUS_CODES['FAIL'])]))
+
+    assert np.isnan(records['distance']).all()
+    assert [STATUS_NAMES[code] for code in records['status']] == list(STATUS_CODES) + ['FAIL']
+    assert records.dtype['status'] == np.uint8
+
+
+def test_drain_keeps_the_order_of_mixed_batches():
+    fields = ScanningRadarComponent.FORMAT
+    codec = RecordCodec(fields)
+    msgs = sample_msgs(fields, n=9)
+
+    Q = queue.Queue()
+    Q.put(msgs[0])
+    Q.put(MessageBatch(msgs[1:3]))
+    Q.put(codec.encode_many(msgs[3:5]))
+    Q.put(msgs[5])
+    Q.put(codec.encode_many(msgs[6:8]))
+    Q.put(MessageBatch(msgs[8:]))
+
+    records = drain(Q, codec.dtype)
+    assert Q.empty()
+    assert records.dtype == codec.dtype
+    assert_same(records, msgs)
+
+
+def test_drain_without_dtype():
+    msgs = sample_msgs(WheelComponent.FORMAT, n=4)
+    Q = queue.Queue()
+    Q.put(msgs[0])
+    Q.put(MessageBatch(msgs[1:3]))
+    Q.put(msgs[3])
+    assert drain(Q) == msgs
+    assert drain(Q) == []
+    assert len(drain(Q, make_dtype(WheelComponent.FORMAT))) == 0
@@ -0,0 +1,107 @@
+import multiprocessing as mp
+import queue
+
+import numpy as np
+import pytest
+
+from transport import SharedRingQueue, MessageBatch, drain
+
+
+FORMAT = ('timestamp', 'comp_id', 'pos', 'distance', 'status')
+
+
+@pytest.fixture
+def ring():
+    Q = SharedRingQueue(FORMAT, capacity=8)
+    yield Q
+    Q.close()
+
+
+def msg(i):
+    return (i, 1, float(i), i / 10., 0)
+
+
+def test_put_get_order(ring):
+    for i in range(5):
+        ring.put(msg(i))
+    assert ring.qsize() == 5
+    assert [ring.get()[0] for _ in range(5)] == list(range(5))
+    assert ring.empty()
+
+
+def test_get_empty_raises(ring):
+    with pytest.raises(queue.Empty):
+        ring.get_nowait()
+    with pytest.raises(queue.Empty):
+        ring.get(timeout=0.01)
+
+
+def test_put_full_raises(ring):
+    for i in range(8):
+        ring.put_nowait(msg(i))
+    assert ring.full()
+    with pytest.raises(queue.Full):
+        ring.put_nowait(msg(8))
+    with pytest.raises(queue.Full):
+        ring.put(msg(8), timeout=0.01)
+
+
+def test_wraparound(ring):
+    # the head and the tail go around the ring several times, also in the middle of a batch
+    expected = []
+    i = 0
+    for n in (5, 6, 7, 3, 8, 1):
+        batch = [msg(i + k) for k in range(n)]
+        i += n
+        ring.put_many(batch)
+        expected.extend(m[0] for m in batch)
+        out = ring.drain()
+        assert out['timestamp'].tolist() == expected[-n:]
+    assert ring.empty()
+
+
+def test_drain_max_items_keeps_the_rest(ring):
+    for i in range(6):
+        ring.put(msg(i))
+    assert ring.drain(max_items=4)['timestamp'].tolist() == [0, 1, 2, 3]
+    assert ring.get()[0] == 4
+    assert drain(ring)['timestamp'].tolist() == [5]
+
+
+def test_message_batch(ring):
+    ring.put(MessageBatch([msg(1), msg(2)]))
+    out = ring.drain()
+    assert out['timestamp'].tolist() == [1, 2]
+    assert out.dtype == ring.dtype
+
+
+def _produce(Q, n):
+    for i in range(n):
+        # every field of a record carries i, so a torn record is visible
+        Q.put((i, i % 60000, float(i), float(i), i % 100))
+
+
+@pytest.mark.skipif('fork' not in mp.get_all_start_methods(), reason='needs fork')
+def test_two_processes_keep_order_and_records_whole():
+    Q = SharedRingQueue(FORMAT, capacity=64)
+    n = 20000
+    producer = mp.get_context('fork').Process(target=_produce, args=(Q, n))
+    producer.start()
+    chunks = []
+    received = 0
+    while received < n:
+        out = Q.drain()
+        if len(out) == 0:
+            producer.join(0.0001)
+            continue
+        chunks.append(out)
+        received += len(out)
+    producer.join(5)
+    Q.close()
+
+    out = np.concatenate(chunks)
+    i = np.arange(n)
+    assert (out['timestamp'] == i).all()
+    assert (out['comp_id'] == i % 60000).all()
+    assert (out['pos'] == i).all() and (out['distance'] == i).all()
+    assert (out['status'] == i % 100).all()
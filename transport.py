@@ -0,0 +1,585 @@
+import pickle
+import queue
+import struct
+import time
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from records import make_dtype, to_array
+
+
+class MessageBatch(list):
+    """
+    A list of messages sent as a single item of a queue. See BatchPublisher and drain.
+    """
+    pass
+
+
+
+class BatchPublisher:
+    """
+    Accumulate the messages locally and put them in the queue as one MessageBatch, so the cost of the queue (pickling,
+    pipe write) is paid once per batch instead of once per message.
+
+    The batch is flushed when it has batch_size messages or when its first message is older than batch_age seconds,
+    which is checked by put and by poll.
+
+    Args of __init__:
+        Q:          the queue that receives the batches.
+        batch_size: int. The maximum number of messages in a batch. None means no limit.
+        batch_age:  float. The maximum age (in second) of the first message of the batch. None means no limit.
+        codec:      records.RecordCodec. If it is set, the batch is sent as the bytes of its records instead of a
+                    MessageBatch of tuples. The consumer needs the dtype to read it, see drain.
+    """
+    def __init__(self, Q, batch_size=None, batch_age=None, codec=None):
+        assert batch_size is not None or batch_age is not None
+        self._Q = Q
+        self._codec = codec
+        self._batch_size = batch_size
+        self._batch_age = batch_age
+        self._msgs = MessageBatch()
+        self._first = None
+
+    def put(self, msg):
+        msgs = self._msgs
+        if self._batch_age is not None and not msgs:
+            self._first = time.monotonic()
+        msgs.append(msg)
+
+        if self._batch_size is not None and len(msgs) >= self._batch_size:
+            self.flush()
+        elif self._batch_age is not None and time.monotonic() - self._first >= self._batch_age:
+            self.flush()
+
+    def poll(self):
+        """
+        Flush the batch if its first message is older than batch_age. The owner calls it regularly, so a partial batch
+        is sent in time even when no more messages come.
+        """
+        if self._msgs and self._batch_age is not None and time.monotonic() - self._first >= self._batch_age:
+            self.flush()
+
+    def flush(self):
+        if self._msgs:
+            self._Q.put(self._msgs if self._codec is None else self._codec.encode_many(self._msgs))
+            self._msgs = MessageBatch()
+
+    def __len__(self):
+        return len(self._msgs)
+
+
+
+def drain(Q, dtype=None):
+    """
+    Get all the messages available in the queue. The batches are unpacked, so the result is the list of messages.
+
+    If dtype is set, the result is a structured array of this dtype (see records.make_dtype) and the batches packed
+    by a BatchPublisher with a codec are decoded. A queue that can drain itself (e.g. SharedRingQueue) returns a
+    structured array too.
+    """
+    if hasattr(Q, 'drain'):
+        return Q.drain()
+
+    msgs = []
+    chunks = []
+    while not Q.empty():
+        msg = Q.get()
+        if isinstance(msg, MessageBatch):
+            msgs.extend(msg)
+        elif isinstance(msg, bytes):
+            assert dtype is not None, 'The dtype is needed to read the packed batches.'
+            # the messages keep their order
+            if msgs:
+                chunks.append(to_array(msgs, dtype))
+                msgs = []
+            chunks.append(np.frombuffer(msg, dtype=dtype))
+        else:
+            msgs.append(msg)
+
+    if dtype is None:
+        return msgs
+    if msgs or not chunks:
+        chunks.append(to_array(msgs, dtype))
+    return chunks[0] if len(chunks) == 1 else np.concatenate(chunks)
+
+
+class CommandChannel:
+    """
+    Command queue of a component with a pollable handle.
+
+    The commands go through a pipe. A shared counter of sent commands lets the component check for pending commands
+    without any system call, and wait lets it sleep until a command arrives or a deadline expires. put and get have
+    the same interface as multiprocessing.Queue, so the channel can be used as the cmd_Q of a ContinuousComponentWrapper.
+
+    Every command is stamped with time.monotonic (the same clock in all processes) when it is sent. The delay between
+    sending and executing the commands is available through latency.
+
+    A command in wire form (bytes, see commands.py) is written to the pipe as is, behind a 9-byte header (timestamp,
+    kind). Any other command is pickled.
+
+    Note:
+        Several processes can put commands, but only one process should get them.
+    """
+    HEADER = struct.Struct('<dB')    # time.monotonic of the put, kind of the payload
+    BYTES   = 0
+    PICKLED = 1
+
+    def __init__(self):
+        self._reader, self._writer = mp.Pipe(duplex=False)
+        self._lock = mp.Lock()
+        self._sent = mp.RawValue('Q', 0)
+        self._received = 0
+        self._last_sent = None
+
+        # count, sum, last and max of the command latency. Written by the consumer only.
+        self._latency = mp.RawArray('d', 4)
+
+    def put(self, cmd, block=True, timeout=None):
+        if isinstance(cmd, bytes):
+            frame = self.HEADER.pack(time.monotonic(), self.BYTES) + cmd
+        else:
+            frame = self.HEADER.pack(time.monotonic(), self.PICKLED) + pickle.dumps(cmd, pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._writer.send_bytes(frame)
+            self._sent.value += 1
+
+    def pending(self):
+        """
+        True if a command has been sent and not received yet. It does not make any system call.
+        """
+        return self._sent.value != self._received
+
+    def wait(self, timeout=None):
+        """
+        Wait until a command is pending or the timeout (in second) expires. Return True if a command is pending.
+        """
+        if self._sent.value != self._received:
+            return True
+        return self._reader.poll(timeout)
+
+    def get(self, block=True, timeout=None):
+        if not self._reader.poll(None if block and timeout is None else (timeout if block else 0)):
+            raise queue.Empty
+        frame = self._reader.recv_bytes()
+        self._received += 1
+        self._last_sent, kind = self.HEADER.unpack_from(frame)
+        if kind == self.BYTES:
+            return frame[self.HEADER.size:]
+        return pickle.loads(frame[self.HEADER.size:])
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def empty(self):
+        return not self.pending()
+
+    def executed(self):
+        """
+        Record the latency of the last command received. The consumer calls it once the command has been executed.
+        """
+        if self._last_sent is None:
+            return
+        latency = time.monotonic() - self._last_sent
+        self._last_sent = None
+
+        stats = self._latency
+        stats[0] += 1
+        stats[1] += latency
+        stats[2] = latency
+        stats[3] = max(stats[3], latency)
+
+    @property
+    def latency(self):
+        """
+        Statistics (in second) of the delay between sending and executing the commands.
+        """
+        count, total, last, max_latency = self._latency[:]
+        return {'count': int(count), 'mean': total / count if count else None, 'last': last if count else None,
+                'max': max_latency if count else None}
+
+
+
+class SharedRingQueue:
+    """
+    Single-producer/single-consumer queue of fixed-size records in shared memory.
+
+    The records follow a component FORMAT, like the rows of a RawDataHandler. put and get have the same interface as
+    multiprocessing.Queue, so the ring can be used as the output_Q of a ContinuousComponentWrapper. The consumer can
+    also drain all the available records at once as a structured array, without unpickling anything.
+
+    Args of __init__:
+        fields:   tuple of field names, usually the FORMAT attribute of the producer component.
+        capacity: the number of records the ring can hold. put blocks (or raises queue.Full) when the ring is full.
+        dtypes:   dict. Overrides the default dtype of some fields. See records.make_dtype.
+
+    Note:
+        The head (written by the producer only) and the tail (written by the consumer only) are 64-bit counters in
+        the header of the shared memory block. A record is written before the head is published, so the consumer never
+        reads a partial record. The ring has to be created before the processes are forked, or passed to them as an
+        argument, and exactly one process should put and one process should get.
+
+        The stores of NumPy carry no ordering guarantee, and the ARM CPU of the Pi may reorder them: the consumer could
+        see the new head before the record. So the counters are only read and written under a multiprocessing.Lock,
+        whose acquire and release are memory barriers. The lock is held for one load or store, never while a record
+        is copied, so the producer and the consumer do not wait for each other. It costs about 1 us per put or get.
+    """
+    HEADER_SIZE = 128
+    HEAD = 0    # index of the head counter in the header, in uint64
+    TAIL = 8    # the tail is on its own cache line
+    POLL_INTERVAL = 0.0001
+
+    def __init__(self, fields=None, capacity=4096, dtypes=None):
+        assert fields is not None and capacity > 0
+
+        self._dtype = make_dtype(fields, dtypes)
+        self._capacity = capacity
+        self._owner = True
+        self._shm = shared_memory.SharedMemory(create=True, size=self.HEADER_SIZE + capacity * self._dtype.itemsize)
+        self._lock = mp.Lock()
+        self._attach()
+        self._ctrl[:] = 0
+
+    def _attach(self):
+        self._ctrl = np.ndarray(self.HEADER_SIZE // 8, dtype=np.uint64, buffer=self._shm.buf)
+        self._records = np.ndarray(self._capacity, dtype=self._dtype, buffer=self._shm.buf, offset=self.HEADER_SIZE)
+        # the last tail seen by the producer and the last head seen by the consumer. The ring has at least this much
+        # room, or this many records, so the counter of the other process is only loaded when they are not enough.
+        self._seen_tail = 0
+        self._seen_head = 0
+
+    def _load(self, index):
+        # read a counter of the other process, after the stores it made before publishing it
+        with self._lock:
+            return int(self._ctrl[index])
+
+    def _store(self, index, value):
+        # publish a counter, after the stores made before it
+        with self._lock:
+            self._ctrl[index] = value
+
+    def __getstate__(self):
+        # only used by the spawn/forkserver start methods. The other process attaches to the same block.
+        return {'name': self._shm.name, 'dtype': self._dtype.descr, 'capacity': self._capacity, 'lock': self._lock}
+
+    def __setstate__(self, state):
+        self._dtype = np.dtype(state['dtype'])
+        self._capacity = state['capacity']
+        self._lock = state['lock']
+        self._owner = False
+        self._shm = shared_memory.SharedMemory(name=state['name'])
+        self._attach()
+
+    def _wait(self, ready, block, timeout, exception):
+        if not block:
+            raise exception
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not ready():
+            if deadline is not None and time.monotonic() > deadline:
+                raise exception
+            time.sleep(self.POLL_INTERVAL)
+
+    def put(self, msg, block=True, timeout=None):
+        """
+        Write one record. msg is a tuple whose items follow the order of the fields, or a MessageBatch.
+        """
+        if isinstance(msg, MessageBatch):
+            self.put_many(msg, block=block, timeout=timeout)
+            return
+
+        cap = self._capacity
+        head = int(self._ctrl[self.HEAD])
+        if head - self._seen_tail >= cap:
+            self._seen_tail = self._load(self.TAIL)
+            if head - self._seen_tail >= cap:
+                self._wait(lambda: head - self._load(self.TAIL) < cap, block, timeout, queue.Full)
+                self._seen_tail = self._load(self.TAIL)
+
+        self._records[head % cap] = msg
+        self._store(self.HEAD, head + 1)
+
+    def put_many(self, msgs, block=True, timeout=None):
+        """
+        Write a batch of records at once. msgs is a sequence of tuples or a structured array.
+        """
+        msgs = to_array(msgs, self._dtype)
+
+        cap = self._capacity
+        n = len(msgs)
+        assert n <= cap, 'The batch does not fit in the ring.'
+
+        head = int(self._ctrl[self.HEAD])
+        if head - self._seen_tail > cap - n:
+            self._seen_tail = self._load(self.TAIL)
+            if head - self._seen_tail > cap - n:
+                self._wait(lambda: head - self._load(self.TAIL) <= cap - n, block, timeout, queue.Full)
+                self._seen_tail = self._load(self.TAIL)
+
+        start = head % cap
+        first = min(n, cap - start)
+        self._records[start:start + first] = msgs[:first]
+        self._records[:n - first] = msgs[first:]
+        self._store(self.HEAD, head + n)
+
+    def put_nowait(self, msg):
+        self.put(msg, block=False)
+
+    def get(self, block=True, timeout=None):
+        """
+        Read one record. It is returned as a tuple, like the message that was put.
+        """
+        tail = int(self._ctrl[self.TAIL])
+        if self._seen_head == tail:
+            self._seen_head = self._load(self.HEAD)
+            if self._seen_head == tail:
+                self._wait(lambda: self._load(self.HEAD) != tail, block, timeout, queue.Empty)
+                self._seen_head = self._load(self.HEAD)
+
+        msg = self._records[tail % self._capacity].item()
+        self._store(self.TAIL, tail + 1)
+        return msg
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def drain(self, max_items=None):
+        """
+        Read all the available records, at most max_items. The records are returned as a structured array, in the
+        order they were put.
+        """
+        tail = int(self._ctrl[self.TAIL])
+        self._seen_head = self._load(self.HEAD)
+        n = self._seen_head - tail
+        if max_items is not None:
+            n = min(n, max_items)
+        if n <= 0:
+            return np.empty(0, dtype=self._dtype)
+
+        start = tail % self._capacity
+        stop = start + n
+        if stop <= self._capacity:
+            out = self._records[start:stop].copy()
+        else:
+            out = np.concatenate((self._records[start:], self._records[:stop - self._capacity]))
+
+        self._store(self.TAIL, tail + n)
+        return out
+
+    def qsize(self):
+        with self._lock:
+            return int(self._ctrl[self.HEAD]) - int(self._ctrl[self.TAIL])
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def full(self):
+        return self.qsize() >= self._capacity
+
+    def close(self):
+        """
+        Release the shared memory. The process that created the ring also destroys the block.
+        """
+        self._ctrl = None
+        self._records = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+
+class LatestValue:
+    """
+    A conflating channel in shared memory: it holds only the latest record put by the producer. A put overwrites the
+    previous record, read or not, so the producer never blocks and nothing accumulates when the consumer is slow. The
+    consumer always reads the newest record in O(1).
+
+    It is meant for the status of the components (e.g. the pulses of the wheels), where only the current value matters.
+    It has the methods of a multiprocessing.Queue that the wrapper and the consumers use (put, get, drain, qsize...), so
+    it can be the output_Q of a ContinuousComponentWrapper.
+
+    Args of __init__:
+        fields: tuple of field names, usually the FORMAT attribute of the producer component.
+        dtypes: dict. Overrides the default dtype of some fields. See records.make_dtype.
+
+    Note:
+        The record is protected by a seqlock. The sequence counter is odd while the producer writes the record and even
+        otherwise; the consumer copies the record and retries if the counter was odd or changed meanwhile, so it never
+        returns a partial record and the producer never waits for it. seq // 2 is the number of records put.
+
+        The consumer publishes the sequence of the last record it read, so a record is unread until the next get or
+        drain, and the records overwritten before being read are counted (see overwritten). Exactly one process should
+        put and one process should get, as with SharedRingQueue.
+
+        As in SharedRingQueue, the counters are only read and written under a multiprocessing.Lock, so the stores of
+        the record and of the sequence are not reordered on the ARM CPU of the Pi. The lock is never held while the
+        record is copied: the producer only waits for a single load of the consumer.
+    """
+    HEADER_SIZE = 128
+    SEQ = 0           # index of the sequence counter in the header, in uint64
+    READ = 8          # the sequence of the last record read, on its own cache line
+    OVERWRITTEN = 9   # the number of records that were never read
+    POLL_INTERVAL = 0.0001
+
+    def __init__(self, fields=None, dtypes=None):
+        assert fields is not None
+
+        self._dtype = make_dtype(fields, dtypes)
+        self._owner = True
+        self._shm = shared_memory.SharedMemory(create=True, size=self.HEADER_SIZE + self._dtype.itemsize)
+        self._lock = mp.Lock()
+        self._attach()
+        self._ctrl[:] = 0
+
+    def _attach(self):
+        self._ctrl = np.ndarray(self.HEADER_SIZE // 8, dtype=np.uint64, buffer=self._shm.buf)
+        self._record = np.ndarray(1, dtype=self._dtype, buffer=self._shm.buf, offset=self.HEADER_SIZE)
+
+    def __getstate__(self):
+        # only used by the spawn/forkserver start methods. The other process attaches to the same block.
+        return {'name': self._shm.name, 'dtype': self._dtype.descr, 'lock': self._lock}
+
+    def __setstate__(self, state):
+        self._dtype = np.dtype(state['dtype'])
+        self._owner = False
+        self._shm = shared_memory.SharedMemory(name=state['name'])
+        self._lock = state['lock']
+        self._attach()
+
+    def _load(self, index):
+        with self._lock:
+            return int(self._ctrl[index])
+
+    def _store(self, index, value):
+        with self._lock:
+            self._ctrl[index] = value
+
+    def put(self, msg, block=True, timeout=None):
+        """
+        Replace the record. msg is a tuple whose items follow the order of the fields, or a batch (MessageBatch or
+        packed records, see BatchPublisher) of which only the last message is kept. It never blocks: block and timeout
+        are only accepted for compatibility with the queues.
+        """
+        if isinstance(msg, (MessageBatch, bytes)):
+            msgs = np.frombuffer(msg, dtype=self._dtype) if isinstance(msg, bytes) else msg
+            if len(msgs) == 0:
+                return
+            msg = msgs[-1]
+
+        # converted first, so a bad message raises before the record is locked
+        msg = np.array(msg, dtype=self._dtype)
+        seq = int(self._ctrl[self.SEQ])
+        self._store(self.SEQ, seq + 1)
+        self._record[0] = msg
+        self._store(self.SEQ, seq + 2)
+
+    def put_many(self, msgs, block=True, timeout=None):
+        if len(msgs):
+            self.put(msgs[-1])
+
+    def put_nowait(self, msg):
+        self.put(msg)
+
+    def _read(self):
+        # the sequence and a copy of a consistent record
+        while True:
+            seq = self._load(self.SEQ)
+            if seq & 1:
+                time.sleep(0)
+                continue
+            record = self._record.copy()
+            if self._load(self.SEQ) == seq:
+                return seq, record
+
+    def _consume(self, seq):
+        # mark the record seq as read and count the records that were overwritten before it
+        read = int(self._ctrl[self.READ])
+        if seq - read > 2:
+            self._store(self.OVERWRITTEN, int(self._ctrl[self.OVERWRITTEN]) + (seq - read) // 2 - 1)
+        self._store(self.READ, seq)
+
+    def latest(self):
+        """
+        The latest record as a tuple, read or not. None if nothing was put yet.
+        """
+        seq, record = self._read()
+        if seq == 0:
+            return None
+        return record[0].item()
+
+    def get(self, block=True, timeout=None):
+        """
+        Read the latest record if it was not read yet. It is returned as a tuple, like the message that was put.
+        Otherwise wait for the next one, or raise queue.Empty if block is False or after timeout seconds.
+        """
+        read = int(self._ctrl[self.READ])
+        if self._load(self.SEQ) == read:
+            if not block:
+                raise queue.Empty
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while self._load(self.SEQ) == read:
+                if deadline is not None and time.monotonic() > deadline:
+                    raise queue.Empty
+                time.sleep(self.POLL_INTERVAL)
+
+        seq, record = self._read()
+        self._consume(seq)
+        return record[0].item()
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def drain(self, max_items=None):
+        """
+        The latest record as a structured array of length 1 if it was not read yet, of length 0 otherwise.
+        """
+        if max_items == 0 or self._load(self.SEQ) == int(self._ctrl[self.READ]):
+            return np.empty(0, dtype=self._dtype)
+        seq, record = self._read()
+        self._consume(seq)
+        return record
+
+    def qsize(self):
+        with self._lock:
+            return int(self._ctrl[self.SEQ] != self._ctrl[self.READ])
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def full(self):
+        return False
+
+    def close(self):
+        """
+        Release the shared memory. The process that created the channel also destroys the block.
+        """
+        self._ctrl = None
+        self._record = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+    @property
+    def count(self):
+        """
+        The number of records put.
+        """
+        return self._load(self.SEQ) // 2
+
+    @property
+    def overwritten(self):
+        """
+        The number of records that were replaced before being read.
+        """
+        return self._load(self.OVERWRITTEN)
@@ -1,43 +1,238 @@
 
-import RPi.GPIO as gpio
+from gpio_backend import gpio
 import time
 
-import numpy as np 
+import numpy as np
 
 gpio.setmode(gpio.BOARD)
 
+
+def _sleep_until(deadline_ns, spin_ns):
+    # sleep, then spin on the clock for the last spin_ns, because time.sleep overshoots
+    remaining = deadline_ns - time.perf_counter_ns()
+    if remaining > spin_ns:
+        time.sleep((remaining - spin_ns) * 1e-9)
+    while time.perf_counter_ns() < deadline_ns:
+        pass
+
+
+def _wait_until(deadline_ns, spin_ns, wait=None):
+    # like _sleep_until, but the sleep is done by wait(timeout), which returns True when it is interrupted. Return
+    # False if it was interrupted before the deadline.
+    if wait is not None:
+        remaining = deadline_ns - time.perf_counter_ns()
+        if remaining > spin_ns and wait((remaining - spin_ns) * 1e-9):
+            return False
+    _sleep_until(deadline_ns, spin_ns)
+    return True
+
+
+class ErrorHistogram:
+    """
+    Histogram of timing errors (achieved - requested), in nanoseconds. Recording an error is a few integer operations,
+    so it can be done on every pulse.
+
+    Args of __init__:
+        bin_width: the width of a bin, in nanoseconds.
+        n_bins:    the number of bins. The bins are centered on 0 and the errors outside the range are counted in the
+                   first or the last bin.
+    """
+    def __init__(self, bin_width=10000, n_bins=201):
+        self._bin_width = bin_width
+        self._n_bins = n_bins
+        self._offset = (n_bins // 2) * bin_width + bin_width // 2
+        self.reset()
+
+    def reset(self):
+        self._counts = [0] * self._n_bins
+        self._count = 0
+        self._sum = 0
+        self._max_abs = 0
+
+    def record(self, error):
+        i = (error + self._offset) // self._bin_width
+        if i < 0:
+            i = 0
+        elif i >= self._n_bins:
+            i = self._n_bins - 1
+        self._counts[i] += 1
+        self._count += 1
+        self._sum += error
+        if abs(error) > self._max_abs:
+            self._max_abs = abs(error)
+
+    @property
+    def counts(self):
+        return np.array(self._counts)
+
+    @property
+    def bin_centers(self):
+        """
+        The center of each bin, in nanoseconds.
+        """
+        return (np.arange(self._n_bins) - self._n_bins // 2) * self._bin_width
+
+    @property
+    def summary(self):
+        """
+        count, mean and max absolute error (in nanoseconds) of the recorded errors.
+        """
+        return {'count': self._count, 'mean': self._sum / self._count if self._count else None, 'max_abs': self._max_abs}
+
+
+
 class WheelMotor:
+    """
+    Continuous rotation servo. The speed is controlled by the length of the pulses sent to the motor every
+    (pulse + width) seconds.
+
+    Args of __init__:
+        pin_signal:          the pin number for sending the pulse to the motor.
+        reference_pulse:     the pulse (in second) that makes the motor still.
+        max_pulse_deviation: the maximum deviation of the pulse from the reference pulse.
+        width:               the length (in second) of the silence after a pulse.
+        use_pwm:             bool. Generate the pulses with gpio.PWM instead of timing each edge in Python.
+        spin_threshold:      float. The last spin_threshold seconds before an edge are spent spinning on the clock instead
+                             of sleeping, because time.sleep overshoots.
+
+    Note:
+        The edges are scheduled against absolute time.perf_counter_ns deadlines, so the errors do not accumulate over the
+        pulse train. generate_pulse returns after the last falling edge and the silence is enforced by the next call,
+        which continues the same train without drift. pulse_once sends a single period of the train, so a loop can
+        change the pulse between two periods. The achieved errors are recorded in pulse_error and period_error.
+    """
     # default setting
     REFERENCE_PULSE     = 0.0014454
     MAX_PULSE_DEVIATION = 0.00025
     WIDTH               = 0.020
-    def __init__(self, pin_signal=None, reference_pulse=None, max_pulse_deviation=None, width=None):
+    SPIN_THRESHOLD      = 0.0002
+    def __init__(self, pin_signal=None, reference_pulse=None, max_pulse_deviation=None, width=None, use_pwm=False, spin_threshold=SPIN_THRESHOLD):
         assert pin_signal is not None
+        assert not use_pwm or hasattr(gpio, 'PWM'), 'PWM is not supported by the GPIO library.'
         self._pin_signal = pin_signal
 
         # if use does not specify the configuration of the motor, the default setting is used.
         self._reference_pulse = reference_pulse if reference_pulse is not None else WheelMotor.REFERENCE_PULSE
         self._max_pulse_deviation = max_pulse_deviation if max_pulse_deviation is not None else WheelMotor.MAX_PULSE_DEVIATION
         self._width = width if width is not None else WheelMotor.WIDTH
+        self._spin_ns = int(spin_threshold * 1e9)
+
+        # absolute time of the next rising edge and of the last one
+        self._next_rise_ns = None
+        self._last_rise_ns = None
 
+        self._pulse_error = ErrorHistogram()
+        self._period_error = ErrorHistogram()
 
         gpio.setup(self._pin_signal, gpio.OUT, initial=0)
 
-    def generate_pulse(self, repeat=10, pulse=None, width=None):
+        self._pwm = None
+        self._pwm_setting = None
+        if use_pwm:
+            self._pwm = gpio.PWM(self._pin_signal, 1. / (self._reference_pulse + self._width))
+            self._pwm.start(0)
+
+    def _schedule(self, period_ns):
+        # the next rising edge of the pulse train. The train continues if we are not late, otherwise a new one starts.
+        now = time.perf_counter_ns()
+        rise = self._next_rise_ns
+        if rise is None or now - rise > period_ns:
+            rise = now
+            self._next_rise_ns = rise
+            self._last_rise_ns = None
+        return rise
+
+    def generate_pulse(self, repeat=10, pulse=None, width=None, preempt=None):
+        """
+        Send repeat pulses to the motor.
+
+        Args:
+            preempt: callable. It is checked after each pulse and the pulse train stops when it returns True.
+        """
+        for n in range(repeat):
+            self.pulse_once(pulse, width)
+            if preempt is not None and preempt():
+                break
+
+    def pulse_once(self, pulse=None, width=None, wait=None):
+        """
+        Send the next pulse of the pulse train: wait for its rising edge, then hold the signal for pulse seconds. It is
+        one period of the train, the caller can change the pulse between two calls.
+
+        Args:
+            wait: callable. wait(timeout) sleeps at most timeout seconds and returns True if it was interrupted, e.g.
+                  Component.idle. It is used during the silence before the rising edge. When it is interrupted, the
+                  pulse is not sent and the rising edge stays scheduled, so the next call still sends it on time.
+
+        Return:
+            True if the pulse was sent.
+        """
         if pulse is None:
-            pulse = WheelMotor.reference_pulse
+            pulse = self.reference_pulse
         if width is None:
-            width = WheelMotor.width
+            width = self.width
 
         assert pulse <= self.reference_pulse + self.max_pulse_deviation
 
+        if self._pwm is not None:
+            return self._pwm_period(pulse, width, wait)
+
         pin = self._pin_signal
+        pulse_ns = int(pulse * 1e9)
+        period_ns = pulse_ns + int(width * 1e9)
+
+        rise = self._schedule(period_ns)
+        if not _wait_until(rise, self._spin_ns, wait):
+            return False
+        gpio.output(pin,1)
+        rise_ns = time.perf_counter_ns()
+
+        # the length of the pulse is what the motor sees, so it is timed from the actual rising edge
+        _sleep_until(rise_ns + pulse_ns, self._spin_ns)
         gpio.output(pin,0)
-        for n in range(repeat):
-            gpio.output(pin,1)
-            time.sleep(pulse)
-            gpio.output(pin,0)
-            time.sleep(width)
+        fall_ns = time.perf_counter_ns()
+
+        self._pulse_error.record(fall_ns - rise_ns - pulse_ns)
+        if self._last_rise_ns is not None:
+            self._period_error.record(rise_ns - self._last_rise_ns - period_ns)
+        self._last_rise_ns = rise_ns
+        self._next_rise_ns = rise + period_ns
+        return True
+
+    def _set_pwm(self, pulse, width):
+        if self._pwm_setting != (pulse, width):
+            period = pulse + width
+            self._pwm.ChangeFrequency(1. / period)
+            self._pwm.ChangeDutyCycle(100. * pulse / period)
+            self._pwm_setting = (pulse, width)
+
+    def _pwm_period(self, pulse, width, wait):
+        # the PWM sends the pulses, the period is only paced
+        self._set_pwm(pulse, width)
+        period_ns = int((pulse + width) * 1e9)
+        rise = self._schedule(period_ns)
+        if not _wait_until(rise, self._spin_ns, wait):
+            return False
+        self._next_rise_ns = rise + period_ns
+        return True
+
+    def reset_stats(self):
+        self._pulse_error.reset()
+        self._period_error.reset()
+
+    @property
+    def pulse_error(self):
+        """
+        ErrorHistogram of achieved - requested pulse length.
+        """
+        return self._pulse_error
+
+    @property
+    def period_error(self):
+        """
+        ErrorHistogram of achieved - requested period (time between two rising edges).
+        """
+        return self._period_error
 
     @property
     def reference_pulse(self):
@@ -51,10 +246,142 @@ class WheelMotor:
     def width(self):
         return self._width
 
+    @property
+    def use_pwm(self):
+        return self._pwm is not None
+
+
+
+class DifferentialDriveMotor:
+    """
+    The two wheel motors of a differential drive, driven by a single timing loop.
+
+    The pulse trains of the two wheels share their rising edges: each period, both pins go up together and each pin
+    goes down after its own pulse, the shorter one first. A new pair of pulses therefore reaches both motors within the
+    same period, instead of up to a period apart with two independent loops.
+
+    Args of __init__:
+        left:  WheelMotor of the left wheel.
+        right: WheelMotor of the right wheel.
+
+    Note:
+        The period is the longer pulse plus the width, so each motor sees at least width seconds of silence. The
+        achieved errors are recorded in the pulse_error and period_error of each WheelMotor.
+    """
+    def __init__(self, left=None, right=None):
+        assert isinstance(left, WheelMotor) and isinstance(right, WheelMotor)
+        assert left.use_pwm == right.use_pwm, 'The two motors use the same way of generating the pulses.'
+        self._left = left
+        self._right = right
+        self._spin_ns = left._spin_ns
+
+        self._next_rise_ns = None
+        self._last_rise_ns = None
+
+    def _schedule(self, period_ns):
+        # see WheelMotor._schedule
+        now = time.perf_counter_ns()
+        rise = self._next_rise_ns
+        if rise is None or now - rise > period_ns:
+            rise = now
+            self._next_rise_ns = rise
+            self._last_rise_ns = None
+        return rise
+
+    def generate_pulse(self, repeat=10, left_pulse=None, right_pulse=None, width=None, preempt=None):
+        """
+        Send repeat pairs of pulses to the motors.
+
+        Args:
+            preempt: callable. It is checked after each period and the pulse trains stop when it returns True.
+        """
+        for n in range(repeat):
+            self.pulse_once(left_pulse, right_pulse, width)
+            if preempt is not None and preempt():
+                break
+
+    def pulse_once(self, left_pulse=None, right_pulse=None, width=None, wait=None):
+        """
+        Send the next pair of pulses. See WheelMotor.pulse_once.
+
+        Return:
+            True if the pulses were sent.
+        """
+        left, right = self._left, self._right
+        if left_pulse is None:
+            left_pulse = left.reference_pulse
+        if right_pulse is None:
+            right_pulse = right.reference_pulse
+        if width is None:
+            width = left.width
+
+        assert left_pulse <= left.reference_pulse + left.max_pulse_deviation
+        assert right_pulse <= right.reference_pulse + right.max_pulse_deviation
+
+        if left.use_pwm:
+            return self._pwm_period(left_pulse, right_pulse, width, wait)
+
+        # the first pin to go down, then the second one
+        pins = ((left._pin_signal, int(left_pulse * 1e9), left), (right._pin_signal, int(right_pulse * 1e9), right))
+        if pins[1][1] < pins[0][1]:
+            pins = pins[::-1]
+        (first_pin, first_ns, first), (second_pin, second_ns, second) = pins
+        period_ns = second_ns + int(width * 1e9)
+
+        rise = self._schedule(period_ns)
+        if not _wait_until(rise, self._spin_ns, wait):
+            return False
+        gpio.output(first_pin, 1)
+        gpio.output(second_pin, 1)
+        rise_ns = time.perf_counter_ns()
+
+        _sleep_until(rise_ns + first_ns, self._spin_ns)
+        gpio.output(first_pin, 0)
+        first_fall_ns = time.perf_counter_ns()
+        _sleep_until(rise_ns + second_ns, self._spin_ns)
+        gpio.output(second_pin, 0)
+        second_fall_ns = time.perf_counter_ns()
+
+        first.pulse_error.record(first_fall_ns - rise_ns - first_ns)
+        second.pulse_error.record(second_fall_ns - rise_ns - second_ns)
+        if self._last_rise_ns is not None:
+            error = rise_ns - self._last_rise_ns - period_ns
+            first.period_error.record(error)
+            second.period_error.record(error)
+        self._last_rise_ns = rise_ns
+        self._next_rise_ns = rise + period_ns
+        return True
+
+    def _pwm_period(self, left_pulse, right_pulse, width, wait):
+        self._left._set_pwm(left_pulse, width)
+        self._right._set_pwm(right_pulse, width)
+
+        period_ns = int((max(left_pulse, right_pulse) + width) * 1e9)
+        rise = self._schedule(period_ns)
+        if not _wait_until(rise, self._spin_ns, wait):
+            return False
+        self._next_rise_ns = rise + period_ns
+        return True
+
+    def reset_stats(self):
+        self._left.reset_stats()
+        self._right.reset_stats()
+
+    @property
+    def left(self):
+        return self._left
+
+    @property
+    def right(self):
+        return self._right
+
 if __name__ == '__main__':
     pin_signal = 13
 
+    motor = WheelMotor(pin_signal=pin_signal)
     for pulse in np.arange(0.0013, 0.0016, 0.0001):
         print('pulse: {}'.format(pulse))
-        generate_pulse(pin_signal,repeat=200,pulse=pulse,width=0.020)
+        motor.generate_pulse(repeat=200,pulse=pulse,width=0.020)
+        print('pulse error (ns): {}, period error (ns): {}'.format(motor.pulse_error.summary, motor.period_error.summary))
+        motor.reset_stats()
 
@@ -5,6 +5,7 @@ import sys
 import signal
 import os
 import copy
+import time
 
 UP_ARR    = "__up_arrow__"
 DOWN_ARR  = "__down_arrow__"
@@ -12,6 +13,11 @@ LEFT_ARR  = "__left_arrow__"
 RIGHT_ARR = "__right_arrow__"
 
 def getchar(timeout=3):
+    if not sys.stdin.isatty():
+        # no keyboard (e.g. a simulated run in the background): wait as if no key was pressed
+        time.sleep(timeout / 10.)
+        return ''
+
     fd = sys.stdin.fileno()
     old_setting = termios.tcgetattr(fd)
 